@@ -62,11 +62,70 @@ export type AnalyticsDataPoint = {
 	dimension_key: string | null
 }
 
+// An alert rollup table the screener keeps. An alert is counted in the bucket its timestamp
+// starts with, and startSuffix turns a bucket back into the first timestamp it holds.
+type Rollup = {
+	table: string
+	bucketPrefix: RegExp
+	bucketStart: string
+	startSuffix: string
+}
+
+// The rollup tables, coarsest first
+const ROLLUPS: Rollup[] = [
+	{
+		table: "alert_rollups_daily",
+		bucketPrefix: /^\d{4}-\d{2}-\d{2} /,
+		bucketStart: "00:00:00",
+		startSuffix: " 00:00:00"
+	},
+	{
+		table: "alert_rollups_hourly",
+		bucketPrefix: /^\d{4}-\d{2}-\d{2} \d{2}:/,
+		bucketStart: "00:00",
+		startSuffix: ":00"
+	}
+]
+
+/**
+ * Whether comparing the timestamps of alerts with a bound gives the same answer for every
+ * alert in a bucket, so the bucket can be counted or skipped whole. A bound falling inside
+ * a bucket splits it, and the alerts have to be read instead.
+ */
+function bucketsAlignWith(rollup: Rollup, bound: string, isUpper: boolean): boolean {
+	const prefix = bound.match(rollup.bucketPrefix)
+	if (!prefix) {
+		return true
+	}
+	const start = prefix[0] + rollup.bucketStart
+	return isUpper ? bound < start : bound <= start
+}
+
+/**
+ * The coarsest rollup table that can answer a query grouped by timeGroupBy with the same
+ * counts as the alerts table, or undefined if the alerts have to be read.
+ */
+function chooseRollup(
+	timeGroupBy: TimeGroupBy,
+	lowerBounds: string[],
+	upperBounds: string[]
+): Rollup | undefined {
+	return ROLLUPS.find(
+		rollup =>
+			(timeGroupBy !== "hour" || rollup.table === "alert_rollups_hourly") &&
+			lowerBounds.every(bound => bucketsAlignWith(rollup, bound, false)) &&
+			upperBounds.every(bound => bucketsAlignWith(rollup, bound, true))
+	)
+}
+
 class DatabaseService {
 	private db: sqlite3.Database | null = null
 
 	private MAX_ALERTS = 100
 
+	// Whether the screener keeps the alert_rollups_* tables in this database
+	private hasRollups = false
+
 	constructor() {
 		this.initialize()
 	}
@@ -75,6 +134,15 @@ class DatabaseService {
 		if (!this.db) {
 			const dbPath = path.join(__dirname, process.env.DATABASE_PATH!)
 			this.db = new sqlite3.Database(dbPath)
+			// The screener puts the database in WAL mode, so reads never block its writes.
+			// These settings only last for this connection.
+			this.db.exec("PRAGMA busy_timeout = 5000; PRAGMA cache_size = -65536; PRAGMA mmap_size = 268435456;")
+			this.db.get(
+				"SELECT COUNT(*) as count FROM sqlite_master WHERE type = 'table' AND name IN ('alert_rollups_hourly', 'alert_rollups_daily')",
+				(err, row: { count: number }) => {
+					this.hasRollups = !err && row.count === 2
+				}
+			)
 		}
 	}
 
@@ -187,22 +255,34 @@ class DatabaseService {
 		let groupByExpr: string
 		let selectExpr: string
 
+		// Read the daily or hourly counts the screener keeps instead of every alert when
+		// they exist. Their buckets are already formatted like the time keys. The coarsest
+		// table whose buckets no date bound falls inside is used, so the counts are the
+		// same as the alerts table gives, and the alerts are read when there is none.
+		const lowerBounds = [minTimestamp, startDate].filter((bound): bound is string => !!bound)
+		const upperBounds = endDate ? [endDate] : []
+		const rollup = this.hasRollups ? chooseRollup(timeGroupBy, lowerBounds, upperBounds) : undefined
+		const source = rollup ? rollup.table : "alerts"
+		const countExpr = rollup ? "COALESCE(SUM(alerts), 0)" : "COUNT(*)"
+		// the first timestamp of a bucket, compared with the bounds like a timestamp
+		const timeColumn = rollup ? `bucket || '${rollup.startSuffix}'` : "timestamp"
+
 		// Handle time-based grouping
 		let timeGroupExpr = ""
 		let timeSelectExpr = ""
 
 		switch (timeGroupBy) {
 			case "month":
-				timeGroupExpr = "strftime('%Y-%m', timestamp)"
-				timeSelectExpr = "strftime('%Y-%m', timestamp)"
+				timeGroupExpr = rollup ? "substr(bucket, 1, 7)" : "strftime('%Y-%m', timestamp)"
+				timeSelectExpr = timeGroupExpr
 				break
 			case "hour":
-				timeGroupExpr = "strftime('%Y-%m-%d %H:00', timestamp)"
-				timeSelectExpr = "strftime('%Y-%m-%d %H:00', timestamp)"
+				timeGroupExpr = rollup ? "bucket" : "strftime('%Y-%m-%d %H:00', timestamp)"
+				timeSelectExpr = timeGroupExpr
 				break
 			case "day":
-				timeGroupExpr = "strftime('%Y-%m-%d', timestamp)"
-				timeSelectExpr = "strftime('%Y-%m-%d', timestamp)"
+				timeGroupExpr = rollup ? "substr(bucket, 1, 10)" : "strftime('%Y-%m-%d', timestamp)"
+				timeSelectExpr = timeGroupExpr
 				break
 			default:
 				// Not a time-based group
@@ -252,15 +332,21 @@ class DatabaseService {
 		}
 
 		// For a count query to get the total regardless of grouping
-		let totalQuery = "SELECT COUNT(*) as count FROM alerts"
+		let totalQuery = `SELECT ${countExpr} as count FROM ${source}`
 		const totalWhereClauses: string[] = []
 		const totalParams: any[] = []
 
 		// Build the query
-		let query = `SELECT ${selectExpr}, COUNT(*) as count FROM alerts`
+		let query = `SELECT ${selectExpr}, ${countExpr} as count FROM ${source}`
 		const whereClauses: string[] = []
 		const params: any[] = []
 
+		if (rollup) {
+			// Buckets holding only coalesced repeats have no alerts of their own
+			whereClauses.push(`alerts > 0`)
+			totalWhereClauses.push(`alerts > 0`)
+		}
+
 		if (alert_name) {
 			whereClauses.push(`alert_name LIKE ?`)
 			params.push(`%${alert_name}%`)
@@ -306,24 +392,24 @@ class DatabaseService {
 
 		// Add filter for minimum timestamp
 		if (minTimestamp) {
-			whereClauses.push(`timestamp >= ?`)
+			whereClauses.push(`${timeColumn} >= ?`)
 			params.push(minTimestamp)
-			totalWhereClauses.push(`timestamp >= ?`)
+			totalWhereClauses.push(`${timeColumn} >= ?`)
 			totalParams.push(minTimestamp)
 		}
 
 		// Add date range filters if provided
 		if (startDate) {
-			whereClauses.push(`timestamp >= ?`)
+			whereClauses.push(`${timeColumn} >= ?`)
 			params.push(startDate)
-			totalWhereClauses.push(`timestamp >= ?`)
+			totalWhereClauses.push(`${timeColumn} >= ?`)
 			totalParams.push(startDate)
 		}
 
 		if (endDate) {
-			whereClauses.push(`timestamp <= ?`)
+			whereClauses.push(`${timeColumn} <= ?`)
 			params.push(endDate)
-			totalWhereClauses.push(`timestamp <= ?`)
+			totalWhereClauses.push(`${timeColumn} <= ?`)
 			totalParams.push(endDate)
 		}
 
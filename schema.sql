@@ -1,5 +1,19 @@
 -- The database name is database.db
 -- It is stored in the same directory as this file.
+-- This is the schema as of the latest migration in screener/src/Database.py.
+-- Databases are created and migrated with screener/scripts/createdb.py, and
+-- the screener migrates older ones when it connects.
+
+-- Space freed by deleted rows is given back a little at a time by retention.
+-- This must come before the first table is created.
+PRAGMA auto_vacuum = INCREMENTAL;
+
+-- The migrations applied to the database
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
 
 -- Alerts table to store triggered warnings
 CREATE TABLE IF NOT EXISTS alerts (
@@ -10,7 +24,12 @@ CREATE TABLE IF NOT EXISTS alerts (
     destination_domain TEXT NOT NULL,
     type TEXT NOT NULL,
     severity INTEGER NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    -- Repeats of an alert within the suppression window are counted on its row
+    fingerprint TEXT,
+    occurrences INTEGER NOT NULL DEFAULT 1,
+    first_seen DATETIME,
+    last_seen DATETIME
 );
 
 -- Junction table for alerts-tcp_messages many-to-many relationship
@@ -40,6 +59,7 @@ CREATE TABLE IF NOT EXISTS tcp_messages (
     server_host TEXT,
     server_port INTEGER,
     message_content BLOB,
+    payload_hash TEXT REFERENCES payload_blobs(hash),
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -51,14 +71,90 @@ CREATE TABLE IF NOT EXISTS http_requests (
     method TEXT,
     headers TEXT,
     request_content TEXT,
+    payload_hash TEXT REFERENCES payload_blobs(hash),
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Request and message payloads, stored once per distinct content.
+-- New rows leave request_content/message_content NULL and point here by hash.
+CREATE TABLE IF NOT EXISTS payload_blobs (
+    hash TEXT PRIMARY KEY,
+    content BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    -- How content is compressed, NULL if it is stored as is
+    codec TEXT,
+    dictionary_id INTEGER REFERENCES payload_dictionaries(id)
+);
+
+-- The shared dictionaries payloads are compressed with, trained from earlier payloads
+CREATE TABLE IF NOT EXISTS payload_dictionaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    codec TEXT NOT NULL,
+    content BLOB NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Read payloads through these views to get the content wherever it is stored.
+-- Compressed payloads have a NULL content and their codec in payload_codec;
+-- read them with read_http_request_content or read_tcp_message_content from
+-- screener/src/PayloadStore.py, which decompress them
+CREATE VIEW IF NOT EXISTS http_requests_with_content AS
+SELECT
+    r.id, r.flow_id, r.url, r.method, r.headers,
+    CASE WHEN b.hash IS NULL THEN r.request_content
+        WHEN b.codec IS NULL THEN CAST(b.content AS TEXT) END AS request_content,
+    b.codec AS payload_codec,
+    r.timestamp
+FROM http_requests r
+LEFT JOIN payload_blobs b ON b.hash = r.payload_hash;
+
+CREATE VIEW IF NOT EXISTS tcp_messages_with_content AS
+SELECT
+    m.id, m.flow_id, m.client_host, m.client_port, m.server_host, m.server_port,
+    CASE WHEN b.hash IS NULL THEN m.message_content
+        WHEN b.codec IS NULL THEN b.content END AS message_content,
+    b.codec AS payload_codec,
+    m.timestamp
+FROM tcp_messages m
+LEFT JOIN payload_blobs b ON b.hash = m.payload_hash;
+
+-- Alert counts per hour and per day, kept up to date by the screener as it
+-- writes alerts. Coalesced repeats count as occurrences but not as alerts.
+CREATE TABLE IF NOT EXISTS alert_rollups_hourly (
+    bucket TEXT NOT NULL,
+    alert_name TEXT NOT NULL,
+    application_from TEXT NOT NULL,
+    destination_domain TEXT NOT NULL,
+    type TEXT NOT NULL,
+    severity INTEGER NOT NULL,
+    alerts INTEGER NOT NULL DEFAULT 0,
+    occurrences INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, alert_name, application_from, destination_domain, type, severity)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS alert_rollups_daily (
+    bucket TEXT NOT NULL,
+    alert_name TEXT NOT NULL,
+    application_from TEXT NOT NULL,
+    destination_domain TEXT NOT NULL,
+    type TEXT NOT NULL,
+    severity INTEGER NOT NULL,
+    alerts INTEGER NOT NULL DEFAULT 0,
+    occurrences INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, alert_name, application_from, destination_domain, type, severity)
+) WITHOUT ROWID;
+
 -- Create indexes for better query performance
 CREATE INDEX IF NOT EXISTS idx_alerts_alert_name ON alerts(alert_name);
-CREATE INDEX IF NOT EXISTS idx_alerts_timestamp ON alerts(timestamp);
-CREATE INDEX IF NOT EXISTS idx_tcp_messages_flow_id ON tcp_messages(flow_id);
-CREATE INDEX IF NOT EXISTS idx_http_requests_flow_id ON http_requests(flow_id);
+CREATE INDEX IF NOT EXISTS idx_alerts_first_seen ON alerts(first_seen);
+
+-- Indexes matching the dashboard: the alert list is ordered by severity then
+-- time, and the analytics group a time range by type, application or destination
+CREATE INDEX IF NOT EXISTS idx_alerts_severity_timestamp ON alerts(severity, timestamp);
+CREATE INDEX IF NOT EXISTS idx_alerts_timestamp_type ON alerts(timestamp, type);
+CREATE INDEX IF NOT EXISTS idx_alerts_application_timestamp ON alerts(application_from, timestamp);
+CREATE INDEX IF NOT EXISTS idx_alerts_destination_timestamp ON alerts(destination_domain, timestamp);
 
 -- Additional indexes for junction tables
 CREATE INDEX IF NOT EXISTS idx_alert_tcp_messages_tcp_id ON alert_tcp_messages(tcp_message_id);
@@ -73,5 +169,7 @@ CREATE INDEX IF NOT EXISTS idx_tcp_messages_server_host ON tcp_messages(server_h
 CREATE INDEX IF NOT EXISTS idx_http_requests_timestamp ON http_requests(timestamp);
 CREATE INDEX IF NOT EXISTS idx_http_requests_url ON http_requests(url);
 CREATE INDEX IF NOT EXISTS idx_http_requests_method ON http_requests(method);
+CREATE INDEX IF NOT EXISTS idx_http_requests_payload_hash ON http_requests(payload_hash);
+CREATE INDEX IF NOT EXISTS idx_tcp_messages_payload_hash ON tcp_messages(payload_hash);
 
 PRAGMA foreign_keys = ON;
@@ -0,0 +1,409 @@
+"""
+Benchmarks for the screeners, the combined pipeline and the alert write path.
+
+Run from the screener directory:
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --quick --suites screeners
+    python benchmarks/bench.py --sizes 1MB,32MB --contents json --densities 0,5
+
+Suites:
+    screeners   each screener on its own, with its own MatchEngine
+    pipeline    AllScreenersCombined.request with every screener
+    tcp         AllScreenersCombined.tcp_message over a segmented stream
+    cached      AllScreenersCombined.request answered from the verdict cache
+    db          committing alert batches and the queued AlertWriter path
+
+Results are written as JSON, one entry per benchmark and parameter set,
+so runs can be compared across commits. A summary table goes to stderr.
+
+The same flows are replayed over and over, so every suite but cached runs
+without the verdict cache, and the device location is fixed rather than
+looked up, keeping the network out of the results.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+from AlertRecord import AlertRecord, HttpRequestRecord  # noqa: E402
+from AlertRollups import AlertRollupBatch  # noqa: E402
+from AlertWriter import AlertWriter  # noqa: E402
+from AllScreenersCombined import AllScreenersCombined, build_screeners  # noqa: E402
+from Database import connect_database  # noqa: E402
+from DeviceLocator import StaticLocation  # noqa: E402
+from ScreeningContext import ScreeningContext  # noqa: E402
+from ScreeningExecutor import build_match_engine  # noqa: E402
+
+from flowgen import (  # noqa: E402
+    CONTENT_TYPES,
+    FlowSpec,
+    format_size,
+    make_http_flow,
+    make_tcp_flow,
+    parse_size,
+)
+
+
+SUITES = ("screeners", "pipeline", "tcp", "cached", "db")
+
+
+def measure(
+    run: Callable[[], Any], min_time: float, min_runs: int, max_runs: int
+) -> List[float]:
+    """Time run until both min_time has passed and min_runs are done"""
+    durations: List[float] = []
+    started = time.perf_counter()
+    while len(durations) < max_runs and (
+        len(durations) < min_runs or time.perf_counter() - started < min_time
+    ):
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(
+    benchmark: str, params: Dict[str, Any], durations: List[float], size: int
+) -> Dict[str, Any]:
+    """A result entry with timing statistics and throughput"""
+    ordered = sorted(durations)
+    median = statistics.median(ordered)
+    return {
+        "benchmark": benchmark,
+        **params,
+        "runs": len(ordered),
+        "mean_s": statistics.fmean(ordered),
+        "median_s": median,
+        "min_s": ordered[0],
+        "p95_s": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "stdev_s": statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        "bytes": size,
+        "mb_per_s": size / median / (1 << 20) if median > 0 and size else None,
+    }
+
+
+def create_database(path: str) -> sqlite3.Connection:
+    """Create a database with the project schema and settings"""
+    return connect_database(path)
+
+
+def build_addon(database_path: str, verdict_cache_entries: int = 0) -> AllScreenersCombined:
+    """Every screener, screening each flow unless verdict_cache_entries is set"""
+    return AllScreenersCombined(
+        database_path,
+        location_providers=[StaticLocation(0.0, 0.0)],
+        location_cache_path=None,
+        verdict_cache_entries=verdict_cache_entries,
+    )
+
+
+def bench_screeners(
+    specs: List[FlowSpec], options: argparse.Namespace, writer: AlertWriter
+) -> List[Dict[str, Any]]:
+    results = []
+    for screener in build_screeners(writer):
+        name = type(screener).__name__
+        engine = build_match_engine([screener])
+        for spec in specs:
+            flow = make_http_flow(spec)
+            durations = measure(
+                # a fresh context per run, so nothing is cached between runs
+                lambda: screener.run_screen(ScreeningContext(flow, engine)),
+                options.min_time,
+                options.min_runs,
+                options.max_runs,
+            )
+            results.append(
+                summarize(
+                    "screener",
+                    spec_params(spec, screener=name),
+                    durations,
+                    len(flow.request.content or b""),
+                )
+            )
+            report(results[-1])
+    return results
+
+
+def bench_pipeline(
+    specs: List[FlowSpec],
+    options: argparse.Namespace,
+    addon: AllScreenersCombined,
+    benchmark: str = "pipeline_http",
+) -> List[Dict[str, Any]]:
+    results = []
+    for spec in specs:
+        flow = make_http_flow(spec)
+        durations = measure(
+            lambda: addon.request(flow), options.min_time, options.min_runs, options.max_runs
+        )
+        results.append(
+            summarize(
+                benchmark, spec_params(spec), durations, len(flow.request.content or b"")
+            )
+        )
+        report(results[-1])
+    return results
+
+
+def bench_tcp(
+    specs: List[FlowSpec], options: argparse.Namespace, addon: AllScreenersCombined
+) -> List[Dict[str, Any]]:
+    results = []
+    for spec in specs:
+        flow, messages = make_tcp_flow(spec, options.segment_size)
+
+        def replay() -> None:
+            flow.messages = []
+            for message in messages:
+                flow.messages.append(message)
+                addon.tcp_message(flow)
+            addon.tcp_end(flow)
+
+        durations = measure(replay, options.min_time, options.min_runs, options.max_runs)
+        results.append(
+            summarize(
+                "pipeline_tcp",
+                spec_params(spec, segments=len(messages), segment_size=options.segment_size),
+                durations,
+                sum(len(message.content) for message in messages),
+            )
+        )
+        report(results[-1])
+    return results
+
+
+def alert_records(count: int, payload_size: int, offset: int) -> List[AlertRecord]:
+    """Alerts with distinct payloads of payload_size bytes each"""
+    filler = "x" * max(payload_size - 16, 0)
+    return [
+        AlertRecord(
+            alert_name="Benchmark Alert",
+            message=f"Benchmark alert {offset + index}",
+            application_from="bench/1.0",
+            destination_domain="bench.example.com",
+            type="benchmark",
+            severity=1,
+            http_request=HttpRequestRecord(
+                flow_id=f"bench-{offset + index}",
+                url="https://bench.example.com/v1/events",
+                method="POST",
+                headers="Content-Type: application/json",
+                request_content=f"{offset + index:016d}{filler}",
+            ),
+        )
+        for index in range(count)
+    ]
+
+
+def bench_db(options: argparse.Namespace, directory: str) -> List[Dict[str, Any]]:
+    results = []
+    database_path = ":memory:" if options.memory else f"{directory}/bench-direct.db"
+    connection = create_database(database_path)
+    writer = AlertWriter(f"{directory}/bench-queued.db", flush_interval=0.05)
+    create_database(f"{directory}/bench-queued.db").close()
+
+    offset = 0
+    for payload_size in options.payload_sizes:
+        for batch_size in options.batch_sizes:
+
+            def commit_batch() -> None:
+                nonlocal offset
+                batch = alert_records(batch_size, payload_size, offset)
+                offset += batch_size
+                rollups = AlertRollupBatch()
+                with connection:
+                    cursor = connection.cursor()
+                    for record in batch:
+                        writer.write_record(cursor, record)
+                        rollups.add(record)
+                    rollups.save(cursor)
+
+            durations = measure(
+                commit_batch, options.min_time, options.min_runs, options.max_runs
+            )
+            results.append(
+                summarize(
+                    "db_commit_batch",
+                    {
+                        "database": "memory" if options.memory else "file",
+                        "batch_size": batch_size,
+                        "payload_size": payload_size,
+                    },
+                    durations,
+                    batch_size * payload_size,
+                )
+            )
+            report(results[-1])
+
+        def submit_and_flush() -> None:
+            nonlocal offset
+            for record in alert_records(options.queued_alerts, payload_size, offset):
+                writer.submit(record)
+            offset += options.queued_alerts
+            writer.flush()
+
+        durations = measure(
+            submit_and_flush, options.min_time, options.min_runs, options.max_runs
+        )
+        results.append(
+            summarize(
+                "db_queued_writer",
+                {"alerts": options.queued_alerts, "payload_size": payload_size},
+                durations,
+                options.queued_alerts * payload_size,
+            )
+        )
+        report(results[-1])
+
+    writer.close()
+    connection.close()
+    return results
+
+
+def spec_params(spec: FlowSpec, **extra: Any) -> Dict[str, Any]:
+    return {
+        **extra,
+        "content": spec.content,
+        "size": spec.size,
+        "density": spec.density,
+    }
+
+
+def report(result: Dict[str, Any]) -> None:
+    """Print a one line summary of a result to stderr"""
+    described = ", ".join(
+        f"{key}={format_size(value) if key in ('size', 'payload_size') else value}"
+        for key, value in result.items()
+        if key in ("screener", "content", "size", "density", "batch_size", "payload_size", "alerts")
+    )
+    throughput = f"{result['mb_per_s']:9.2f} MB/s" if result["mb_per_s"] else ""
+    print(
+        f"{result['benchmark']:<20} {described:<60} "
+        f"median {result['median_s'] * 1000:10.3f} ms  {throughput}",
+        file=sys.stderr,
+    )
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=current_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the screeners, pipeline and alert writer"
+    )
+    parser.add_argument("--suites", default=",".join(SUITES), help="comma separated")
+    parser.add_argument("--sizes", default="100,10KB,1MB,10MB", help="body sizes")
+    parser.add_argument("--contents", default=",".join(CONTENT_TYPES), help="body kinds")
+    parser.add_argument("--densities", default="0,1", help="needles per KiB")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--segment-size", type=int, default=16384, help="TCP segment size")
+    parser.add_argument("--payload-sizes", default="1KB,64KB", help="alert payload sizes")
+    parser.add_argument("--batch-sizes", default="1,100", help="alerts per transaction")
+    parser.add_argument("--queued-alerts", type=int, default=500)
+    parser.add_argument("--memory", action="store_true", help="commit batches to :memory:")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds per benchmark")
+    parser.add_argument("--min-runs", type=int, default=3)
+    parser.add_argument("--max-runs", type=int, default=1000)
+    parser.add_argument("--quick", action="store_true", help="small sizes, short runs")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    options = parser.parse_args(argv)
+
+    if options.quick:
+        options.sizes = "100,10KB,256KB"
+        options.min_time = 0.2
+        options.payload_sizes = "1KB"
+
+    options.suites = [suite for suite in options.suites.split(",") if suite]
+    unknown = set(options.suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+    options.sizes = [parse_size(size) for size in options.sizes.split(",")]
+    options.contents = options.contents.split(",")
+    options.densities = [float(density) for density in options.densities.split(",")]
+    options.payload_sizes = [parse_size(size) for size in options.payload_sizes.split(",")]
+    options.batch_sizes = [int(size) for size in options.batch_sizes.split(",")]
+    return options
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    options = parse_args(argv)
+    specs = [
+        FlowSpec(size, content, density, options.seed)
+        for content in options.contents
+        for size in options.sizes
+        for density in options.densities
+    ]
+
+    results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="traffic-slice-bench-") as directory:
+        # alerts raised while benchmarking are written to a throwaway database
+        database_path = f"{directory}/bench-alerts.db"
+        create_database(database_path).close()
+
+        # screeners print every trigger, keep that out of the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            addon = build_addon(database_path)
+            if "screeners" in options.suites:
+                results += bench_screeners(specs, options, addon.alert_writer)
+            if "pipeline" in options.suites:
+                results += bench_pipeline(specs, options, addon)
+            if "tcp" in options.suites:
+                results += bench_tcp(specs, options, addon)
+            addon.done()
+            if "cached" in options.suites:
+                # every run after the first is a verdict cache hit
+                cached = build_addon(database_path, verdict_cache_entries=10000)
+                results += bench_pipeline(specs, options, cached, "pipeline_http_cached")
+                cached.done()
+            if "db" in options.suites:
+                results += bench_db(options, directory)
+
+    output = json.dumps(
+        {
+            "meta": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "options": {
+                    key: value for key, value in vars(options).items() if key != "output"
+                },
+            },
+            "results": results,
+        },
+        indent=2,
+    )
+    if options.output:
+        pathlib.Path(options.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Synthetic flow generator for the screener benchmarks.
+
+Flows are generated deterministically from a seed, with request bodies of a
+chosen size and content type, and "needles" (values the screeners alert on)
+planted at a chosen density.
+"""
+
+import json
+import random
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import quote_plus, urlencode
+
+from mitmproxy import http, tcp
+from mitmproxy.test import tflow
+
+
+CONTENT_TYPES: Dict[str, str] = {
+    "json": "application/json",
+    "form": "application/x-www-form-urlencoded",
+    "text": "text/plain; charset=utf-8",
+    "binary": "application/octet-stream",
+}
+"""The body kinds the generator can produce and their Content-Type"""
+
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima "
+    "mike november oscar papa quebec romeo sierra tango uniform victor whiskey "
+    "xray yankee zulu session user profile event click view page item cart "
+    "order status value count total result error retry token-less payload"
+).split()
+
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/124.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_4) AppleWebKit/605.1.15 Safari/17.4",
+    "okhttp/4.12.0",
+    "python-requests/2.31.0",
+)
+
+NEEDLES: Dict[str, Callable[[random.Random], str]] = {
+    "secret": lambda rng: "CqyTJns6LOXtDRxmlkuNAFfV91UjgreE",
+    "mac": lambda rng: ":".join(f"{rng.randrange(256):02x}" for _ in range(6)),
+    "filename": lambda rng: f"{rng.choice(WORDS)}_{rng.randrange(1000)}.pdf",
+    "timestamp": lambda rng: f"2024-03-{rng.randrange(1, 29):02d}T{rng.randrange(24):02d}:32:28Z",
+    "coordinates": lambda rng: f"{37.7 + rng.random() / 10:.4f},{-122.4 - rng.random() / 10:.4f}",
+}
+"""Generators of a value each screener alerts on, keyed by kind"""
+
+
+@dataclass(frozen=True)
+class FlowSpec:
+    """What a generated flow looks like"""
+
+    size: int
+    """Approximate request body size in bytes"""
+
+    content: str = "json"
+    """One of CONTENT_TYPES"""
+
+    density: float = 0.0
+    """Needles planted per KiB of body, may be fractional"""
+
+    seed: int = 0
+    """Seed of the generator, the same spec and seed give the same flow"""
+
+    @property
+    def label(self) -> str:
+        return f"{self.content}/{format_size(self.size)}/d{self.density:g}"
+
+
+def format_size(size: int) -> str:
+    for unit, scale in (("MB", 1 << 20), ("KB", 1 << 10)):
+        if size >= scale:
+            return f"{size / scale:g}{unit}"
+    return f"{size}B"
+
+
+def parse_size(text: str) -> int:
+    """Parse sizes like 100, 64KB or 10MB"""
+    text = text.strip().upper().removesuffix("B")
+    for suffix, scale in (("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30)):
+        if text.endswith(suffix):
+            return int(float(text[:-1]) * scale)
+    return int(text)
+
+
+def needle_count(rng: random.Random, size: int, density: float) -> int:
+    """The number of needles for a body, rounding the fraction randomly"""
+    expected = size / 1024 * density
+    count = int(expected)
+    if rng.random() < expected - count:
+        count += 1
+    return count
+
+
+def sentence(rng: random.Random, words: int = 8) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def needles(rng: random.Random, count: int) -> List[Tuple[str, str]]:
+    """(kind, value) of count needles, cycling through the kinds"""
+    kinds = list(NEEDLES)
+    return [
+        (kinds[index % len(kinds)], NEEDLES[kinds[index % len(kinds)]](rng))
+        for index in range(count)
+    ]
+
+
+def plant(rng: random.Random, chunks: List[str], count: int) -> None:
+    """Replace randomly chosen chunks with needles"""
+    for _, value in needles(rng, count):
+        chunks[rng.randrange(len(chunks))] = value
+
+
+def json_body(rng: random.Random, size: int, count: int) -> bytes:
+    records: List[Dict] = []
+    length = 2
+    while length < size:
+        record = {
+            "id": len(records),
+            "name": rng.choice(WORDS),
+            "note": sentence(rng),
+            "score": round(rng.random() * 100, 2),
+            "tags": [rng.choice(WORDS) for _ in range(3)],
+        }
+        records.append(record)
+        length += len(json.dumps(record)) + 1
+    if not records:
+        return b"{}"
+
+    for kind, value in needles(rng, count):
+        record = rng.choice(records)
+        if kind == "coordinates":
+            # the way location SDKs send them
+            latitude, longitude = value.split(",")
+            record["location"] = {"lat": float(latitude), "lng": float(longitude)}
+        else:
+            record["note"] = value
+    return json.dumps({"events": records}).encode()
+
+
+def form_body(rng: random.Random, size: int, count: int) -> bytes:
+    values: List[str] = []
+    length = 0
+    while length < size:
+        value = sentence(rng, 4)
+        values.append(value)
+        length += len(quote_plus(value)) + 8
+    plant(rng, values, count)
+    return urlencode([(f"field{index}", value) for index, value in enumerate(values)]).encode()
+
+
+def text_body(rng: random.Random, size: int, count: int) -> bytes:
+    words: List[str] = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    if not words:
+        return b""
+    plant(rng, words, count)
+    return " ".join(words).encode()
+
+
+def binary_body(rng: random.Random, size: int, count: int) -> bytes:
+    body = bytearray(rng.randbytes(size))
+    for _, value in needles(rng, count):
+        needle = value.encode()
+        if len(needle) >= size:
+            break
+        position = rng.randrange(size - len(needle))
+        body[position : position + len(needle)] = needle
+    return bytes(body)
+
+
+BODY_GENERATORS: Dict[str, Callable[[random.Random, int, int], bytes]] = {
+    "json": json_body,
+    "form": form_body,
+    "text": text_body,
+    "binary": binary_body,
+}
+
+
+def make_body(spec: FlowSpec) -> bytes:
+    """Generate the request body for a spec"""
+    rng = random.Random(spec.seed)
+    return BODY_GENERATORS[spec.content](
+        rng, spec.size, needle_count(rng, spec.size, spec.density)
+    )
+
+
+def make_http_flow(spec: FlowSpec) -> http.HTTPFlow:
+    """Generate an HTTP request flow for a spec"""
+    rng = random.Random(spec.seed + 1)
+    flow = tflow.tflow()
+    request = flow.request
+    request.method = "POST"
+    request.host = f"api.{rng.choice(WORDS)}.example.com"
+    request.port = 443
+    request.scheme = "https"
+    request.path = f"/v1/{rng.choice(WORDS)}?session={rng.randrange(10 ** 8)}&page={rng.randrange(50)}"
+    request.headers["User-Agent"] = rng.choice(USER_AGENTS)
+    request.headers["Content-Type"] = CONTENT_TYPES[spec.content]
+    request.headers["Accept"] = "application/json"
+    request.headers["Cookie"] = f"sid={rng.randbytes(16).hex()}"
+    request.content = make_body(spec)
+    return flow
+
+
+def make_tcp_flow(spec: FlowSpec, segment_size: int = 16384) -> Tuple[tcp.TCPFlow, List[tcp.TCPMessage]]:
+    """
+    Generate a TCP connection for a spec.
+
+    Returns the connection without messages and the messages to feed to it
+    one by one, so callers can replay the stream as it would arrive.
+    """
+    body = make_body(spec)
+    flow = tflow.ttcpflow(messages=[])
+    messages = [
+        tcp.TCPMessage(True, body[start : start + segment_size])
+        for start in range(0, max(len(body), 1), segment_size)
+    ]
+    return flow, messages
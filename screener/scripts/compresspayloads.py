@@ -0,0 +1,83 @@
+import argparse
+import pathlib
+import sqlite3
+import sys
+
+# Make the screener modules importable
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+from Database import close_database, connect_database  # noqa: E402
+from PayloadCodecs import DEFAULT_CODEC, PAYLOAD_CODECS  # noqa: E402
+from PayloadStore import (  # noqa: E402
+    load_payload_compressor,
+    recompress_payloads,
+    train_payload_dictionary,
+)
+from Retention import incremental_vacuum  # noqa: E402
+
+
+def compress_payloads(
+    db_name="../database.db",
+    codec=DEFAULT_CODEC,
+    train=True,
+    dictionary_size=64 * 1024,
+    batch_size=500,
+):
+    """
+    Compress the stored payloads of a database, training a dictionary for
+    the codec from them first
+    """
+    try:
+        conn = connect_database(db_name)
+
+        before = conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM payload_blobs").fetchone()[0]
+        if train:
+            dictionary_id = train_payload_dictionary(conn, codec, size=dictionary_size)
+            print(f"Trained {codec} dictionary {dictionary_id}")
+
+        compressor = load_payload_compressor(conn, codec)
+        recompressed = recompress_payloads(conn, compressor, batch_size=batch_size)
+        after = conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM payload_blobs").fetchone()[0]
+        print(
+            f"Compressed {recompressed} payloads with {codec}, "
+            f"from {before} to {after} bytes"
+        )
+
+        pages = incremental_vacuum(conn)
+        if pages:
+            print(f"Freed {pages} pages")
+
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+
+    finally:
+        if "conn" in locals():
+            close_database(conn)
+
+
+"""
+This file should be run from the screener directory.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=compress_payloads.__doc__)
+    parser.add_argument("database", nargs="?", default="../database.db")
+    parser.add_argument("--codec", choices=list(PAYLOAD_CODECS), default=DEFAULT_CODEC)
+    parser.add_argument(
+        "--no-train",
+        dest="train",
+        action="store_false",
+        help="use the newest dictionary of the codec instead of training one",
+    )
+    parser.add_argument("--dictionary-size", type=int, default=64 * 1024)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    compress_payloads(
+        args.database,
+        codec=args.codec,
+        train=args.train,
+        dictionary_size=args.dictionary_size,
+        batch_size=args.batch_size,
+    )
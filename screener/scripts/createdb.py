@@ -1,36 +1,29 @@
-import sqlite3
 import pathlib
+import sqlite3
+import sys
 
-# Get the current directory and schema file
+# Make the screener modules importable
 current_dir = pathlib.Path(__file__).parent
-schema_path = current_dir / "../../schema.sql"
+sys.path.insert(0, str(current_dir / "../src"))
+
+from Database import SCHEMA_VERSION, close_database, connect_database  # noqa: E402
 
 
 def create_database(db_name="../database.db"):
-    """Create a new database using the schema.sql file"""
+    """Create a new database, or bring an existing one up to the current schema"""
     try:
         # Connect to database (this will create it if it doesn't exist)
-        conn = sqlite3.connect(db_name)
+        conn = connect_database(db_name)
 
-        # Read the schema file
-        with open(schema_path, "r") as f:
-            schema = f.read()
-
-        # Execute the schema
-        conn.executescript(schema)
-
-        print(f"Database '{db_name}' created successfully!")
+        print(f"Database '{db_name}' is ready at schema version {SCHEMA_VERSION}!")
 
     except sqlite3.Error as e:
         print(f"An error occurred: {e}")
 
-    except FileNotFoundError:
-        print(f"Schema file not found at: {schema_path}")
-
     finally:
         # Close the connection if it was opened
         if "conn" in locals():
-            conn.close()
+            close_database(conn)
 
 
 """
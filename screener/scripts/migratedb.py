@@ -0,0 +1,83 @@
+import argparse
+import pathlib
+import sqlite3
+import sys
+
+# Make the screener modules importable
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+from AlertRollups import rebuild_alert_rollups  # noqa: E402
+from Database import close_database, connect_database  # noqa: E402
+from PayloadCodecs import DEFAULT_CODEC  # noqa: E402
+from PayloadStore import (  # noqa: E402
+    backfill_payload_store,
+    delete_orphaned_payloads,
+    load_payload_compressor,
+)
+
+
+def migrate_database(
+    db_name="../database.db", batch_size=500, vacuum=False, rebuild_rollups=False
+):
+    """
+    Bring an existing database up to the current schema and move its payloads
+    into the payload blob table, compressed
+    """
+    try:
+        # Connecting applies the schema migrations the database is missing
+        conn = connect_database(db_name)
+
+        moved = backfill_payload_store(
+            conn,
+            batch_size=batch_size,
+            compressor=load_payload_compressor(conn, DEFAULT_CODEC),
+        )
+        print(f"Moved {moved} payloads into payload_blobs")
+
+        deleted = delete_orphaned_payloads(conn)
+        if deleted:
+            print(f"Deleted {deleted} orphaned payloads")
+
+        if rebuild_rollups:
+            # The migration fills the rollups once, this recounts them from scratch
+            counted = rebuild_alert_rollups(conn)
+            print(f"Recounted {counted} alerts into the rollup tables")
+
+        if vacuum:
+            # Reclaims the space the inline payloads took up
+            conn.execute("VACUUM")
+            print("Database vacuumed")
+
+        print(f"Database '{db_name}' migrated successfully!")
+
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+
+    finally:
+        if "conn" in locals():
+            close_database(conn)
+
+
+"""
+This file should be run from the screener directory.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=migrate_database.__doc__)
+    parser.add_argument("database", nargs="?", default="../database.db")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--vacuum", action="store_true")
+    parser.add_argument(
+        "--rebuild-rollups",
+        action="store_true",
+        help="recount the hourly and daily alert rollups from the alerts table",
+    )
+    args = parser.parse_args()
+
+    migrate_database(
+        args.database,
+        batch_size=args.batch_size,
+        vacuum=args.vacuum,
+        rebuild_rollups=args.rebuild_rollups,
+    )
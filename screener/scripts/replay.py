@@ -0,0 +1,70 @@
+import argparse
+import pathlib
+import sys
+
+# Make the screener modules importable
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+from Replay import SHARD_BY_HOST, SHARD_ROUND_ROBIN, Replay  # noqa: E402
+
+
+def replay_dumps(
+    db_name,
+    dumps,
+    workers=None,
+    batch_size=64,
+    shard=SHARD_BY_HOST,
+    suppression_window=600.0,
+    quiet=True,
+):
+    """Screen mitmproxy flow dumps offline and write the alerts to the database"""
+    replay = Replay(
+        db_name,
+        workers=workers,
+        batch_size=batch_size,
+        shard=shard,
+        suppression_window=suppression_window or None,
+        quiet=quiet,
+    )
+    stats = replay.run(dumps)
+
+    rate = stats.flows / stats.seconds if stats.seconds else 0.0
+    print(
+        f"Replayed {stats.flows} flows from {stats.files} dumps on {replay.workers} workers "
+        f"in {stats.seconds:.1f}s ({rate:.0f} flows/s), {stats.alerts} alerts, "
+        f"{stats.skipped} skipped"
+    )
+
+
+"""
+This file should be run from the screener directory.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=replay_dumps.__doc__)
+    parser.add_argument("dumps", nargs="+", help="mitmproxy .flow files or HAR files")
+    parser.add_argument("--database", default="../database.db")
+    parser.add_argument("--workers", type=int, help="defaults to one per CPU")
+    parser.add_argument("--batch-size", type=int, default=64, help="flows per hand-over")
+    parser.add_argument(
+        "--shard", choices=(SHARD_BY_HOST, SHARD_ROUND_ROBIN), default=SHARD_BY_HOST
+    )
+    parser.add_argument(
+        "--suppression-window",
+        type=float,
+        default=600.0,
+        help="seconds repeats of an alert are coalesced for, 0 to store every alert",
+    )
+    parser.add_argument("--verbose", action="store_true", help="print every alert")
+    args = parser.parse_args()
+
+    replay_dumps(
+        args.database,
+        args.dumps,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        shard=args.shard,
+        suppression_window=args.suppression_window,
+        quiet=not args.verbose,
+    )
@@ -0,0 +1,71 @@
+import argparse
+import pathlib
+import sqlite3
+import sys
+
+# Make the screener modules importable
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+from Database import close_database, connect_database  # noqa: E402
+from Retention import RetentionPolicy, apply_retention  # noqa: E402
+
+
+def apply_policy(db_name="../database.db", policy=None, batch_size=500):
+    """
+    Archive and delete the rows of a database that are older than the
+    retention policy keeps, then give the space freed back
+    """
+    try:
+        conn = connect_database(db_name)
+
+        stats = apply_retention(conn, policy or RetentionPolicy(), batch_size=batch_size)
+        print(
+            f"Archived {stats.archived_partitions} partitions, deleted "
+            f"{stats.deleted_rows} rows and {stats.deleted_payloads} payloads, "
+            f"and freed {stats.vacuumed_pages} pages"
+        )
+
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+
+    finally:
+        if "conn" in locals():
+            close_database(conn)
+
+
+def days(value):
+    """A number of days, or "never" to keep the rows forever"""
+    return None if value == "never" else float(value)
+
+
+"""
+This file should be run from the screener directory.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=apply_policy.__doc__)
+    parser.add_argument("database", nargs="?", default="../database.db")
+    parser.add_argument("--alerts-days", type=days, default=90.0)
+    parser.add_argument("--http-requests-days", type=days, default=30.0)
+    parser.add_argument("--tcp-messages-days", type=days, default=30.0)
+    parser.add_argument("--partition", choices=["day", "week"], default="day")
+    parser.add_argument(
+        "--archive-dir",
+        default="../archive",
+        help="where expired partitions are archived, or none to delete them outright",
+    )
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    apply_policy(
+        args.database,
+        RetentionPolicy(
+            alerts_days=args.alerts_days,
+            http_requests_days=args.http_requests_days,
+            tcp_messages_days=args.tcp_messages_days,
+            partition=args.partition,
+            archive_dir=None if args.archive_dir == "none" else args.archive_dir,
+        ),
+        batch_size=args.batch_size,
+    )
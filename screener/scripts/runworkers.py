@@ -0,0 +1,261 @@
+import argparse
+import multiprocessing
+import os
+import pathlib
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+# Make the screener modules importable
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+from AlertWriterService import (  # noqa: E402
+    AlertWriterService,
+    format_address,
+    parse_address,
+)
+from Retention import RetentionPolicy  # noqa: E402
+
+WORKER_SCRIPT = current_dir / "../src/worker.py"
+"""The mitmdump addon script every worker runs"""
+
+RESTART_BACKOFF_MAX = 60.0
+"""The most seconds a worker that keeps crashing waits to be restarted"""
+
+STOP_TIMEOUT = 30.0
+"""The seconds workers and the writer get to finish before they are killed"""
+
+
+def serve_writer(database_path, address, authkey, metrics_port, retention, ready, stop):
+    """
+    Run the writer service until stop is set, in its own process, expiring
+    old rows with the default retention policy if retention is set
+    """
+    # the supervisor decides when to stop, not the terminal's ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    service = AlertWriterService(
+        database_path,
+        address,
+        authkey=authkey,
+        retention=RetentionPolicy(archive_dir="../archive") if retention else None,
+        metrics_port=metrics_port,
+    )
+    ready.set()
+    service.serve(stop)
+
+
+def write_pac(path, proxy_host, ports):
+    """
+    Write a proxy auto-config file that spreads destinations over the
+    workers by a hash of their host, so each host is always screened by the
+    same worker and its rate windows see all of its traffic
+    """
+    port_list = ", ".join(str(port) for port in ports)
+    with open(path, "w") as f:
+        f.write(
+            "function FindProxyForURL(url, host) {\n"
+            f"    var ports = [{port_list}];\n"
+            "    var hash = 0;\n"
+            "    for (var i = 0; i < host.length; i++) {\n"
+            "        hash = (hash * 31 + host.charCodeAt(i)) % 2147483647;\n"
+            "    }\n"
+            f'    return "PROXY {proxy_host}:" + ports[hash % ports.length];\n'
+            "}\n"
+        )
+
+
+class Worker:
+    """A mitmdump process screening on one port, restarted when it dies"""
+
+    def __init__(self, index, port, command, env):
+        self.index = index
+        self.port = port
+        self.command = command
+        self.env = env
+        self.process = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.crashes = 0
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, env=self.env)
+        self.started_at = time.monotonic()
+        print(f"Started worker {self.index} on port {self.port}, pid {self.process.pid}")
+
+    def supervise(self):
+        """Restart the worker if it died, backing off while it keeps crashing"""
+        now = time.monotonic()
+        if self.process is not None:
+            code = self.process.poll()
+            if code is None:
+                return
+            # a worker that ran for a while has recovered from earlier crashes
+            self.crashes = 1 if now - self.started_at > RESTART_BACKOFF_MAX else self.crashes + 1
+            delay = min(RESTART_BACKOFF_MAX, 2.0 ** (self.crashes - 1))
+            print(f"Worker {self.index} exited with {code}, restarting in {delay:.0f}s")
+            self.process = None
+            self.restart_at = now + delay
+        if now >= self.restart_at:
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, deadline):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"Worker {self.index} did not stop in time, killing it")
+            self.process.kill()
+            self.process.wait()
+
+
+def run_workers(
+    workers=None,
+    listen_port=8080,
+    proxy_host="127.0.0.1",
+    pac_path="../proxy.pac",
+    db_name="../database.db",
+    writer_address="127.0.0.1:9470",
+    metrics_port=9464,
+    retention=False,
+    screener_config=None,
+    mitmdump=None,
+    mitmdump_args=(),
+):
+    """
+    Run several proxy workers, each screening on its own port and core,
+    with a single writer service that owns the database, restarting any
+    that die until interrupted
+    """
+    workers = workers or os.cpu_count() or 1
+    mitmdump = mitmdump or shutil.which("mitmdump") or "./.venv/bin/mitmdump"
+    address = parse_address(writer_address)
+    # shared with the workers through their environment only
+    authkey = secrets.token_bytes(32)
+
+    # a plain flag, as setting an Event in a handler can deadlock the wait on it
+    stopping = []
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+
+    # spawn, since forking a process with running threads is unsafe
+    context = multiprocessing.get_context("spawn")
+
+    def start_writer():
+        ready = context.Event()
+        # a fresh event each time, as one a killed writer was waiting on may
+        # be left locked
+        stop = context.Event()
+        process = context.Process(
+            target=serve_writer,
+            args=(db_name, address, authkey, metrics_port, retention, ready, stop),
+            name="alert-writer-service",
+        )
+        process.start()
+        while not ready.wait(0.1):
+            if not process.is_alive():
+                raise RuntimeError(f"The writer service failed to start on {writer_address}")
+        print(f"Started the writer service on {writer_address}, pid {process.pid}")
+        return process, stop
+
+    writer, writer_stop = start_writer()
+
+    ports = [listen_port + index for index in range(workers)]
+    write_pac(pac_path, proxy_host, ports)
+    print(f"Wrote {pac_path}, point clients at it to spread them over the workers")
+
+    pool = []
+    for index, port in enumerate(ports):
+        env = dict(
+            os.environ,
+            TRAFFIC_SLICE_WORKER=str(index),
+            TRAFFIC_SLICE_WRITER_ADDRESS=format_address(address),
+            TRAFFIC_SLICE_WRITER_AUTHKEY=authkey.hex(),
+            TRAFFIC_SLICE_METRICS_PORT=str(metrics_port + 1 + index) if metrics_port else "",
+            TRAFFIC_SLICE_SCREENER_CONFIG=screener_config or "",
+        )
+        command = [
+            mitmdump,
+            "-s",
+            str(WORKER_SCRIPT),
+            "--listen-port",
+            str(port),
+            "--set",
+            "flow_detail=0",
+            *mitmdump_args,
+        ]
+        pool.append(Worker(index, port, command, env))
+
+    try:
+        while not stopping:
+            if not writer.is_alive():
+                # the workers keep their alerts queued until it is back
+                print(f"The writer service exited with {writer.exitcode}, restarting it")
+                writer, writer_stop = start_writer()
+            for worker in pool:
+                worker.supervise()
+            time.sleep(1.0)
+    finally:
+        # the workers send what they have left before the writer stops
+        for worker in pool:
+            worker.stop()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in pool:
+            worker.wait(deadline)
+        writer_stop.set()
+        writer.join(STOP_TIMEOUT)
+        if writer.is_alive():
+            print("The writer service did not stop in time, terminating it")
+            writer.terminate()
+
+
+"""
+This file should be run from the screener directory.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=run_workers.__doc__)
+    parser.add_argument("--workers", type=int, help="defaults to one per CPU")
+    parser.add_argument("--listen-port", type=int, default=8080, help="the first worker's port")
+    parser.add_argument("--proxy-host", default="127.0.0.1", help="the host clients reach the workers at")
+    parser.add_argument("--pac", default="../proxy.pac", help="where to write the proxy auto-config file")
+    parser.add_argument("--database", default="../database.db")
+    parser.add_argument("--writer-address", default="127.0.0.1:9470", help="host:port or a Unix socket path")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=9464,
+        help="the writer's metrics port, workers use the ones after it, 0 to serve none",
+    )
+    parser.add_argument(
+        "--retention",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="delete alerts after 90 days and traffic after 30, archiving them to ../archive first",
+    )
+    parser.add_argument("--screener-config", help="a JSON screener config for every worker")
+    parser.add_argument("--mitmdump", help="the mitmdump executable")
+    parser.add_argument("mitmdump_args", nargs=argparse.REMAINDER, help="passed on to every worker")
+    args = parser.parse_args()
+
+    run_workers(
+        workers=args.workers,
+        listen_port=args.listen_port,
+        proxy_host=args.proxy_host,
+        pac_path=args.pac,
+        db_name=args.database,
+        writer_address=args.writer_address,
+        metrics_port=args.metrics_port or None,
+        retention=args.retention,
+        screener_config=args.screener_config,
+        mitmdump=args.mitmdump,
+        mitmdump_args=[arg for arg in args.mitmdump_args if arg != "--"],
+    )
@@ -0,0 +1,51 @@
+import argparse
+import pathlib
+import sys
+import time
+
+# Make the screener modules importable
+current_dir = pathlib.Path(__file__).parent
+sys.path.insert(0, str(current_dir / "../src"))
+
+HEAVY_MODULES = ["geocoder", "requests", "numpy", "ahocorasick", "zstandard"]
+"""Optional or slow to import dependencies worth knowing whether startup pulled in"""
+
+
+def measure_startup(config_path=None):
+    """
+    Measure what starting the screener costs: importing the addon, then
+    importing and building each screener a configuration enables
+    """
+    modules = len(sys.modules)
+    start = time.perf_counter()
+    from AllScreenersCombined import build_screeners
+    from ScreenerRegistry import ScreenerRegistry, load_screener_config
+    imported = time.perf_counter()
+    print(
+        f"Imported the addon in {(imported - start) * 1000:.1f} ms, "
+        f"{len(sys.modules) - modules} modules"
+    )
+
+    registry = ScreenerRegistry()
+    config = load_screener_config(config_path) if config_path else None
+    start = time.perf_counter()
+    screeners = build_screeners(None, config=config, registry=registry)
+    built = time.perf_counter()
+    print(registry.report())
+    print(f"Built {len(screeners)} screeners in {(built - start) * 1000:.1f} ms")
+
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f"Heavy modules imported: {', '.join(loaded) if loaded else 'none'}")
+    print(f"Screeners available: {', '.join(registry.available())}")
+
+
+"""
+This file should be run from the screener directory.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=measure_startup.__doc__)
+    parser.add_argument("config", nargs="?", help="a JSON screener config, every built-in screener by default")
+    args = parser.parse_args()
+
+    measure_startup(args.config)
@@ -0,0 +1,109 @@
+from collections import deque
+from typing import Any, Dict, Iterator, List, Tuple
+
+try:
+    import ahocorasick  # pyahocorasick, optional C implementation
+except ImportError:
+    ahocorasick = None
+
+
+class AhoCorasick:
+    """
+    An Aho-Corasick automaton for finding many keywords in one pass over a text.
+
+    Keywords are added with a value, then build is called once. iter yields
+    (end index, value) for every occurrence of every keyword, overlapping
+    occurrences included.
+
+    Uses pyahocorasick when it is installed and falls back to a pure Python
+    implementation otherwise.
+    """
+
+    def __init__(self) -> None:
+        self._built = False
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            return
+
+        # state 0 is the root
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[List[Any]] = [[]]
+
+    def __len__(self) -> int:
+        if ahocorasick is not None:
+            return len(self._automaton)
+        return sum(len(outputs) for outputs in self._outputs)
+
+    def add(self, keyword: str, value: Any) -> None:
+        """Add a keyword. Adding the same keyword again replaces its value"""
+        if self._built:
+            raise Exception("Cannot add keywords after the automaton is built")
+        if not keyword:
+            raise ValueError("Keywords must not be empty")
+
+        if ahocorasick is not None:
+            self._automaton.add_word(keyword, value)
+            return
+
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+        self._outputs[state] = [value]
+
+    def build(self) -> None:
+        """Compute the failure links. Must be called before iter"""
+        self._built = True
+        if ahocorasick is not None:
+            if len(self._automaton):
+                self._automaton.make_automaton()
+            return
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+
+                # keywords ending at the fallback state also end here
+                self._outputs[next_state] = (
+                    self._outputs[next_state] + self._outputs[self._fail[next_state]]
+                )
+
+    def iter(self, text: str) -> Iterator[Tuple[int, Any]]:
+        """Yield (end index, value) for every keyword occurrence in the text"""
+        if not self._built:
+            raise Exception("The automaton must be built before searching")
+
+        if ahocorasick is not None:
+            if len(self._automaton):
+                yield from self._automaton.iter(text)
+            return
+
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        root = goto[0]
+        if not root:
+            return
+
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                for value in outputs[state]:
+                    yield index, value
@@ -0,0 +1,38 @@
+import threading
+from typing import List
+
+from AlertRecord import AlertRecord
+from AlertWriter import AlertSink, AlertWriterStats
+
+
+class AlertCollector(AlertSink):
+    """
+    AlertCollector keeps submitted alerts in memory until they are taken.
+
+    Used where alerts are raised in one process and written in another, such
+    as the workers of an offline replay.
+    """
+
+    def __init__(self) -> None:
+        self.stats = AlertWriterStats()
+        self._records: List[AlertRecord] = []
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._records)
+
+    def submit(self, record: AlertRecord) -> bool:
+        with self._lock:
+            self._records.append(record)
+            self.stats.enqueued += 1
+            self.stats.max_queue_depth = max(
+                self.stats.max_queue_depth, len(self._records)
+            )
+        return True
+
+    def take(self) -> List[AlertRecord]:
+        """Remove and return every alert collected so far"""
+        with self._lock:
+            records, self._records = self._records, []
+        return records
@@ -0,0 +1,47 @@
+from dataclasses import dataclass, field
+import time
+from typing import Optional
+
+
+@dataclass
+class HttpRequestRecord:
+    """A snapshot of an HTTP request taken when an alert is triggered"""
+
+    flow_id: str
+    url: str
+    method: str
+    headers: str
+    request_content: Optional[str]
+
+
+@dataclass
+class TcpMessageRecord:
+    """A snapshot of a TCP message taken when an alert is triggered"""
+
+    flow_id: str
+    client_host: Optional[str]
+    client_port: Optional[int]
+    server_host: Optional[str]
+    server_port: Optional[int]
+    message_content: Optional[bytes]
+
+
+@dataclass
+class AlertRecord:
+    """
+    An alert waiting to be persisted, together with the traffic that triggered it.
+
+    Records are plain data so they can be queued and written by another thread.
+    """
+
+    alert_name: str
+    message: str
+    application_from: str
+    destination_domain: str
+    type: str
+    severity: int
+    created_at: float = field(default_factory=time.time)
+    http_request: Optional[HttpRequestRecord] = None
+    tcp_message: Optional[TcpMessageRecord] = None
+    fingerprint: Optional[str] = None
+    """Repeats of the alert share this, None if they are never coalesced"""
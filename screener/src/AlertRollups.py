@@ -0,0 +1,161 @@
+from datetime import datetime, timezone
+import sqlite3
+from typing import Dict, List, Tuple
+
+from AlertRecord import AlertRecord
+from SqlScript import execute_script
+
+
+ROLLUPS: Dict[str, str] = {
+    "alert_rollups_hourly": "%Y-%m-%d %H:00",
+    "alert_rollups_daily": "%Y-%m-%d",
+}
+"""The rollup tables and the strftime format of their buckets"""
+
+DIMENSIONS = ("alert_name", "application_from", "destination_domain", "type", "severity")
+"""The alert columns every rollup row is keyed by, besides its bucket"""
+
+
+def _rollup_table(table: str) -> str:
+    return f"""
+CREATE TABLE IF NOT EXISTS {table} (
+    bucket TEXT NOT NULL,
+    alert_name TEXT NOT NULL,
+    application_from TEXT NOT NULL,
+    destination_domain TEXT NOT NULL,
+    type TEXT NOT NULL,
+    severity INTEGER NOT NULL,
+    alerts INTEGER NOT NULL DEFAULT 0,
+    occurrences INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, alert_name, application_from, destination_domain, type, severity)
+) WITHOUT ROWID;
+"""
+
+
+ROLLUP_SCHEMA = "".join(_rollup_table(table) for table in ROLLUPS)
+"""
+The rollup tables. Their primary key starts with the bucket, so a chart over
+a time range is a range scan of it
+"""
+
+
+def _table_names(cursor: sqlite3.Cursor) -> List[str]:
+    return [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+
+def ensure_alert_rollups(connection: sqlite3.Connection) -> None:
+    """
+    Add the rollup tables if they are missing, counting the existing alerts
+    into them.
+
+    Cheap and safe to call on every connect. Runs in the transaction of the
+    caller, which commits it.
+    """
+    missing = set(ROLLUPS) - set(_table_names(connection.cursor()))
+    if not missing:
+        return
+    execute_script(connection, ROLLUP_SCHEMA)
+    _count_alert_rollups(connection)
+
+
+def rebuild_alert_rollups(connection: sqlite3.Connection) -> int:
+    """
+    Recount the rollup tables from the alerts table in a single transaction.
+
+    The repeats coalesced into an alert are counted in the bucket of its
+    first occurrence, since the times of the others are not kept, and alerts
+    that retention has deleted are no longer counted at all. Returns the
+    number of alerts counted.
+    """
+    with connection:
+        return _count_alert_rollups(connection)
+
+
+def _count_alert_rollups(connection: sqlite3.Connection) -> int:
+    dimensions = ", ".join(DIMENSIONS)
+    cursor = connection.cursor()
+    for table, bucket_format in ROLLUPS.items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (bucket, {dimensions}, alerts, occurrences)
+            SELECT strftime(?, timestamp), {dimensions}, COUNT(*), SUM(occurrences)
+            FROM alerts
+            WHERE strftime(?, timestamp) IS NOT NULL
+            GROUP BY 1, {dimensions}
+            """,
+            (bucket_format, bucket_format),
+        )
+    row = cursor.execute(f"SELECT SUM(alerts) FROM {next(iter(ROLLUPS))}").fetchone()
+    return row[0] or 0
+
+
+class AlertRollupBatch:
+    """
+    AlertRollupBatch counts the alerts of a write batch for the rollup tables.
+
+    The writer adds every record it writes and saves the counts in the
+    batch's transaction, so the rollups always agree with what was
+    committed. Records are counted by the hour they were triggered in, and
+    each table gets a single upsert per distinct key rather than one per
+    record.
+
+    A record inserted as a new alert counts as an alert and an occurrence.
+    A repeat coalesced into an open aggregate counts only as an occurrence,
+    in the bucket it was triggered in.
+    """
+
+    def __init__(self) -> None:
+        # (hour, *dimensions) -> [alerts, occurrences]
+        self._counts: Dict[Tuple, List[int]] = {}
+
+    def __len__(self) -> int:
+        """The number of distinct hourly keys counted"""
+        return len(self._counts)
+
+    def add(self, record: AlertRecord, coalesced: bool = False) -> None:
+        """Count a written record"""
+        key = (
+            int(record.created_at // 3600),
+            record.alert_name,
+            record.application_from,
+            record.destination_domain,
+            record.type,
+            record.severity,
+        )
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0, 0]
+        if not coalesced:
+            counts[0] += 1
+        counts[1] += 1
+
+    def save(self, cursor: sqlite3.Cursor) -> None:
+        """Add the counts to the rollup tables"""
+        if not self._counts:
+            return
+
+        dimensions = ", ".join(DIMENSIONS)
+        for table, bucket_format in ROLLUPS.items():
+            rows: Dict[Tuple, List[int]] = {}
+            buckets: Dict[int, str] = {}
+            for (hour, *key), (alerts, occurrences) in self._counts.items():
+                bucket = buckets.get(hour)
+                if bucket is None:
+                    bucket = buckets[hour] = datetime.fromtimestamp(
+                        hour * 3600, timezone.utc
+                    ).strftime(bucket_format)
+                counts = rows.setdefault((bucket, *key), [0, 0])
+                counts[0] += alerts
+                counts[1] += occurrences
+
+            cursor.executemany(
+                f"""
+                INSERT INTO {table} (bucket, {dimensions}, alerts, occurrences)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, {dimensions}) DO UPDATE SET
+                    alerts = alerts + excluded.alerts,
+                    occurrences = occurrences + excluded.occurrences
+                """,
+                [(*key, alerts, occurrences) for key, (alerts, occurrences) in rows.items()],
+            )
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import hashlib
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+from SqlScript import execute_script
+
+
+AGGREGATE_SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_alerts_first_seen ON alerts(first_seen);
+"""
+"""The index open aggregates are found by when they are reloaded"""
+
+
+def alert_fingerprint(
+    alert_name: str, application_from: str, destination_domain: str, match: str
+) -> str:
+    """
+    The suppression key of an alert.
+
+    Alerts of the same screener, from the same application, to the same
+    destination and with the same normalized match share a fingerprint.
+    """
+    key = "\0".join((alert_name, application_from, destination_domain, match))
+    return hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=16).hexdigest()
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """The inverse of AlertWriter.format_timestamp"""
+    return (
+        datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+    )
+
+
+def _columns(cursor: sqlite3.Cursor, table: str) -> List[str]:
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+def ensure_alert_aggregates(connection: sqlite3.Connection) -> None:
+    """
+    Add the aggregate columns to the alerts table if they are missing.
+
+    Cheap and safe to call on every connect. Existing alerts count as a
+    single occurrence seen at their timestamp. Runs in the transaction of
+    the caller, which commits it.
+    """
+    cursor = connection.cursor()
+    columns = _columns(cursor, "alerts")
+    if "fingerprint" not in columns:
+        cursor.execute("ALTER TABLE alerts ADD COLUMN fingerprint TEXT")
+    if "occurrences" not in columns:
+        cursor.execute(
+            "ALTER TABLE alerts ADD COLUMN occurrences INTEGER NOT NULL DEFAULT 1"
+        )
+    if "first_seen" not in columns:
+        cursor.execute("ALTER TABLE alerts ADD COLUMN first_seen DATETIME")
+    if "last_seen" not in columns:
+        cursor.execute("ALTER TABLE alerts ADD COLUMN last_seen DATETIME")
+    execute_script(connection, AGGREGATE_SCHEMA)
+
+
+@dataclass
+class AlertAggregate:
+    """An alert row that repeats of the same alert are counted on"""
+
+    alert_id: int
+
+    first_seen: float
+    """When the first occurrence was triggered"""
+
+    last_seen: float
+    """When the latest occurrence was triggered"""
+
+    occurrences: int = 1
+
+    samples: int = 0
+    """The number of occurrences whose traffic was stored"""
+
+
+class AlertSuppressor:
+    """
+    AlertSuppressor tracks the open aggregates repeated alerts are merged into.
+
+    An aggregate is open for window seconds from its first occurrence. Every
+    alert with the same fingerprint in that time is counted on it, and the
+    traffic of only the first sample_size of them is stored. The first alert
+    after the window opens a new aggregate.
+
+    The writer stages the aggregates a batch changes and only commits them
+    here once the batch's transaction has committed, so a failed batch
+    leaves them as they were. At most max_open aggregates are kept in
+    memory, the least recently repeated ones being closed first.
+    """
+
+    window: float
+    """The number of seconds an aggregate stays open"""
+
+    sample_size: int
+    """The number of occurrences per aggregate whose traffic is stored"""
+
+    max_open: int
+    """The maximum number of aggregates kept open at once"""
+
+    def __init__(
+        self, window: float = 600.0, sample_size: int = 5, max_open: int = 10000
+    ) -> None:
+        """
+        Args:
+            window: The number of seconds an aggregate stays open
+            sample_size: The number of occurrences per aggregate whose traffic
+                is stored
+            max_open: The maximum number of aggregates kept open at once
+        """
+        self.window = window
+        self.sample_size = sample_size
+        self.max_open = max_open
+        self._open: "OrderedDict[str, AlertAggregate]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """The number of open aggregates"""
+        return len(self._open)
+
+    def find(self, fingerprint: str, created_at: float) -> Optional[AlertAggregate]:
+        """The aggregate an alert triggered at created_at is counted on, if any"""
+        aggregate = self._open.get(fingerprint)
+        if aggregate is None or not self.is_open(aggregate, created_at):
+            return None
+        return aggregate
+
+    def is_open(self, aggregate: AlertAggregate, created_at: float) -> bool:
+        return aggregate.first_seen <= created_at < aggregate.first_seen + self.window
+
+    def commit(self, staged: Dict[str, AlertAggregate]) -> None:
+        """Keep the aggregates of a committed batch"""
+        for fingerprint, aggregate in staged.items():
+            self._open.pop(fingerprint, None)
+            self._open[fingerprint] = aggregate
+        while len(self._open) > self.max_open:
+            self._open.popitem(last=False)
+
+    def load(self, connection: sqlite3.Connection, now: Optional[float] = None) -> int:
+        """
+        Reopen the aggregates of the database that are still open at now.
+
+        Returns the number of aggregates reopened.
+        """
+        if now is None:
+            now = time.time()
+        since = datetime.fromtimestamp(now - self.window, timezone.utc).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        rows = connection.execute(
+            """
+            SELECT
+                a.id, a.fingerprint, a.occurrences, a.first_seen, a.last_seen,
+                (SELECT COUNT(*) FROM alert_http_requests h WHERE h.alert_id = a.id)
+                + (SELECT COUNT(*) FROM alert_tcp_messages t WHERE t.alert_id = a.id)
+            FROM alerts a
+            WHERE a.fingerprint IS NOT NULL AND a.first_seen > ?
+            ORDER BY a.first_seen, a.id
+            """,
+            (since,),
+        ).fetchall()
+
+        staged: Dict[str, AlertAggregate] = {}
+        for alert_id, fingerprint, occurrences, first_seen, last_seen, samples in rows:
+            staged[fingerprint] = AlertAggregate(
+                alert_id=alert_id,
+                first_seen=parse_timestamp(first_seen),
+                last_seen=parse_timestamp(last_seen or first_seen),
+                occurrences=occurrences,
+                samples=samples,
+            )
+        self.commit(staged)
+        return len(staged)
@@ -0,0 +1,553 @@
+from abc import ABC, abstractmethod
+import atexit
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import uuid
+
+from AlertRecord import AlertRecord, HttpRequestRecord, TcpMessageRecord
+from AlertRollups import AlertRollupBatch
+from AlertSuppression import AlertAggregate, AlertSuppressor
+from Database import close_database, connect_database
+from Metrics import DB_BATCH_SIZE, DB_WRITE_SECONDS
+from PayloadCodecs import DEFAULT_CODEC, get_codec
+from PayloadStore import (
+    PayloadCompressor,
+    encode_text,
+    load_payload_compressor,
+    store_payload,
+    train_payload_dictionary,
+)
+
+
+_STOP = object()
+"""Sentinel put on the queue to tell the writer thread to finish"""
+
+
+def format_timestamp(created_at: float) -> str:
+    """Format a unix time the same way SQLite's CURRENT_TIMESTAMP does"""
+    return datetime.fromtimestamp(created_at, timezone.utc).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+@dataclass
+class AlertWriterStats:
+    """Counters describing the state of the write-behind queue"""
+
+    enqueued: int = 0
+    """Records accepted onto the queue"""
+
+    written: int = 0
+    """Records committed to the database"""
+
+    coalesced: int = 0
+    """Written records that were counted on an open aggregate instead of inserted"""
+
+    failed: int = 0
+    """Records lost because their batch failed to commit"""
+
+    dropped: int = 0
+    """Records rejected because the queue stayed full"""
+
+    backpressure_waits: int = 0
+    """Times a producer found the queue full and had to wait"""
+
+    batches: int = 0
+    """Transactions committed"""
+
+    max_queue_depth: int = 0
+    """Highest queue depth observed"""
+
+
+class AlertSink(ABC):
+    """
+    Where screeners send the alerts they trigger.
+
+    AlertWriter writes them to the database. Other sinks collect them for
+    later or pass them on elsewhere.
+    """
+
+    stats: AlertWriterStats
+    """Queue and write counters"""
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of records waiting to be handled"""
+        return 0
+
+    @abstractmethod
+    def submit(self, record: AlertRecord) -> bool:
+        """
+        Hand over a record.
+
+        Returns False if the record was dropped.
+        """
+        pass
+
+    def flush(self) -> None:
+        """Block until every record submitted so far has been handled"""
+
+    def close(self) -> None:
+        """Handle everything still pending and release any resources"""
+
+
+class AlertWriter(AlertSink):
+    """
+    AlertWriter persists alerts on a dedicated thread.
+
+    Screeners submit AlertRecords which are queued in memory and drained by a
+    writer thread. The writer groups alerts, stored traffic and junction rows
+    into a single transaction per batch. A batch is written once it reaches
+    batch_size records or flush_interval seconds after its first record,
+    whichever comes first.
+
+    The queue is bounded. When it is full, submit blocks for up to
+    put_timeout seconds (forever if None) before dropping the record.
+
+    Request bodies and TCP message contents are stored once per distinct
+    payload in payload_blobs, and the traffic rows point to them by hash.
+    New payloads are compressed with payload_codec, None to store them as
+    they are. Once train_after payloads have been compressed without a
+    dictionary, one is trained from them, and the newest dictionary of the
+    codec is used from then on.
+
+    Repeats of an alert, records with the same fingerprint, are coalesced
+    for suppression_window seconds: they update the occurrences and
+    last_seen of the first alert's row rather than inserting rows of their
+    own, and only the traffic of the first sample_size of them is stored.
+    The aggregates still open are reloaded from the database on start.
+
+    Every batch also adds its alerts to the hourly and daily rollup tables
+    in the same transaction, so the dashboard's charts never have to scan
+    the alerts table.
+    """
+
+    database_path: str
+    """The path of the database the writer owns"""
+
+    batch_size: int
+    """The maximum number of records written per transaction"""
+
+    flush_interval: float
+    """The maximum number of seconds a record waits for its batch to fill"""
+
+    put_timeout: Optional[float]
+    """How long submit waits for room on a full queue"""
+
+    suppressor: Optional[AlertSuppressor]
+    """The open aggregates repeats are coalesced into, None to insert every alert"""
+
+    compressor: Optional[PayloadCompressor]
+    """Compresses new payloads, None to store them as they are"""
+
+    train_after: Optional[int]
+    """The number of payloads compressed before a dictionary is trained, None to never train"""
+
+    stats: AlertWriterStats
+    """Queue and write counters"""
+
+    def __init__(
+        self,
+        database_path: str,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        max_queue_size: int = 10000,
+        put_timeout: Optional[float] = 5.0,
+        suppression_window: Optional[float] = 600.0,
+        sample_size: int = 5,
+        payload_codec: Optional[str] = DEFAULT_CODEC,
+        train_after: Optional[int] = 2000,
+    ) -> None:
+        self.database_path = database_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.suppressor = (
+            AlertSuppressor(suppression_window, sample_size)
+            if suppression_window
+            else None
+        )
+        self.payload_codec = payload_codec
+        self.train_after = train_after
+        # replaced by one with the newest dictionary once the database is open
+        self.compressor = (
+            PayloadCompressor(get_codec(payload_codec)) if payload_codec else None
+        )
+        self.stats = AlertWriterStats()
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._stats_lock = threading.Lock()
+        self._closed = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="alert-writer", daemon=True
+        )
+        self._thread.start()
+
+        # Make sure queued alerts are written even if close is never called
+        atexit.register(self.close)
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of records waiting to be written"""
+        return self._queue.qsize()
+
+    def submit(self, record: AlertRecord) -> bool:
+        """
+        Queue a record to be written.
+
+        Returns False if the record was dropped.
+        """
+        if self._closed:
+            print(f"Alert writer is closed, dropping alert: {record.message}")
+            with self._stats_lock:
+                self.stats.dropped += 1
+            return False
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.stats.backpressure_waits += 1
+            try:
+                self._queue.put(record, timeout=self.put_timeout)
+            except queue.Full:
+                print(f"Alert queue is full, dropping alert: {record.message}")
+                with self._stats_lock:
+                    self.stats.dropped += 1
+                return False
+
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self.stats.enqueued += 1
+            if depth > self.stats.max_queue_depth:
+                self.stats.max_queue_depth = depth
+        return True
+
+    def flush(self) -> None:
+        """Block until every record submitted so far has been processed"""
+        self._queue.join()
+
+    def close(self) -> None:
+        """Write everything still queued and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self) -> None:
+        """Drain the queue until the stop sentinel is seen"""
+        # Older databases are migrated to the current schema on first use
+        connection = connect_database(self.database_path)
+        try:
+            if self.suppressor is not None:
+                self.suppressor.load(connection)
+            if self.payload_codec is not None:
+                self.compressor = load_payload_compressor(connection, self.payload_codec)
+
+            stopping = False
+            while not stopping:
+                batch, stopping = self._next_batch()
+                if batch:
+                    self._write_batch(connection, batch)
+                    self._train_dictionary(connection)
+                for _ in batch:
+                    self._queue.task_done()
+            # Account for the sentinel itself
+            self._queue.task_done()
+        finally:
+            close_database(connection)
+
+    def _next_batch(self) -> Tuple[List[AlertRecord], bool]:
+        """
+        Wait for the next batch of records.
+
+        Returns the batch and whether the stop sentinel was reached.
+        """
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch: List[AlertRecord] = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is _STOP:
+                return batch, True
+            batch.append(record)
+
+        return batch, False
+
+    def _train_dictionary(self, connection: sqlite3.Connection) -> None:
+        """Train a dictionary for the codec once enough payloads were compressed without one"""
+        compressor = self.compressor
+        if (
+            compressor is None
+            or compressor.dictionary is not None
+            or self.train_after is None
+            or compressor.compressed < self.train_after
+        ):
+            return
+        try:
+            train_payload_dictionary(connection, compressor.codec.name)
+            self.compressor = load_payload_compressor(connection, compressor.codec.name)
+        except Exception as e:
+            print(f"Failed to train a {compressor.codec.name} payload dictionary: {e}")
+            # don't try again with every batch
+            self.train_after = None
+
+    def _write_batch(
+        self, connection: sqlite3.Connection, batch: List[AlertRecord]
+    ) -> None:
+        """Write a batch of records in a single transaction"""
+        start = time.perf_counter()
+        # the aggregates the batch opens or counts on, kept once it commits
+        staged: Dict[str, AlertAggregate] = {}
+        rollups = AlertRollupBatch()
+        coalesced = 0
+        try:
+            with connection:
+                cursor = connection.cursor()
+                for record in batch:
+                    if self.coalesce_record(cursor, record, staged):
+                        rollups.add(record, coalesced=True)
+                        coalesced += 1
+                    else:
+                        self.write_record(cursor, record, staged)
+                        rollups.add(record)
+                self.save_aggregates(cursor, staged)
+                rollups.save(cursor)
+        except Exception as e:
+            print(f"Failed to write {len(batch)} alerts to the database: {e}")
+            with self._stats_lock:
+                self.stats.failed += len(batch)
+            return
+
+        if self.suppressor is not None:
+            self.suppressor.commit(staged)
+        DB_WRITE_SECONDS.labels().observe(time.perf_counter() - start)
+        DB_BATCH_SIZE.labels().observe(len(batch))
+        with self._stats_lock:
+            self.stats.written += len(batch)
+            self.stats.coalesced += coalesced
+            self.stats.batches += 1
+
+    def coalesce_record(
+        self,
+        cursor: sqlite3.Cursor,
+        record: AlertRecord,
+        staged: Dict[str, AlertAggregate],
+    ) -> bool:
+        """
+        Count a repeated alert on its open aggregate, storing its traffic if
+        the aggregate's sample is not full yet.
+
+        Returns False if the record has no open aggregate and needs a row.
+        """
+        if self.suppressor is None or record.fingerprint is None:
+            return False
+
+        aggregate = staged.get(record.fingerprint) or self.suppressor.find(
+            record.fingerprint, record.created_at
+        )
+        if aggregate is None or not self.suppressor.is_open(aggregate, record.created_at):
+            return False
+
+        # a copy, so the open aggregate is untouched if the batch fails
+        aggregate = replace(
+            aggregate,
+            occurrences=aggregate.occurrences + 1,
+            last_seen=max(aggregate.last_seen, record.created_at),
+        )
+        if aggregate.samples < self.suppressor.sample_size and self.save_traffic(
+            cursor, record, aggregate.alert_id, format_timestamp(record.created_at)
+        ):
+            aggregate.samples += 1
+        staged[record.fingerprint] = aggregate
+        return True
+
+    def save_aggregates(
+        self, cursor: sqlite3.Cursor, staged: Dict[str, AlertAggregate]
+    ) -> None:
+        """Update the rows of the aggregates repeats were counted on, once per batch"""
+        cursor.executemany(
+            "UPDATE alerts SET occurrences = ?, last_seen = ? WHERE id = ?",
+            [
+                (aggregate.occurrences, format_timestamp(aggregate.last_seen), aggregate.alert_id)
+                for aggregate in staged.values()
+                if aggregate.occurrences > 1
+            ],
+        )
+
+    def write_record(
+        self,
+        cursor: sqlite3.Cursor,
+        record: AlertRecord,
+        staged: Optional[Dict[str, AlertAggregate]] = None,
+    ) -> int:
+        """
+        Insert an alert and the traffic attached to it. Returns the alert ID.
+
+        If staged is given, the alert opens an aggregate for its fingerprint.
+        """
+        timestamp = format_timestamp(record.created_at)
+        alert_id = self.save_alert(cursor, record, timestamp)
+        stored = self.save_traffic(cursor, record, alert_id, timestamp)
+
+        if staged is not None and record.fingerprint is not None:
+            # the aggregate this one replaces still needs its row updated
+            previous = staged.get(record.fingerprint)
+            if previous is not None:
+                self.save_aggregates(cursor, {record.fingerprint: previous})
+            staged[record.fingerprint] = AlertAggregate(
+                alert_id=alert_id,
+                first_seen=record.created_at,
+                last_seen=record.created_at,
+                samples=1 if stored else 0,
+            )
+
+        return alert_id
+
+    def save_traffic(
+        self, cursor: sqlite3.Cursor, record: AlertRecord, alert_id: int, timestamp: str
+    ) -> bool:
+        """Save the traffic of a record and link it to an alert. Returns whether there was any"""
+        if record.tcp_message:
+            tcp_message_id = self.save_tcp_message(
+                cursor, record.tcp_message, timestamp
+            )
+            cursor.execute(
+                "INSERT INTO alert_tcp_messages (alert_id, tcp_message_id) VALUES (?, ?)",
+                (alert_id, tcp_message_id),
+            )
+
+        if record.http_request:
+            http_request_id = self.save_http_request(
+                cursor, record.http_request, timestamp
+            )
+            cursor.execute(
+                "INSERT INTO alert_http_requests (alert_id, http_request_id) VALUES (?, ?)",
+                (alert_id, http_request_id),
+            )
+
+        return bool(record.tcp_message or record.http_request)
+
+    def save_alert(
+        self, cursor: sqlite3.Cursor, record: AlertRecord, timestamp: str
+    ) -> int:
+        """Save the alert without any relationships and return the ID"""
+        cursor.execute(
+            """
+            INSERT INTO alerts (
+                alert_name, message, application_from, destination_domain,
+                type, severity, timestamp, fingerprint, first_seen, last_seen
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                record.alert_name,
+                record.message,
+                record.application_from,
+                record.destination_domain,
+                record.type,
+                record.severity,
+                timestamp,
+                record.fingerprint,
+                timestamp,
+                timestamp,
+            ),
+        )
+
+        new_id = cursor.lastrowid
+        if new_id is None:
+            raise Exception("Failed to save alert to database")
+        return new_id
+
+    def save_tcp_message(
+        self, cursor: sqlite3.Cursor, tcp_message: TcpMessageRecord, timestamp: str
+    ) -> int:
+        """Save the TCP message and return the ID"""
+        cursor.execute(
+            "SELECT id FROM tcp_messages WHERE flow_id = ?", (tcp_message.flow_id,)
+        )
+        existing_id = cursor.fetchone()
+
+        # A connection can trigger alerts on many of its messages
+        new_flow_id = tcp_message.flow_id
+        if existing_id:
+            new_flow_id = f"{tcp_message.flow_id}-{uuid.uuid4().hex[:8]}"
+
+        content_hash = store_payload(cursor, tcp_message.message_content, self.compressor)
+        cursor.execute(
+            """
+            INSERT INTO tcp_messages (
+                flow_id, client_host, client_port,
+                server_host, server_port, payload_hash, timestamp
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                new_flow_id,
+                tcp_message.client_host,
+                tcp_message.client_port,
+                tcp_message.server_host,
+                tcp_message.server_port,
+                content_hash,
+                timestamp,
+            ),
+        )
+
+        new_id = cursor.lastrowid
+        if new_id is None:
+            raise Exception("Failed to save TCP message to database")
+        return new_id
+
+    def save_http_request(
+        self, cursor: sqlite3.Cursor, http_request: HttpRequestRecord, timestamp: str
+    ) -> int:
+        """Save the HTTP request and return the ID"""
+        cursor.execute(
+            "SELECT id FROM http_requests WHERE flow_id = ?", (http_request.flow_id,)
+        )
+        existing_id = cursor.fetchone()
+
+        new_flow_id = http_request.flow_id
+        if existing_id:
+            new_flow_id = f"{http_request.flow_id}-{uuid.uuid4().hex[:8]}"
+
+        content_hash = None
+        if http_request.request_content is not None:
+            content_hash = store_payload(
+                cursor, encode_text(http_request.request_content), self.compressor
+            )
+
+        cursor.execute(
+            """
+            INSERT INTO http_requests (
+                flow_id, url, method, headers, payload_hash, timestamp
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                new_flow_id,
+                http_request.url,
+                http_request.method,
+                http_request.headers,
+                content_hash,
+                timestamp,
+            ),
+        )
+
+        new_id = cursor.lastrowid
+        if new_id is None:
+            raise Exception("Failed to save HTTP request to database")
+        return new_id
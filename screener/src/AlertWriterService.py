@@ -0,0 +1,425 @@
+import atexit
+from dataclasses import dataclass
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from AlertRecord import AlertRecord
+from AlertWriter import AlertSink, AlertWriter, AlertWriterStats
+from Metrics import REGISTRY, MetricsServer
+from Retention import RetentionPolicy, RetentionService
+
+
+Address = Union[str, Tuple[str, int]]
+"""A "host:port" TCP address, or the path of a Unix socket"""
+
+DEFAULT_ADDRESS: Address = ("127.0.0.1", 9470)
+"""Where the writer service listens by default, reachable from this machine only"""
+
+_STOP = object()
+"""Sentinel put on the queue to tell the sender thread to finish"""
+
+
+def parse_address(text: str) -> Address:
+    """A "host:port" string as a TCP address, anything else as a Unix socket path"""
+    host, separator, port = text.rpartition(":")
+    if separator and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return text
+
+
+def format_address(address: Address) -> str:
+    """An address as parse_address reads it"""
+    if isinstance(address, str):
+        return address
+    return f"{address[0]}:{address[1]}"
+
+
+class RemoteAlertSink(AlertSink):
+    """
+    RemoteAlertSink sends alerts to an AlertWriterService in another process.
+
+    Used by each proxy worker of a multi-worker deployment, so only the
+    service ever writes to the database. Submitted records are queued in
+    memory and sent by a sender thread in batches of up to batch_size, or
+    flush_interval seconds after the first record of a batch.
+
+    The queue is bounded like the AlertWriter's: when it is full, submit
+    blocks for up to put_timeout seconds before dropping the record. While
+    the service can't be reached, records stay queued and the sender tries
+    to reconnect every retry_interval seconds, so a restarted service loses
+    nothing that fit in the queue.
+
+    In the stats, written counts the records the service has received, and
+    batches the number of sends.
+    """
+
+    address: Address
+    """Where the service listens"""
+
+    batch_size: int
+    """The maximum number of records sent at once"""
+
+    flush_interval: float
+    """The maximum number of seconds a record waits for its batch to fill"""
+
+    put_timeout: Optional[float]
+    """How long submit waits for room on a full queue"""
+
+    retry_interval: float
+    """The number of seconds between attempts to reach the service"""
+
+    stats: AlertWriterStats
+    """Queue and send counters"""
+
+    def __init__(
+        self,
+        address: Address = DEFAULT_ADDRESS,
+        authkey: Optional[bytes] = None,
+        batch_size: int = 100,
+        flush_interval: float = 0.2,
+        max_queue_size: int = 10000,
+        put_timeout: Optional[float] = 5.0,
+        retry_interval: float = 1.0,
+    ) -> None:
+        """
+        Args:
+            address: Where the service listens
+            authkey: The key shared with the service, which rejects senders
+                that don't know it
+            batch_size: The maximum number of records sent at once
+            flush_interval: The maximum number of seconds a record waits for
+                its batch to fill
+            max_queue_size: The maximum number of records waiting to be sent
+            put_timeout: How long submit waits for room on a full queue
+            retry_interval: The number of seconds between attempts to reach
+                the service
+        """
+        self.address = address
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retry_interval = retry_interval
+        self.stats = AlertWriterStats()
+
+        self._authkey = authkey
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._stats_lock = threading.Lock()
+        self._connection: Optional[Connection] = None
+        self._closed = False
+        self._give_up_at: Optional[float] = None
+
+        self._thread = threading.Thread(
+            target=self._run, name="alert-sender", daemon=True
+        )
+        self._thread.start()
+
+        # Make sure queued alerts are sent even if close is never called
+        atexit.register(self.close)
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of records waiting to be sent"""
+        return self._queue.qsize()
+
+    @property
+    def connected(self) -> bool:
+        """Whether the service is reachable"""
+        return self._connection is not None
+
+    def submit(self, record: AlertRecord) -> bool:
+        """
+        Queue a record to be sent.
+
+        Returns False if the record was dropped.
+        """
+        if self._closed:
+            print(f"Alert sink is closed, dropping alert: {record.message}")
+            with self._stats_lock:
+                self.stats.dropped += 1
+            return False
+
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.stats.backpressure_waits += 1
+            try:
+                self._queue.put(record, timeout=self.put_timeout)
+            except queue.Full:
+                print(f"Alert queue is full, dropping alert: {record.message}")
+                with self._stats_lock:
+                    self.stats.dropped += 1
+                return False
+
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self.stats.enqueued += 1
+            if depth > self.stats.max_queue_depth:
+                self.stats.max_queue_depth = depth
+        return True
+
+    def flush(self) -> None:
+        """Block until every record submitted so far has been sent"""
+        self._queue.join()
+
+    def close(self, timeout: float = 30.0) -> None:
+        """
+        Send everything still queued and stop the sender thread.
+
+        Records still unsent after timeout seconds, because the service
+        can't be reached, are dropped.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._give_up_at = time.monotonic() + timeout
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self) -> None:
+        """Send batches until the stop sentinel is seen"""
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._send(batch)
+            for _ in batch:
+                self._queue.task_done()
+        self._queue.task_done()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _next_batch(self) -> Tuple[List[AlertRecord], bool]:
+        """
+        Wait for the next batch of records.
+
+        Returns the batch and whether the stop sentinel was reached.
+        """
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch: List[AlertRecord] = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is _STOP:
+                return batch, True
+            batch.append(record)
+
+        return batch, False
+
+    def _send(self, batch: List[AlertRecord]) -> None:
+        """Send a batch, reconnecting until it gets through or the sink gives up"""
+        while True:
+            try:
+                if self._connection is None:
+                    self._connection = Client(self.address, authkey=self._authkey)
+                self._connection.send(batch)
+                with self._stats_lock:
+                    self.stats.written += len(batch)
+                    self.stats.batches += 1
+                return
+            except (OSError, EOFError) as e:
+                if self._connection is not None:
+                    self._connection.close()
+                    self._connection = None
+                    print(f"Lost the alert writer service at {self.address}: {e}")
+
+            if self._give_up_at is not None and time.monotonic() >= self._give_up_at:
+                print(f"Alert writer service unreachable, dropping {len(batch)} alerts")
+                with self._stats_lock:
+                    self.stats.failed += len(batch)
+                return
+            time.sleep(self.retry_interval)
+
+
+@dataclass
+class AlertWriterServiceStats:
+    """Counters describing the senders of a writer service"""
+
+    connections: int = 0
+    """Senders connected"""
+
+    accepted: int = 0
+    """Senders that have connected since the service started"""
+
+    rejected: int = 0
+    """Connections refused, such as ones that didn't know the key"""
+
+    received: int = 0
+    """Records received from senders"""
+
+
+class AlertWriterService:
+    """
+    AlertWriterService owns the database for a multi-worker deployment.
+
+    Several proxy workers, each with its own screeners on its own core, send
+    the alerts they raise to the service with a RemoteAlertSink. The service
+    hands every record to a single AlertWriter, which batches them into
+    transactions as it does for a single proxy, so the database has one
+    writer and the workers never contend for its lock. Readers, such as the
+    dashboard, read the database as before.
+
+    Records are sent with multiprocessing.connection, pickled and framed,
+    and each sender must prove it knows authkey before anything it sends is
+    unpickled. Each sender gets a thread, and when the writer's queue is
+    full that thread blocks, which in turn fills the sender's queue, so
+    workers feel the database's backpressure.
+
+    With a retention policy, expired rows are archived and deleted in the
+    background, as AllScreenersCombined does for a single proxy.
+    """
+
+    address: Address
+    """Where the service listens"""
+
+    writer: AlertWriter
+    """Writes the records of every sender"""
+
+    retention: Optional[RetentionService]
+    """Archives and deletes expired rows, None when everything is kept"""
+
+    stats: AlertWriterServiceStats
+    """Sender counters"""
+
+    def __init__(
+        self,
+        database_path: str,
+        address: Address = DEFAULT_ADDRESS,
+        authkey: Optional[bytes] = None,
+        writer_options: Optional[Dict[str, Any]] = None,
+        retention: Optional[RetentionPolicy] = None,
+        retention_interval: float = 3600.0,
+        metrics_port: Optional[int] = None,
+        metrics_host: str = "127.0.0.1",
+    ) -> None:
+        """
+        Args:
+            database_path: The database the service owns
+            address: Where to listen for senders
+            authkey: The key senders must know, required unless the address
+                is a Unix socket, whose permissions decide who can send
+            writer_options: Extra arguments for the AlertWriter
+            retention: How long rows are kept, None to keep everything
+            retention_interval: The number of seconds between retention passes
+            metrics_port: Where to serve the writer metrics, None to not serve them
+            metrics_host: The interface the metrics are served on
+        """
+        if authkey is None and not isinstance(address, str):
+            # anyone on the machine could otherwise send records to unpickle
+            raise ValueError("A writer service listening on TCP needs an authkey")
+
+        self.writer = AlertWriter(database_path, **(writer_options or {}))
+        self.stats = AlertWriterServiceStats()
+        self.retention = (
+            RetentionService(database_path, retention, interval=retention_interval)
+            if retention is not None
+            else None
+        )
+
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._connections: Set[Connection] = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._accept, name="alert-writer-service", daemon=True
+        )
+        self._thread.start()
+
+        REGISTRY.gauges_from_stats("traffic_slice_alert_writer", self.writer.stats)
+        REGISTRY.gauges_from_stats("traffic_slice_alert_writer_service", self.stats)
+        REGISTRY.gauge(
+            "traffic_slice_alert_queue_depth",
+            "Alerts waiting to be written",
+            lambda: self.writer.queue_depth,
+        )
+        if self.retention is not None:
+            REGISTRY.gauges_from_stats("traffic_slice_retention", self.retention.stats)
+        self.metrics_server = (
+            MetricsServer(REGISTRY, metrics_host, metrics_port)
+            if metrics_port is not None
+            else None
+        )
+
+    def _accept(self) -> None:
+        """Accept senders until the listener is closed"""
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # closed by close, or a sender that failed to authenticate
+                if not self._closed:
+                    self.stats.rejected += 1
+                continue
+            with self._lock:
+                self._connections.add(connection)
+                self.stats.accepted += 1
+                self.stats.connections = len(self._connections)
+            threading.Thread(
+                target=self._receive,
+                args=(connection,),
+                name="alert-writer-service-sender",
+                daemon=True,
+            ).start()
+
+    def _receive(self, connection: Connection) -> None:
+        """Hand every batch a sender sends to the writer, until it disconnects"""
+        try:
+            while True:
+                batch = connection.recv()
+                for record in batch:
+                    self.writer.submit(record)
+                with self._lock:
+                    self.stats.received += len(batch)
+        except (OSError, EOFError):
+            pass
+        finally:
+            connection.close()
+            with self._lock:
+                self._connections.discard(connection)
+                self.stats.connections = len(self._connections)
+
+    def serve(self, stop: threading.Event) -> None:
+        """Serve until stop is set, then write everything received and close"""
+        try:
+            stop.wait()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Stop accepting senders, write everything received and close the database.
+
+        Senders should be stopped first, as records they send while the
+        writer closes are dropped.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._listener.close()
+        if self.retention is not None:
+            self.retention.stop()
+        self.writer.close()
+        stats = self.writer.stats
+        print(
+            f"Alert writer service stopped: {self.stats.received} received from "
+            f"{self.stats.accepted} senders, {stats.written} written "
+            f"({stats.coalesced} coalesced), {stats.failed} failed, "
+            f"{stats.dropped} dropped"
+        )
+        if self.metrics_server is not None:
+            self.metrics_server.close()
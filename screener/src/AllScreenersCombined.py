@@ -1,15 +1,73 @@
-import sqlite3
-from typing import List
-from Screeners import EnvVarScreener
-from Screeners import FileNameScreener
-from Screeners import MacAddrScreener
-from Screeners import ClipboardScreener
-from Screeners import LocationScreener
-from Screeners import TimestampScreener
+from functools import partial
+from typing import TYPE_CHECKING, Any, Awaitable, Dict, List, Optional, Set, Union
+from AlertWriter import AlertSink, AlertWriter
+from DestinationPolicy import DestinationPolicy
+from DeviceLocator import DEFAULT_CACHE_PATH, DeviceLocator, LocationProvider
+from MatchEngine import MatchEngine
+from PayloadCodecs import DEFAULT_CODEC
+from Metrics import REGISTRY, FlowProfiler, MetricsServer, MetricsSnapshot
+from Retention import RetentionPolicy, RetentionService
+from ScreenerRegistry import ScreenerConfig, ScreenerRegistry, load_screener_config
+from ScreeningContext import ScreeningContext, TcpScreeningContext
+from ScreeningExecutor import (
+    ScreeningExecutor,
+    Verdicts,
+    build_match_engine,
+    screen_all,
+)
+from SecretIndex import SecretSource
+from TcpStreams import TcpStreams
+from VerdictCache import VerdictCache
 from Screeners.IndividualScreener import IndividualScreener
 
 import mitmproxy.http as http
 import mitmproxy.tcp as tcp
+import mitmproxy.tls as tls
+
+if TYPE_CHECKING:
+    # only the LocationScreener needs the geofence, and numpy with it
+    from Geofence import ProtectedLocation
+
+
+def build_screeners(
+    alert_writer: Optional[AlertSink],
+    secret_sources: Optional[List[SecretSource]] = None,
+    device_locator: Optional[DeviceLocator] = None,
+    location_providers: Optional[List[LocationProvider]] = None,
+    location_cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+    protected_locations: Optional[List["ProtectedLocation"]] = None,
+    config: Optional[List[ScreenerConfig]] = None,
+    registry: Optional[ScreenerRegistry] = None,
+) -> List[IndividualScreener]:
+    """
+    Build the screeners a configuration enables, every built-in one by default.
+
+    Screeners built without a writer can only screen, which is what worker
+    processes of a ScreeningExecutor use them for. Without a device_locator,
+    one is built from location_providers and location_cache_path, and it
+    only starts looking the location up once the LocationScreener first
+    needs it. protected_locations are the sites, besides the device, that
+    coordinates in traffic are alerted on when near.
+
+    The screeners are built by the registry, which records what each one
+    cost to import and build.
+    """
+    if device_locator is None:
+        device_locator = DeviceLocator(location_providers, location_cache_path, start=False)
+
+    # the objects the built-in screeners share with the rest of the proxy
+    shared: Dict[str, Dict[str, Any]] = {
+        "env_var": {"sources": secret_sources},
+        "location": {
+            "device_locator": device_locator,
+            "protected_locations": protected_locations,
+        },
+    }
+    extra_options = {
+        name: {key: value for key, value in options.items() if value is not None}
+        for name, options in shared.items()
+    }
+    return (registry or ScreenerRegistry()).build(alert_writer, config, extra_options)
 
 
 class AllScreenersCombined:
@@ -17,32 +75,369 @@ class AllScreenersCombined:
     AllScreenersCombined combines all the screeners into a single object.
 
     This is a mitmproxy addon.
+
+    By default every screener runs inline in the hooks. With executor set to
+    "thread" or "process", flows are screened on a ScreeningExecutor instead
+    and the hooks return an awaitable for mitmproxy to wait on.
+
+    Per-screener and database metrics are collected in Metrics.REGISTRY and
+    can be served over HTTP on metrics_port, written to metrics_path every
+    metrics_interval seconds, or both. A profile_sample_rate above zero
+    profiles that fraction of flows and keeps the slowest profiles.
+
+    Alerts go to a write-behind AlertWriter on database_path, unless another
+    alert_sink is given, such as the AlertCollector of a replay worker. The
+    writer coalesces repeats of an alert within suppression_window seconds
+    into a single row, storing the traffic of sample_size of them, and
+    compresses the payloads it stores with payload_codec.
+
+    The device location is looked up in the background with the
+    location_providers, IP geolocation by default, from the first time the
+    LocationScreener needs it, and the last fix is kept in
+    location_cache_path so it is known as soon as the proxy starts.
+    Coordinates near it, or near any of the protected_locations, are alerted on.
+
+    With a retention policy, the rows it expires are archived and deleted
+    from the database every retention_interval seconds in the background.
+
+    The screeners built are the ones screener_config enables, a list of
+    ScreenerConfig or the path of a JSON file of them, every built-in one by
+    default. Each screener module is only imported when it is enabled, and
+    what each one cost to import and build is kept in screener_registry.
+    Enabling "rules" with the path of a rules file adds a screener for each
+    declarative rule in it, all matched together by one RuleSet.
+
+    Material screened before, such as the identical heartbeats SDKs send
+    over and over, is looked up in a VerdictCache of verdict_cache_entries
+    entries taking at most verdict_cache_bytes, each used for
+    verdict_cache_ttl seconds, rather than screened again. Setting
+    verdict_cache_entries to 0 screens everything.
+
+    A destination_policy skips screening traffic to trusted destinations,
+    and passes their TLS connections through without intercepting them. It
+    is matched against the names the destination is connected by, the host
+    and SNI, never the Host header an application chooses.
     """
 
-    db_connection: sqlite3.Connection
-    """The connection to the database"""
+    alert_writer: AlertSink
+    """Where triggered alerts are sent, usually the writer that owns the database"""
 
     screeners: List[IndividualScreener]
     """The list of screeners"""
 
-    def __init__(self, database_path: str) -> None:
-        # open db from ../database.db
-        self.db_connection = sqlite3.connect(database_path)
+    match_engine: MatchEngine
+    """Scans for the patterns of every screener in a single pass"""
+
+    device_locator: DeviceLocator
+    """Keeps the device location the LocationScreener compares against"""
+
+    tcp_streams: TcpStreams
+    """The data carried over between the messages of each TCP connection"""
+
+    executor: Optional[ScreeningExecutor]
+    """Screens flows off the event loop, None to screen inline"""
+
+    profiler: Optional[FlowProfiler]
+    """Profiles a sample of flows, None when profiling is off"""
+
+    retention: Optional[RetentionService]
+    """Archives and deletes expired rows, None when everything is kept"""
+
+    destination_policy: Optional[DestinationPolicy]
+    """Decides which destinations are trusted, None to screen all traffic"""
+
+    screener_registry: ScreenerRegistry
+    """Built the screeners, and knows what each one cost to build"""
+
+    verdict_cache: Optional[VerdictCache]
+    """Remembers what was found in material already screened, None to screen everything"""
+
+    def __init__(
+        self,
+        database_path: Optional[str] = None,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        max_queue_size: int = 10000,
+        put_timeout: Optional[float] = 5.0,
+        suppression_window: Optional[float] = 600.0,
+        sample_size: int = 5,
+        payload_codec: Optional[str] = DEFAULT_CODEC,
+        secret_sources: Optional[List[SecretSource]] = None,
+        tcp_carry_size: int = 256,
+        executor: str = "inline",
+        max_workers: int = 4,
+        max_in_flight: int = 256,
+        deadline: Optional[float] = 2.0,
+        hold: bool = True,
+        metrics_port: Optional[int] = None,
+        metrics_host: str = "127.0.0.1",
+        metrics_path: Optional[str] = None,
+        metrics_interval: float = 15.0,
+        profile_sample_rate: float = 0.0,
+        profile_dir: Optional[str] = None,
+        alert_sink: Optional[AlertSink] = None,
+        location_providers: Optional[List[LocationProvider]] = None,
+        location_cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+        protected_locations: Optional[List["ProtectedLocation"]] = None,
+        retention: Optional[RetentionPolicy] = None,
+        retention_interval: float = 3600.0,
+        destination_policy: Optional[DestinationPolicy] = None,
+        verdict_cache_entries: int = 10000,
+        verdict_cache_bytes: int = 16 * 1024 * 1024,
+        verdict_cache_ttl: Optional[float] = 300.0,
+        screener_config: Optional[Union[str, List[ScreenerConfig]]] = None,
+    ) -> None:
+        if alert_sink is not None:
+            self.alert_writer = alert_sink
+        elif database_path is not None:
+            # alerts are written to the database on a separate thread
+            self.alert_writer = AlertWriter(
+                database_path,
+                batch_size=batch_size,
+                flush_interval=flush_interval,
+                max_queue_size=max_queue_size,
+                put_timeout=put_timeout,
+                suppression_window=suppression_window,
+                sample_size=sample_size,
+                payload_codec=payload_codec,
+            )
+        else:
+            raise ValueError("Either a database_path or an alert_sink is needed")
 
         # initialize screeners
-        self.screeners = [
-            EnvVarScreener(self.db_connection),
-            FileNameScreener(self.db_connection),
-            MacAddrScreener(self.db_connection),
-            ClipboardScreener(self.db_connection),
-            LocationScreener(self.db_connection),
-            TimestampScreener(self.db_connection),
-        ]
-
-    def request(self, flow: http.HTTPFlow) -> None:
-        for screener in self.screeners:
-            screener.request(flow)
-
-    def tcp_message(self, flow: tcp.TCPFlow) -> None:
-        for screener in self.screeners:
-            screener.tcp_message(flow)
+        if isinstance(screener_config, str):
+            screener_config = load_screener_config(screener_config)
+        self.device_locator = DeviceLocator(
+            location_providers, location_cache_path, start=False
+        )
+        self.screener_registry = ScreenerRegistry()
+        self.screeners = build_screeners(
+            self.alert_writer,
+            secret_sources,
+            device_locator=self.device_locator,
+            protected_locations=protected_locations,
+            config=screener_config,
+            registry=self.screener_registry,
+        )
+        self.match_engine = build_match_engine(self.screeners)
+
+        self.tcp_streams = TcpStreams(carry_size=tcp_carry_size)
+
+        self.verdict_cache = (
+            VerdictCache(verdict_cache_entries, verdict_cache_bytes, verdict_cache_ttl)
+            if verdict_cache_entries > 0
+            else None
+        )
+
+        self.destination_policy = destination_policy
+        # the TCP connections to trusted destinations, whose messages aren't screened
+        self._trusted_tcp_flows: Set[str] = set()
+
+        self.retention = None
+        if retention is not None and database_path is not None:
+            self.retention = RetentionService(
+                database_path, retention, interval=retention_interval
+            )
+
+        self.profiler = None
+        if profile_sample_rate > 0:
+            self.profiler = FlowProfiler(profile_sample_rate, output_dir=profile_dir)
+
+        self.executor = None
+        if executor != "inline":
+            self.executor = ScreeningExecutor(
+                self.screeners,
+                self.match_engine,
+                mode=executor,
+                max_workers=max_workers,
+                max_in_flight=max_in_flight,
+                deadline=deadline,
+                hold=hold,
+                worker_factory=partial(
+                    build_screeners,
+                    None,
+                    secret_sources,
+                    location_providers=location_providers,
+                    location_cache_path=location_cache_path,
+                    protected_locations=protected_locations,
+                    config=screener_config,
+                ),
+                profiler=self.profiler,
+                verdict_cache=self.verdict_cache,
+            )
+
+        self.register_metrics()
+        self.metrics_server = (
+            MetricsServer(REGISTRY, metrics_host, metrics_port)
+            if metrics_port is not None
+            else None
+        )
+        self.metrics_snapshot = (
+            MetricsSnapshot(REGISTRY, metrics_path, metrics_interval)
+            if metrics_path
+            else None
+        )
+
+    def register_metrics(self) -> None:
+        """Expose the writer, executor and TCP stream state as gauges"""
+        REGISTRY.gauges_from_stats("traffic_slice_alert_writer", self.alert_writer.stats)
+        REGISTRY.gauge(
+            "traffic_slice_alert_queue_depth",
+            "Alerts waiting to be written",
+            lambda: self.alert_writer.queue_depth,
+        )
+        REGISTRY.gauge(
+            "traffic_slice_device_location_age_seconds",
+            "Seconds since the device location was last fixed",
+            # left out until there is a fix
+            lambda: self.device_locator.age,  # type: ignore[arg-type,return-value]
+        )
+        REGISTRY.gauge(
+            "traffic_slice_tcp_streams",
+            "TCP connection directions with carried over data",
+            lambda: len(self.tcp_streams),
+        )
+        if self.retention is not None:
+            REGISTRY.gauges_from_stats("traffic_slice_retention", self.retention.stats)
+        if self.verdict_cache is not None:
+            verdict_cache = self.verdict_cache
+            REGISTRY.gauges_from_stats("traffic_slice_verdict_cache", verdict_cache.stats)
+            REGISTRY.gauge(
+                "traffic_slice_verdict_cache_hit_rate",
+                "Fraction of flows whose material was found in the verdict cache",
+                lambda: verdict_cache.hit_rate,
+            )
+        if self.destination_policy is not None:
+            REGISTRY.gauges_from_stats(
+                "traffic_slice_destination_policy", self.destination_policy.stats
+            )
+        if self.executor is not None:
+            executor = self.executor
+            REGISTRY.gauges_from_stats("traffic_slice_executor", executor.stats)
+            REGISTRY.gauge(
+                "traffic_slice_executor_in_flight",
+                "Flows being screened on the pool",
+                lambda: executor.in_flight,
+            )
+
+    def tls_clienthello(self, data: tls.ClientHelloData) -> None:
+        """Leave TLS connections to trusted destinations uninterrupted"""
+        if self.destination_policy is None:
+            return
+        address = data.context.server.address
+        if self.destination_policy.should_pass_through(
+            data.client_hello.sni, address[0] if address else None
+        ):
+            data.ignore_connection = True
+
+    def request(self, flow: http.HTTPFlow) -> Optional[Awaitable[None]]:
+        if self.destination_policy is not None and not self.destination_policy.should_screen(
+            flow.request.host, flow.server_conn.sni
+        ):
+            return None
+
+        # the context is shared so the search material is built once per flow
+        context = ScreeningContext(flow, self.match_engine)
+
+        if self.executor is not None:
+            return self.executor.dispatch(context, self.apply_verdicts)
+
+        self.apply_verdicts(
+            context,
+            screen_all(self.screeners, context, self.profiler, self.verdict_cache),
+        )
+        return None
+
+    def tcp_start(self, flow: tcp.TCPFlow) -> None:
+        address = flow.server_conn.address
+        if self.destination_policy is not None and not self.destination_policy.should_screen(
+            flow.server_conn.sni, address[0] if address else None
+        ):
+            self._trusted_tcp_flows.add(flow.id)
+
+    def tcp_message(self, flow: tcp.TCPFlow) -> Optional[Awaitable[None]]:
+        if flow.id in self._trusted_tcp_flows:
+            return None
+
+        # only the newest message is screened, with the tail of the last one
+        context = self.tcp_streams.context(flow, self.match_engine)
+        if context is None:
+            return None
+
+        if self.executor is not None:
+            return self.executor.dispatch(context, self.apply_verdicts)
+
+        self.apply_verdicts(
+            context,
+            screen_all(self.screeners, context, self.profiler, self.verdict_cache),
+        )
+        return None
+
+    def apply_verdicts(self, context: ScreeningContext, verdicts: Verdicts) -> None:
+        """Raise the alerts of a screened flow"""
+        for index, message in verdicts:
+            if isinstance(context, TcpScreeningContext):
+                self.screeners[index].on_trigger(
+                    message, tcp_message=context.flow, context=context
+                )
+            else:
+                self.screeners[index].on_trigger(
+                    message, http_request=context.flow, context=context
+                )
+
+    def tcp_end(self, flow: tcp.TCPFlow) -> None:
+        self._trusted_tcp_flows.discard(flow.id)
+        self.tcp_streams.close(flow)
+
+    def tcp_error(self, flow: tcp.TCPFlow) -> None:
+        self._trusted_tcp_flows.discard(flow.id)
+        self.tcp_streams.close(flow)
+
+    def done(self) -> Optional[Awaitable[None]]:
+        """Flush any queued alerts when mitmproxy shuts down"""
+        if self.executor is not None:
+            return self.shutdown()
+        self.close_writer()
+        return None
+
+    def close_metrics(self) -> None:
+        """Stop exporting metrics and report the verdict cache and slowest profiled flow"""
+        if self.verdict_cache is not None:
+            stats = self.verdict_cache.stats
+            print(
+                f"Verdict cache: {stats.hits} hits, {stats.misses} misses "
+                f"({self.verdict_cache.hit_rate:.1%} hit rate), {stats.evictions} evicted"
+            )
+        if self.metrics_snapshot is not None:
+            self.metrics_snapshot.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.profiler is not None:
+            print(self.profiler.report())
+
+    async def shutdown(self) -> None:
+        """Wait for flows still being screened, then stop the pool and writer"""
+        assert self.executor is not None
+        await self.executor.drain()
+        self.executor.close()
+        stats = self.executor.stats
+        print(
+            f"Screening executor stopped: {stats.completed} screened in time, "
+            f"{stats.late} late, {stats.timed_out} timed out, {stats.failed} failed, "
+            f"{stats.shed} shed, max in flight {stats.max_in_flight}"
+        )
+        self.close_writer()
+
+    def close_writer(self) -> None:
+        """Write every queued alert and stop the writer and metrics"""
+        self.device_locator.stop()
+        if self.retention is not None:
+            self.retention.stop()
+        self.alert_writer.close()
+        stats = self.alert_writer.stats
+        print(
+            f"Alert writer stopped: {stats.written} written "
+            f"({stats.coalesced} coalesced), {stats.failed} failed, "
+            f"{stats.dropped} dropped, max queue depth {stats.max_queue_depth}"
+        )
+        self.close_metrics()
@@ -0,0 +1,278 @@
+from dataclasses import dataclass
+import sqlite3
+from typing import Callable, Dict, List, Optional, Union
+
+from AlertRollups import ensure_alert_rollups
+from AlertSuppression import ensure_alert_aggregates
+from PayloadStore import (
+    PAYLOAD_VIEWS,
+    ensure_payload_compression,
+    ensure_payload_store,
+    register_payload_functions,
+)
+from SqlScript import execute_script
+
+
+PRAGMAS: Dict[str, Union[int, str]] = {
+    # only takes effect on new databases, before their first table is created
+    "auto_vacuum": "INCREMENTAL",
+    # readers never block the writer and the writer never blocks readers
+    "journal_mode": "WAL",
+    # with WAL, only a power loss can lose the last transactions, never corrupt
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    # negative sizes are in KiB, so 64 MiB
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+}
+"""The settings every connection to the screener database is made with"""
+
+
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    alert_name TEXT NOT NULL,
+    message TEXT NOT NULL,
+    application_from TEXT NOT NULL,
+    destination_domain TEXT NOT NULL,
+    type TEXT NOT NULL,
+    severity INTEGER NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS alert_tcp_messages (
+    alert_id INTEGER NOT NULL,
+    tcp_message_id INTEGER NOT NULL,
+    PRIMARY KEY (alert_id, tcp_message_id),
+    FOREIGN KEY (alert_id) REFERENCES alerts(id),
+    FOREIGN KEY (tcp_message_id) REFERENCES tcp_messages(id)
+);
+
+CREATE TABLE IF NOT EXISTS alert_http_requests (
+    alert_id INTEGER NOT NULL,
+    http_request_id INTEGER NOT NULL,
+    PRIMARY KEY (alert_id, http_request_id),
+    FOREIGN KEY (alert_id) REFERENCES alerts(id),
+    FOREIGN KEY (http_request_id) REFERENCES http_requests(id)
+);
+
+CREATE TABLE IF NOT EXISTS tcp_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    flow_id TEXT UNIQUE NOT NULL,
+    client_host TEXT,
+    client_port INTEGER,
+    server_host TEXT,
+    server_port INTEGER,
+    message_content BLOB,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS http_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    flow_id TEXT UNIQUE NOT NULL,
+    url TEXT,
+    method TEXT,
+    headers TEXT,
+    request_content TEXT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_alerts_alert_name ON alerts(alert_name);
+CREATE INDEX IF NOT EXISTS idx_alerts_timestamp ON alerts(timestamp);
+CREATE INDEX IF NOT EXISTS idx_tcp_messages_flow_id ON tcp_messages(flow_id);
+CREATE INDEX IF NOT EXISTS idx_http_requests_flow_id ON http_requests(flow_id);
+CREATE INDEX IF NOT EXISTS idx_alert_tcp_messages_tcp_id ON alert_tcp_messages(tcp_message_id);
+CREATE INDEX IF NOT EXISTS idx_alert_http_requests_http_id ON alert_http_requests(http_request_id);
+CREATE INDEX IF NOT EXISTS idx_tcp_messages_timestamp ON tcp_messages(timestamp);
+CREATE INDEX IF NOT EXISTS idx_tcp_messages_client_host ON tcp_messages(client_host);
+CREATE INDEX IF NOT EXISTS idx_tcp_messages_server_host ON tcp_messages(server_host);
+CREATE INDEX IF NOT EXISTS idx_http_requests_timestamp ON http_requests(timestamp);
+CREATE INDEX IF NOT EXISTS idx_http_requests_url ON http_requests(url);
+CREATE INDEX IF NOT EXISTS idx_http_requests_method ON http_requests(method);
+"""
+"""The tables and indexes of the original schema.sql"""
+
+
+DASHBOARD_INDEXES = """
+-- the alert list is ordered by severity, then newest first
+CREATE INDEX IF NOT EXISTS idx_alerts_severity_timestamp ON alerts(severity, timestamp);
+
+-- the analytics group a time range by type, application or destination
+CREATE INDEX IF NOT EXISTS idx_alerts_timestamp_type ON alerts(timestamp, type);
+CREATE INDEX IF NOT EXISTS idx_alerts_application_timestamp ON alerts(application_from, timestamp);
+CREATE INDEX IF NOT EXISTS idx_alerts_destination_timestamp ON alerts(destination_domain, timestamp);
+
+-- covered by idx_alerts_timestamp_type and the UNIQUE constraints on flow_id
+DROP INDEX IF EXISTS idx_alerts_timestamp;
+DROP INDEX IF EXISTS idx_tcp_messages_flow_id;
+DROP INDEX IF EXISTS idx_http_requests_flow_id;
+"""
+"""Indexes matching the queries of the dashboard backend"""
+
+
+@dataclass(frozen=True)
+class Migration:
+    """A step that brings the schema from the previous version to version"""
+
+    version: int
+
+    name: str
+
+    apply: Callable[[sqlite3.Connection], None]
+    """Makes the change. Must be safe to apply to a database that already has it"""
+
+    transactional: bool = True
+    """
+    Whether the change is applied in the transaction that records it. Changes
+    that cannot run in a transaction, like VACUUM, are applied just before it
+    """
+
+
+def _script(sql: str) -> Callable[[sqlite3.Connection], None]:
+    def apply(connection: sqlite3.Connection) -> None:
+        execute_script(connection, sql)
+
+    return apply
+
+
+def ensure_incremental_vacuum(connection: sqlite3.Connection) -> None:
+    """
+    Put the database in incremental auto-vacuum mode if it is not already.
+
+    New databases are created in it. Older ones need a full VACUUM to switch,
+    which rewrites the whole file once.
+    """
+    if connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.execute("VACUUM")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline schema", _script(BASELINE_SCHEMA)),
+    Migration(2, "payload blob store", ensure_payload_store),
+    Migration(3, "alert aggregates", ensure_alert_aggregates),
+    Migration(4, "dashboard indexes", _script(DASHBOARD_INDEXES)),
+    Migration(5, "alert rollups", ensure_alert_rollups),
+    Migration(6, "incremental vacuum", ensure_incremental_vacuum, transactional=False),
+    Migration(7, "payload compression", ensure_payload_compression),
+    Migration(8, "plain SQL payload views", _script(PAYLOAD_VIEWS)),
+]
+"""Every migration, in order. New ones are appended with the next version"""
+
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+"""The version of the schema this code writes"""
+
+
+def apply_pragmas(
+    connection: sqlite3.Connection, pragmas: Optional[Dict[str, Union[int, str]]] = None
+) -> None:
+    """Apply the connection settings, PRAGMAS by default"""
+    for name, value in (PRAGMAS if pragmas is None else pragmas).items():
+        connection.execute(f"PRAGMA {name} = {value}")
+
+
+def schema_version(connection: sqlite3.Connection) -> int:
+    """The version of the schema of a database, 0 if it has never been migrated"""
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    row = connection.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def _check_version(version: int) -> None:
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"The database is at schema version {version}, newer than this "
+            f"screener's {SCHEMA_VERSION}"
+        )
+
+
+def migrate(connection: sqlite3.Connection) -> List[Migration]:
+    """
+    Apply the migrations the database has not had yet, in order.
+
+    Databases created before versioning start at version 0. Since every
+    migration is safe to apply to a database that already has its change,
+    they are brought up to date like new ones. Returns the migrations applied.
+
+    Each migration and its schema_version row are committed together under
+    the write lock, and the version is read again once the lock is held, so
+    processes connecting at the same time apply every migration only once.
+    """
+    current = schema_version(connection)
+    connection.commit()
+    _check_version(current)
+
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+        if not migration.transactional:
+            migration.apply(connection)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            current = schema_version(connection)
+            _check_version(current)
+            if migration.version <= current:
+                # another connection applied it while this one waited
+                connection.rollback()
+                continue
+            if migration.transactional:
+                migration.apply(connection)
+            connection.execute(
+                "INSERT INTO schema_version (version, name) VALUES (?, ?)",
+                (migration.version, migration.name),
+            )
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        current = migration.version
+        applied.append(migration)
+
+    if applied:
+        # gives the query planner statistics for the new indexes
+        connection.execute("ANALYZE")
+    return applied
+
+
+def connect_database(
+    database_path: str,
+    migrate_schema: bool = True,
+    pragmas: Optional[Dict[str, Union[int, str]]] = None,
+) -> sqlite3.Connection:
+    """
+    Open the screener database with the production settings.
+
+    The schema is migrated to the latest version unless migrate_schema is
+    False, which readers that must not change the database use.
+    """
+    connection = sqlite3.connect(database_path)
+    try:
+        apply_pragmas(connection, pragmas)
+        # DECODED_HTTP_REQUESTS and DECODED_TCP_MESSAGES read payloads through it
+        register_payload_functions(connection)
+        if migrate_schema:
+            migrate(connection)
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+def close_database(connection: sqlite3.Connection) -> None:
+    """Close a connection, letting SQLite refresh the statistics it needs first"""
+    try:
+        connection.execute("PRAGMA optimize")
+    finally:
+        connection.close()
@@ -0,0 +1,200 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+
+ALLOW = "allow"
+"""Traffic to the destination is trusted and not screened"""
+
+DENY = "deny"
+"""Traffic to the destination is always screened, even if an allow rule matches"""
+
+SCREEN = "screen"
+"""The action of destinations no rule matches"""
+
+
+class _Node:
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        # the action of the domain ending here, and of its subdomains
+        self.exact: Optional[str] = None
+        self.wildcard: Optional[str] = None
+
+
+def _labels(domain: str) -> List[str]:
+    """The labels of a domain, from the top level down"""
+    return domain.strip().rstrip(".").lower().split(".")[::-1]
+
+
+class DomainTrie:
+    """
+    DomainTrie matches host names against domain patterns.
+
+    Patterns are stored by their labels in reverse, com then example then
+    www, so a lookup walks the labels of the host from the top level down
+    and costs the same however many patterns there are. A pattern is either
+    a domain, matching exactly that host, or a wildcard such as
+    *.example.com, matching every subdomain of example.com but not
+    example.com itself.
+
+    The most specific pattern that matches a host decides it, a domain being
+    more specific than a wildcard over it. When an allow and a deny pattern
+    are equally specific, deny wins.
+    """
+
+    def __init__(self) -> None:
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self) -> int:
+        """The number of patterns"""
+        return self._size
+
+    def add(self, pattern: str, action: str) -> None:
+        """Add a pattern, replacing any action it had unless that was deny"""
+        labels = _labels(pattern)
+        wildcard = labels[-1] == "*"
+        if wildcard:
+            labels.pop()
+        if not labels or "*" in labels or "" in labels:
+            raise ValueError(f"Invalid domain pattern {pattern!r}")
+
+        node = self._root
+        for label in labels:
+            node = node.children.setdefault(label, _Node())
+        current = node.wildcard if wildcard else node.exact
+        if current is None:
+            self._size += 1
+        if current != DENY:
+            if wildcard:
+                node.wildcard = action
+            else:
+                node.exact = action
+
+    def match(self, host: str) -> Optional[str]:
+        """The action of the most specific pattern matching a host, None if none does"""
+        found: Optional[str] = None
+        node = self._root
+        for label in _labels(host):
+            # a wildcard covers every name below the node it is on
+            if node.wildcard is not None:
+                found = node.wildcard
+            child = node.children.get(label)
+            if child is None:
+                return found
+            node = child
+        return node.exact if node.exact is not None else found
+
+
+def load_domain_list(path: str) -> List[str]:
+    """
+    Read domain patterns from a file, one per line.
+
+    Blank lines and everything after a # are ignored.
+    """
+    patterns = []
+    with open(path, "r") as f:
+        for line in f:
+            pattern = line.split("#", 1)[0].strip()
+            if pattern:
+                patterns.append(pattern)
+    return patterns
+
+
+@dataclass
+class DestinationPolicyStats:
+    """Counters describing what the destination policy decided"""
+
+    screened: int = 0
+    """Flows screened as usual"""
+
+    skipped: int = 0
+    """Flows to allowed destinations that were not screened"""
+
+    passed_through: int = 0
+    """TLS connections to allowed destinations that were not intercepted"""
+
+
+class DestinationPolicy:
+    """
+    DestinationPolicy decides which traffic is worth screening by where it goes.
+
+    Traffic to destinations on the allowlist is trusted: flows to them are
+    not screened and, with passthrough on, their TLS connections are not
+    even intercepted, so neither decryption nor screening is paid for them.
+    The denylist carves exceptions out of the allowlist, such as a single
+    third party host under an allowed domain. Everything else is screened.
+    """
+
+    passthrough: bool
+    """Whether TLS connections to allowed destinations are passed through"""
+
+    stats: DestinationPolicyStats
+    """What the policy decided"""
+
+    def __init__(
+        self,
+        allow: Iterable[str] = (),
+        deny: Iterable[str] = (),
+        passthrough: bool = True,
+    ) -> None:
+        """
+        Args:
+            allow: The patterns of trusted destinations
+            deny: The patterns of destinations always screened
+            passthrough: Whether TLS connections to allowed destinations are
+                passed through without interception
+        """
+        self.trie = DomainTrie()
+        for pattern in allow:
+            self.trie.add(pattern, ALLOW)
+        for pattern in deny:
+            self.trie.add(pattern, DENY)
+        self.passthrough = passthrough
+        self.stats = DestinationPolicyStats()
+
+    @classmethod
+    def from_files(
+        cls,
+        allow_path: Optional[str] = None,
+        deny_path: Optional[str] = None,
+        passthrough: bool = True,
+    ) -> "DestinationPolicy":
+        """Build a policy from files of patterns, as read by load_domain_list"""
+        return cls(
+            load_domain_list(allow_path) if allow_path else (),
+            load_domain_list(deny_path) if deny_path else (),
+            passthrough=passthrough,
+        )
+
+    def action(self, host: Optional[str]) -> str:
+        """ALLOW, DENY or SCREEN for a host, SCREEN when it is unknown"""
+        if not host:
+            return SCREEN
+        return self.trie.match(host) or SCREEN
+
+    def should_screen(self, *hosts: Optional[str]) -> bool:
+        """
+        Whether a flow is screened, given the names its destination is known
+        by, such as the host connected to and the SNI.
+
+        A flow is only skipped if one of the names is allowed and none is
+        denied, so a denied SNI can't hide behind an allowed host.
+        """
+        actions = [self.action(host) for host in hosts if host]
+        if ALLOW in actions and DENY not in actions:
+            self.stats.skipped += 1
+            return False
+        self.stats.screened += 1
+        return True
+
+    def should_pass_through(self, *hosts: Optional[str]) -> bool:
+        """Whether a TLS connection to a destination is left uninterrupted"""
+        if not self.passthrough:
+            return False
+        actions = [self.action(host) for host in hosts if host]
+        if ALLOW in actions and DENY not in actions:
+            self.stats.passed_through += 1
+            return True
+        return False
@@ -0,0 +1,262 @@
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import List, Optional, Tuple
+
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "traffic-slice", "device-location.json"
+)
+
+
+@dataclass(frozen=True)
+class LocationFix:
+    """A location of the device and where and when it was obtained"""
+
+    latitude: float
+
+    longitude: float
+
+    source: str
+    """The name of the provider that produced the fix"""
+
+    timestamp: float
+    """When the fix was obtained"""
+
+    @property
+    def coordinates(self) -> Tuple[float, float]:
+        return (self.latitude, self.longitude)
+
+    @property
+    def age(self) -> float:
+        """The number of seconds since the fix was obtained"""
+        return max(0.0, time.time() - self.timestamp)
+
+
+class LocationProvider(ABC):
+    """
+    A way to find out where the device is.
+
+    Subclasses implement locate, which returns (latitude, longitude) or None
+    if the location is not available right now. locate may block, since it
+    is only ever called from the DeviceLocator's refresher thread.
+    """
+
+    name: str = "unknown"
+    """Recorded as the source of the fixes the provider produces"""
+
+    @abstractmethod
+    def locate(self) -> Optional[Tuple[float, float]]:
+        """The (latitude, longitude) of the device, or None if it is not known"""
+        pass
+
+
+class StaticLocation(LocationProvider):
+    """A location given in configuration, for offline use or a fixed site"""
+
+    name = "static"
+
+    def __init__(self, latitude: float, longitude: float) -> None:
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def locate(self) -> Optional[Tuple[float, float]]:
+        return (self.latitude, self.longitude)
+
+
+class FileLocation(LocationProvider):
+    """
+    A location read from a JSON file with "lat" and "lng" keys.
+
+    Lets a local location service, or a test, provide the location without
+    any network access.
+    """
+
+    name = "file"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def locate(self) -> Optional[Tuple[float, float]]:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            return (float(data["lat"]), float(data["lng"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+class GeocoderLocation(LocationProvider):
+    """The location of the device's public IP address, looked up online"""
+
+    name = "geocoder"
+
+    def locate(self) -> Optional[Tuple[float, float]]:
+        # geocoder and its requests stack are slow to import, and only the
+        # background refresh ever needs them
+        import geocoder
+
+        try:
+            # Try to get location from IP-based geocoding
+            g = geocoder.ip("me")
+            if g.ok:
+                return (g.lat, g.lng)
+
+            # Fallback to a different IP geocoding provider if first one fails
+            g = geocoder.ipinfo("me")
+            if g.ok:
+                return (g.lat, g.lng)
+        except Exception:
+            pass
+        return None
+
+
+class DeviceLocator:
+    """
+    DeviceLocator keeps track of where the device is, without ever blocking.
+
+    The last known fix is loaded from cache_path when the locator is built,
+    so it is available at once. A background thread then asks the providers,
+    in order, for a fresh fix every refresh_interval seconds, or every
+    retry_interval seconds while none of them has one, and saves each new fix
+    to cache_path.
+
+    Readers only ever see the fix already in memory, along with how old it is.
+    """
+
+    providers: List[LocationProvider]
+    """Asked for the location in order, until one has it"""
+
+    cache_path: Optional[str]
+    """Where the last fix is kept between runs, None to not keep it"""
+
+    refresh_interval: float
+    """The number of seconds between refreshes"""
+
+    retry_interval: float
+    """The number of seconds between refreshes while no provider has a fix"""
+
+    def __init__(
+        self,
+        providers: Optional[List[LocationProvider]] = None,
+        cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+        refresh_interval: float = 900.0,
+        retry_interval: float = 60.0,
+        start: bool = True,
+    ) -> None:
+        """
+        Args:
+            providers: Where to get the location from, the IP geolocation
+                services by default
+            cache_path: Where the last fix is kept between runs
+            refresh_interval: The number of seconds between refreshes
+            retry_interval: The number of seconds between refreshes while no
+                provider has a fix
+            start: Whether to start refreshing in the background now
+        """
+        self.providers = providers if providers is not None else [GeocoderLocation()]
+        self.cache_path = cache_path
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+
+        self._fix: Optional[LocationFix] = self.load()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        if start:
+            self.start()
+
+    @property
+    def fix(self) -> Optional[LocationFix]:
+        """The last known fix, None until there is one"""
+        return self._fix
+
+    @property
+    def coordinates(self) -> Tuple[float, float]:
+        """The last known (latitude, longitude), (0.0, 0.0) until there is one"""
+        fix = self._fix
+        return fix.coordinates if fix is not None else (0.0, 0.0)
+
+    @property
+    def age(self) -> Optional[float]:
+        """The number of seconds since the last known fix, None without one"""
+        fix = self._fix
+        return fix.age if fix is not None else None
+
+    def refresh(self) -> bool:
+        """Ask the providers for a fix now. Returns whether one had it"""
+        for provider in self.providers:
+            try:
+                coordinates = provider.locate()
+            except Exception as e:
+                print(f"Failed to get the device location from {provider.name}: {e}")
+                continue
+            if coordinates is None:
+                continue
+
+            latitude, longitude = coordinates
+            self._fix = LocationFix(latitude, longitude, provider.name, time.time())
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Failed to save the device location to {self.cache_path}: {e}")
+            return True
+        return False
+
+    def load(self) -> Optional[LocationFix]:
+        """Read the fix saved in cache_path, if there is one"""
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, "r") as f:
+                return LocationFix(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self) -> None:
+        """Write the current fix to cache_path, replacing the previous one atomically"""
+        if not self.cache_path or self._fix is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".device-location-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(asdict(self._fix), f)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def start(self) -> None:
+        """
+        Start refreshing in the background, beginning with a refresh now.
+
+        Does nothing once started, so users that are built before they are
+        needed can call it on first use.
+        """
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="device-locator", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop refreshing"""
+        self._stop.set()
+
+    def _run(self) -> None:
+        # a saved fix that is still fresh doesn't need refreshing yet
+        age = self.age
+        delay = max(0.0, self.refresh_interval - age) if age is not None else 0.0
+        while not self._stop.wait(delay):
+            delay = self.refresh_interval if self.refresh() else self.retry_interval
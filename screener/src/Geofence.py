@@ -0,0 +1,275 @@
+from dataclasses import dataclass
+import json
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy  # optional, vectorizes the distance checks
+except ImportError:
+    numpy = None
+
+
+EARTH_RADIUS_KM = 6371.0
+
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+"""The length of a degree of latitude"""
+
+
+@dataclass(frozen=True)
+class ProtectedLocation:
+    """A sensitive site, such as an office or a home, and the area around it"""
+
+    name: str
+
+    latitude: float
+
+    longitude: float
+
+    radius_km: float = 1.0
+    """Coordinates within this distance of the site are alerted on"""
+
+
+@dataclass(frozen=True)
+class GeofenceMatch:
+    """A coordinate that falls within a protected location"""
+
+    location: ProtectedLocation
+
+    latitude: float
+
+    longitude: float
+
+    distance_km: float
+    """The distance from the coordinate to the site"""
+
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """The great-circle distance between two points in kilometers"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def load_protected_locations(path: str) -> List[ProtectedLocation]:
+    """
+    Read protected locations from a JSON file.
+
+    The file holds a list of objects with name, lat, lng and, optionally,
+    radius_km keys.
+    """
+    with open(path, "r") as f:
+        return [
+            ProtectedLocation(
+                name=str(entry["name"]),
+                latitude=float(entry["lat"]),
+                longitude=float(entry["lng"]),
+                radius_km=float(entry.get("radius_km", 1.0)),
+            )
+            for entry in json.load(f)
+        ]
+
+
+class GeofenceIndex:
+    """
+    GeofenceIndex finds which protected locations coordinates fall within.
+
+    The globe is divided into a grid of cells of cell_degrees, and every
+    location is filed under each cell its bounding box overlaps. A coordinate
+    is then only compared with the locations filed under its own cell, first
+    against their bounding boxes and then by distance, so the cost per
+    coordinate depends on how crowded its cell is rather than on how many
+    locations there are. Locations too large to file cell by cell, such as
+    ones near a pole, are filed under whole rows of cells instead.
+
+    Batches of coordinates are checked together, vectorized with NumPy when
+    it is installed.
+    """
+
+    locations: List[ProtectedLocation]
+    """The protected locations, in the order they were given"""
+
+    cell_degrees: float
+    """The size of a grid cell in degrees"""
+
+    MAX_CELLS_PER_LOCATION = 4096
+    """Locations whose bounding box covers more cells are filed by row"""
+
+    def __init__(
+        self, locations: Sequence[ProtectedLocation], cell_degrees: Optional[float] = None
+    ) -> None:
+        """
+        Args:
+            locations: The protected locations
+            cell_degrees: The size of a grid cell in degrees, by default about
+                twice the median radius of the locations
+        """
+        self.locations = list(locations)
+        if cell_degrees is None:
+            radii = sorted(location.radius_km for location in self.locations) or [1.0]
+            cell_degrees = min(1.0, max(0.01, 2 * radii[len(radii) // 2] / KM_PER_DEGREE))
+
+        # a whole number of cells around the globe, so longitudes wrap cleanly
+        self._lng_cells = max(1, round(360 / cell_degrees))
+        self.cell_degrees = 360 / self._lng_cells
+
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+        self._rows: Dict[int, List[int]] = {}
+        self._boxes: List[Tuple[float, float]] = []
+        for index, location in enumerate(self.locations):
+            self._boxes.append(self._file(index, location))
+
+        if numpy is not None and self.locations:
+            self._lat = numpy.radians([location.latitude for location in self.locations])
+            self._lng = numpy.radians([location.longitude for location in self.locations])
+            self._radius = numpy.array([location.radius_km for location in self.locations])
+            self._latitudes = numpy.array([location.latitude for location in self.locations])
+            self._longitudes = numpy.array([location.longitude for location in self.locations])
+            self._lat_box = numpy.array([box[0] for box in self._boxes])
+            self._lng_box = numpy.array([box[1] for box in self._boxes])
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (
+            math.floor(latitude / self.cell_degrees),
+            math.floor(longitude / self.cell_degrees) % self._lng_cells,
+        )
+
+    def _file(self, index: int, location: ProtectedLocation) -> Tuple[float, float]:
+        """
+        File a location under the cells its bounding box overlaps.
+
+        Returns the half-height and half-width of the box in degrees.
+        """
+        lat_box = location.radius_km / KM_PER_DEGREE
+        low = max(-90.0, location.latitude - lat_box)
+        high = min(90.0, location.latitude + lat_box)
+
+        # a degree of longitude is shortest at the edge nearest a pole
+        widest = math.cos(math.radians(max(abs(low), abs(high))))
+        lng_box = location.radius_km / (KM_PER_DEGREE * widest) if widest > 1e-9 else 180.0
+
+        lat_cells = range(
+            math.floor(low / self.cell_degrees), math.floor(high / self.cell_degrees) + 1
+        )
+        if lng_box >= 180.0:
+            lng_cells = range(self._lng_cells)
+        else:
+            first = math.floor((location.longitude - lng_box) / self.cell_degrees)
+            last = math.floor((location.longitude + lng_box) / self.cell_degrees)
+            lng_cells = range(first, last + 1)
+
+        if len(lat_cells) * len(lng_cells) > self.MAX_CELLS_PER_LOCATION:
+            for lat_cell in lat_cells:
+                self._rows.setdefault(lat_cell, []).append(index)
+        else:
+            for lat_cell in lat_cells:
+                for lng_cell in lng_cells:
+                    key = (lat_cell, lng_cell % self._lng_cells)
+                    self._cells.setdefault(key, []).append(index)
+        return (lat_box, min(lng_box, 180.0))
+
+    def candidates(self, latitude: float, longitude: float) -> List[int]:
+        """The indexes of the locations a coordinate could fall within"""
+        lat_cell, lng_cell = self._cell(latitude, longitude)
+        found = self._cells.get((lat_cell, lng_cell), [])
+        row = self._rows.get(lat_cell)
+        return found + row if row else found
+
+    def match(
+        self, coordinates: Sequence[Tuple[float, float]]
+    ) -> List[Optional[GeofenceMatch]]:
+        """
+        Find the nearest protected location each coordinate falls within.
+
+        Returns one entry per coordinate, None where it is in none of them.
+        """
+        if not self.locations or not coordinates:
+            return [None] * len(coordinates)
+
+        pair_coordinates: List[int] = []
+        pair_locations: List[int] = []
+        for position, (latitude, longitude) in enumerate(coordinates):
+            found = self.candidates(latitude, longitude)
+            pair_coordinates.extend([position] * len(found))
+            pair_locations.extend(found)
+        if not pair_locations:
+            return [None] * len(coordinates)
+
+        if numpy is None:
+            hits = self._hits(coordinates, pair_coordinates, pair_locations)
+        else:
+            hits = self._hits_vectorized(coordinates, pair_coordinates, pair_locations)
+
+        matches: List[Optional[GeofenceMatch]] = [None] * len(coordinates)
+        for position, index, distance in hits:
+            current = matches[position]
+            if current is None or distance < current.distance_km:
+                latitude, longitude = coordinates[position]
+                matches[position] = GeofenceMatch(
+                    self.locations[index], latitude, longitude, distance
+                )
+        return matches
+
+    def _hits(
+        self,
+        coordinates: Sequence[Tuple[float, float]],
+        pair_coordinates: List[int],
+        pair_locations: List[int],
+    ) -> List[Tuple[int, int, float]]:
+        """
+        The (coordinate position, location index, distance) of the candidate
+        pairs where the coordinate is within the location's radius
+        """
+        hits: List[Tuple[int, int, float]] = []
+        for position, index in zip(pair_coordinates, pair_locations):
+            latitude, longitude = coordinates[position]
+            location = self.locations[index]
+            lat_box, lng_box = self._boxes[index]
+            lng_delta = (longitude - location.longitude + 180.0) % 360.0 - 180.0
+            if abs(latitude - location.latitude) > lat_box or abs(lng_delta) > lng_box:
+                continue
+            distance = haversine(latitude, longitude, location.latitude, location.longitude)
+            if distance <= location.radius_km:
+                hits.append((position, index, distance))
+        return hits
+
+    def _hits_vectorized(
+        self,
+        coordinates: Sequence[Tuple[float, float]],
+        pair_coordinates: List[int],
+        pair_locations: List[int],
+    ) -> List[Tuple[int, int, float]]:
+        """_hits over every candidate pair at once with NumPy"""
+        positions = numpy.asarray(pair_coordinates)
+        indexes = numpy.asarray(pair_locations)
+        points = numpy.asarray(coordinates, dtype=float)[positions]
+
+        # bounding boxes first, so only the pairs left need a distance
+        lng_delta = (points[:, 1] - self._longitudes[indexes] + 180.0) % 360.0 - 180.0
+        inside = (
+            numpy.abs(points[:, 0] - self._latitudes[indexes]) <= self._lat_box[indexes]
+        ) & (numpy.abs(lng_delta) <= self._lng_box[indexes])
+        positions, indexes, points = positions[inside], indexes[inside], points[inside]
+
+        lat1 = numpy.radians(points[:, 0])
+        lat2 = self._lat[indexes]
+        a = (
+            numpy.sin((lat2 - lat1) / 2) ** 2
+            + numpy.cos(lat1)
+            * numpy.cos(lat2)
+            * numpy.sin((self._lng[indexes] - numpy.radians(points[:, 1])) / 2) ** 2
+        )
+        distances = 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+        within = distances <= self._radius[indexes]
+        return list(
+            zip(
+                positions[within].tolist(),
+                indexes[within].tolist(),
+                distances[within].tolist(),
+            )
+        )
@@ -0,0 +1,599 @@
+from functools import lru_cache
+from itertools import islice
+import re
+import threading
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants  # type: ignore[no-redef]
+    import sre_parse  # type: ignore[no-redef]
+
+
+SearchText = Union[str, bytes]
+"""
+A search string, or a body screened as raw bytes.
+
+Bodies are only screened as bytes when each byte stands for the character of
+the same code point, so matches are found at the same offsets either way.
+"""
+
+# Character class escapes for the categories sre_parse can report
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: r"\d",
+    sre_constants.CATEGORY_NOT_DIGIT: r"\D",
+    sre_constants.CATEGORY_SPACE: r"\s",
+    sre_constants.CATEGORY_NOT_SPACE: r"\S",
+    sre_constants.CATEGORY_WORD: r"\w",
+    sre_constants.CATEGORY_NOT_WORD: r"\W",
+}
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, "POSSESSIVE_REPEAT"):
+    _REPEATS.add(sre_constants.POSSESSIVE_REPEAT)
+
+
+def _escape_char(code: int) -> str:
+    """Escape a single character for use inside a character class"""
+    return re.escape(chr(code))
+
+
+def _first_chars_of_item(op, av) -> Tuple[Optional[List[str]], bool]:
+    """
+    Work out which characters a single regex item can start with.
+
+    Returns (character class fragments, whether the item can match empty).
+    The fragments are None when the item could start with any character.
+    """
+    if op is sre_constants.LITERAL:
+        return [_escape_char(av)], False
+
+    if op is sre_constants.IN:
+        fragments = []
+        for item_op, item_av in av:
+            if item_op is sre_constants.LITERAL:
+                fragments.append(_escape_char(item_av))
+            elif item_op is sre_constants.RANGE:
+                fragments.append(
+                    f"{_escape_char(item_av[0])}-{_escape_char(item_av[1])}"
+                )
+            elif item_op is sre_constants.CATEGORY and item_av in _CATEGORIES:
+                fragments.append(_CATEGORIES[item_av])
+            else:
+                # negated sets and anything unusual
+                return None, False
+        return fragments, False
+
+    if op is sre_constants.SUBPATTERN:
+        _, add_flags, _, subpattern = av
+        if add_flags & re.IGNORECASE:
+            return None, False
+        return _first_chars_of_sequence(subpattern)
+
+    if op is sre_constants.BRANCH:
+        fragments = []
+        nullable = False
+        for branch in av[1]:
+            branch_fragments, branch_nullable = _first_chars_of_sequence(branch)
+            if branch_fragments is None:
+                return None, False
+            fragments.extend(branch_fragments)
+            nullable = nullable or branch_nullable
+        return fragments, nullable
+
+    if op in _REPEATS:
+        minimum, _, item = av
+        fragments, nullable = _first_chars_of_sequence(item)
+        return fragments, nullable or minimum == 0
+
+    if op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        # zero-width, the next item decides the first character
+        return [], True
+
+    return None, False
+
+
+def _first_chars_of_sequence(items) -> Tuple[Optional[List[str]], bool]:
+    """Work out which characters a sequence of regex items can start with"""
+    fragments: List[str] = []
+    for op, av in items:
+        item_fragments, nullable = _first_chars_of_item(op, av)
+        if item_fragments is None:
+            return None, False
+        fragments.extend(item_fragments)
+        if not nullable:
+            return fragments, False
+    return fragments, True
+
+
+def first_char_class(pattern: re.Pattern) -> Optional[str]:
+    """
+    Build a character class matching every character the pattern can start with.
+
+    Returns None if the pattern could start with anything or match empty.
+    """
+    if pattern.flags & re.IGNORECASE or not isinstance(pattern.pattern, str):
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except re.error:
+        return None
+
+    fragments, nullable = _first_chars_of_sequence(parsed)
+    if fragments is None or nullable or not fragments:
+        return None
+    return "[" + "".join(dict.fromkeys(fragments)) + "]"
+
+
+def _literal_runs(items, ignore_case: bool) -> List[str]:
+    """
+    The runs of literal characters every match of a sequence of regex items
+    must contain, split wherever something else comes between them.
+    """
+    runs: List[str] = []
+    current: List[str] = []
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        if op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            continue  # zero-width, the literals on either side stay adjacent
+        if current:
+            runs.append("".join(current))
+            current = []
+
+        if op is sre_constants.SUBPATTERN:
+            _, add_flags, _, subpattern = av
+            # a case-insensitive group in a case-sensitive pattern has no
+            # exact literals
+            if ignore_case or not add_flags & re.IGNORECASE:
+                runs.extend(_literal_runs(subpattern, ignore_case))
+        elif op in _REPEATS:
+            minimum, _, item = av
+            if minimum > 0:
+                runs.extend(_literal_runs(item, ignore_case))
+    if current:
+        runs.append("".join(current))
+    return runs
+
+
+def required_literal(pattern: re.Pattern, min_length: int = 3) -> Optional[str]:
+    """
+    The longest literal string every match of the pattern contains.
+
+    Text that doesn't contain it can't match, so searching for it with a
+    literal matcher first saves running the pattern. For a case-insensitive
+    pattern the literal is lowercased, and only rules out text that doesn't
+    contain it ignoring case.
+
+    Returns None if there is no such literal of at least min_length characters.
+    """
+    if not isinstance(pattern.pattern, str):
+        return None
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except re.error:
+        return None
+
+    ignore_case = bool(pattern.flags & re.IGNORECASE)
+    runs = _literal_runs(parsed, ignore_case)
+    if not runs:
+        return None
+    literal = max(runs, key=len)
+    if len(literal) < min_length:
+        return None
+    return literal.lower() if ignore_case else literal
+
+
+def _latin1_set(category: str) -> str:
+    """The members of a str character class among the latin-1 code points, as set items"""
+    members = [code for code in range(256) if re.match(category, chr(code))]
+    items = []
+    start = 0
+    while start < len(members):
+        end = start
+        while end + 1 < len(members) and members[end + 1] == members[end] + 1:
+            end += 1
+        items.append(
+            f"\\x{members[start]:02x}"
+            if start == end
+            else f"\\x{members[start]:02x}-\\x{members[end]:02x}"
+        )
+        start = end + 1
+    return "".join(items)
+
+
+# What \d, \s and \w match in a str pattern, among the latin-1 code points
+_LATIN1_SETS = {escape: _latin1_set(f"\\{escape}") for escape in "dsw"}
+
+_WORD = f"[{_LATIN1_SETS['w']}]"
+_BOUNDARIES = {
+    "b": f"(?:(?<={_WORD})(?!{_WORD})|(?<!{_WORD})(?={_WORD}))",
+    "B": f"(?:(?<={_WORD})(?={_WORD})|(?<!{_WORD})(?!{_WORD}))",
+}
+
+
+def _bytes_source(source: str) -> str:
+    """
+    Rewrite a str pattern so that, compiled for bytes, it matches the same as
+    the str pattern does over the latin-1 decoding of those bytes.
+
+    Bytes patterns only know ASCII classes, so \\d, \\s, \\w and the word
+    boundaries are spelled out as latin-1 sets.
+    """
+    out = []
+    in_set = False
+    index = 0
+    while index < len(source):
+        char = source[index]
+        if char == "\\" and index + 1 < len(source):
+            escape = source[index + 1]
+            if escape.lower() in _LATIN1_SETS:
+                members = _LATIN1_SETS[escape.lower()]
+                if not in_set:
+                    out.append(f"[^{members}]" if escape.isupper() else f"[{members}]")
+                elif escape.isupper():
+                    raise re.error("negated class inside a set")
+                else:
+                    out.append(members)
+            elif escape in _BOUNDARIES and not in_set:
+                out.append(_BOUNDARIES[escape])
+            else:
+                out.append(source[index : index + 2])
+            index += 2
+            continue
+
+        out.append(char)
+        index += 1
+        if char == "[" and not in_set:
+            in_set = True
+            # a leading ^ negates, and a ] right after the opening is literal
+            if source.startswith("^", index):
+                out.append("^")
+                index += 1
+            if source.startswith("]", index):
+                out.append("]")
+                index += 1
+        elif char == "]" and in_set:
+            in_set = False
+    return "".join(out)
+
+
+def _compile_bytes(source: str, flags: int) -> Optional[re.Pattern]:
+    """Compile a str pattern source for bytes, or None if it can't be done exactly"""
+    if flags & re.IGNORECASE and not flags & re.ASCII:
+        return None  # case folding beyond ASCII
+    try:
+        if not flags & re.ASCII:
+            source = _bytes_source(source)
+        return re.compile(source.encode("latin-1"), flags & ~re.UNICODE)
+    except (UnicodeEncodeError, re.error):
+        return None
+
+
+@lru_cache(maxsize=None)
+def bytes_pattern(pattern: re.Pattern) -> Optional[re.Pattern]:
+    """
+    Compile a str pattern for bytes that stand for latin-1 text.
+
+    The compiled pattern finds exactly what the str pattern finds in the
+    decoded text, at the same offsets. Returns None if the pattern has
+    characters beyond latin-1, escapes bytes patterns don't support, or
+    case-insensitive matching.
+    """
+    return _compile_bytes(pattern.pattern, pattern.flags)
+
+
+def match_text(match: re.Match) -> str:
+    """The text of a match, whether it was found in a str or in bytes"""
+    group = match.group()
+    return group if isinstance(group, str) else group.decode("latin-1")
+
+
+def _can_combine(pattern: re.Pattern) -> bool:
+    """Patterns with named groups or backreferences must be scanned on their own"""
+    if pattern.groupindex or not isinstance(pattern.pattern, str):
+        return False
+    return not re.search(r"\\[1-9]|\(\?P=", pattern.pattern)
+
+
+class ScanResult:
+    """
+    The matches found by a MatchEngine for one set of search strings.
+
+    Screeners ask for matches through finditer and search, which return the
+    prescanned matches when the engine scanned that pattern over that exact
+    string object and fall back to running the pattern otherwise.
+
+    Matches ending at or before min_end are left out. Streamed TCP data is
+    screened with the tail of the previous message in front of the new one,
+    and matches entirely inside that tail were already reported.
+
+    Patterns are given as str patterns even for bytes, which are searched
+    with the bytes_pattern of the pattern.
+    """
+
+    min_end: int
+    """Matches must end after this offset to be reported"""
+
+    def __init__(self, min_end: int = 0) -> None:
+        self.min_end = min_end
+        self._matches: Dict[Tuple[int, int], List[re.Match]] = {}
+        # keep the scanned strings alive so their ids stay unique
+        self._texts: List[SearchText] = []
+
+    def add(
+        self, pattern: re.Pattern, text: SearchText, matches: List[re.Match]
+    ) -> None:
+        """Record the matches of a pattern over a string"""
+        self._texts.append(text)
+        self._matches[(id(pattern), id(text))] = matches
+
+    def finditer(self, pattern: re.Pattern, text: SearchText) -> Iterable[re.Match]:
+        """Equivalent to pattern.finditer(text)"""
+        matches = self._matches.get((id(pattern), id(text)))
+        if matches is not None:
+            return iter(matches)
+        if isinstance(text, bytes):
+            pattern, text = _for_bytes(pattern, text)
+        if self.min_end:
+            return (
+                match for match in pattern.finditer(text) if match.end() > self.min_end
+            )
+        return pattern.finditer(text)
+
+    def search(self, pattern: re.Pattern, text: SearchText) -> Optional[re.Match]:
+        """Equivalent to pattern.search(text)"""
+        matches = self._matches.get((id(pattern), id(text)))
+        if matches is not None:
+            return matches[0] if matches else None
+        if self.min_end:
+            return next(iter(self.finditer(pattern, text)), None)
+        if isinstance(text, bytes):
+            pattern, text = _for_bytes(pattern, text)
+        return pattern.search(text)
+
+
+def _for_bytes(pattern: re.Pattern, text: bytes) -> Tuple[re.Pattern, SearchText]:
+    """The pattern to search bytes with, decoding them if it has no bytes form"""
+    compiled = bytes_pattern(pattern)
+    if compiled is None:
+        return pattern, text.decode("latin-1")
+    return compiled, text
+
+
+DIRECT_SCAN = ScanResult()
+"""A ScanResult with no prescanned matches, every lookup runs the pattern directly"""
+
+
+class MatchEngine:
+    """
+    MatchEngine scans search strings for the patterns of many screeners at once.
+
+    Registered patterns are compiled into a single alternation guarded by
+    lookaheads over the characters they can start with, so each search
+    string is walked once instead of once per pattern. Every position the
+    combined scanner stops at is then confirmed against the individual
+    patterns, which reproduces exactly what pattern.finditer would return for
+    each of them, overlaps between different patterns included.
+
+    Patterns registered as first_only are only needed until their first match,
+    after which they are dropped from the scan.
+
+    Bodies screened as bytes are scanned with the bytes form of every
+    pattern, without decoding them. The few patterns that have no bytes form
+    are run over a decoded copy instead.
+
+    scan_string scans a string for only some of the patterns, such as the
+    ones a literal prefilter didn't rule out. The combined scanner of each
+    set of patterns is compiled once, keeping the last max_scanners. The
+    scanners are shared by the threads screening flows.
+    """
+
+    patterns: List[re.Pattern]
+    """The registered patterns, in registration order"""
+
+    first_only: List[bool]
+    """Whether each pattern only needs its first match"""
+
+    max_scanners: int
+    """The number of combined scanners kept compiled"""
+
+    def __init__(self, max_scanners: int = 256) -> None:
+        self.patterns = []
+        self.first_only = []
+        self.max_scanners = max_scanners
+        self._scanners: Dict[Tuple[FrozenSet[int], bool], Optional[re.Pattern]] = {}
+        self._scanners_lock = threading.Lock()
+
+    def register(self, pattern: re.Pattern, first_only: bool = False) -> None:
+        """Add a pattern to the engine"""
+        for index, existing in enumerate(self.patterns):
+            if existing is pattern:
+                # keep scanning for all matches if any owner needs them
+                self.first_only[index] = self.first_only[index] and first_only
+                return
+
+        self.patterns.append(pattern)
+        self.first_only.append(first_only)
+        with self._scanners_lock:
+            self._scanners.clear()
+
+    def _scanner(
+        self, indexes: FrozenSet[int], binary: bool = False
+    ) -> Optional[re.Pattern]:
+        """Get the combined scanner for a set of patterns, compiling it once"""
+        key = (indexes, binary)
+        with self._scanners_lock:
+            if key in self._scanners:
+                return self._scanners[key]
+
+        # compiled outside the lock, a thread racing for the same set
+        # compiles an equal scanner
+        patterns = [self.patterns[index] for index in sorted(indexes)]
+        flags = patterns[0].flags
+
+        # gate each alternative on its first character, and the whole
+        # alternation on the union of them, so sre can skip quickly
+        gates = [first_char_class(pattern) for pattern in patterns]
+        alternation = "|".join(
+            f"(?={gate})(?:{pattern.pattern})" if gate else f"(?:{pattern.pattern})"
+            for gate, pattern in zip(gates, patterns)
+        )
+        if all(gates):
+            gate = "|".join(gates)  # type: ignore[arg-type]
+            alternation = f"(?=(?:{gate}))(?:{alternation})"
+
+        if binary:
+            scanner = _compile_bytes(alternation, flags)
+        else:
+            try:
+                scanner = re.compile(alternation, flags)
+            except re.error:
+                scanner = None
+        with self._scanners_lock:
+            if key not in self._scanners and len(self._scanners) >= self.max_scanners:
+                # the oldest is compiled again if it is needed again
+                del self._scanners[next(iter(self._scanners))]
+            self._scanners[key] = scanner
+        return scanner
+
+    def _groups(self, active: List[int]) -> List[List[int]]:
+        """Split the active patterns into groups that can share a scanner"""
+        groups: Dict[int, List[int]] = {}
+        separate: List[List[int]] = []
+        for index in active:
+            pattern = self.patterns[index]
+            if _can_combine(pattern):
+                groups.setdefault(pattern.flags, []).append(index)
+            else:
+                separate.append([index])
+        return list(groups.values()) + separate
+
+    def _scan_group(
+        self, group: List[int], text: SearchText, min_end: int = 0
+    ) -> Dict[int, List[re.Match]]:
+        """
+        Find the matches of a group of patterns with one pass over the text.
+
+        Bytes are scanned with the bytes form of the patterns, which every
+        pattern of the group must have. Matches ending at or before min_end
+        are skipped.
+        """
+        found: Dict[int, List[re.Match]] = {index: [] for index in group}
+
+        binary = isinstance(text, bytes)
+        patterns = {
+            index: bytes_pattern(self.patterns[index]) if binary else self.patterns[index]
+            for index in group
+        }
+        scanner = self._scanner(frozenset(group), binary) if len(group) > 1 else None
+
+        # where each pattern may match next without overlapping its last match
+        next_allowed = {index: 0 for index in group}
+        pending = set(group)
+        position = 0
+        while pending:
+            if len(pending) == 1 or scanner is None:
+                # a single pattern left is cheaper to run directly
+                for index in pending:
+                    matches = (
+                        match
+                        for match in patterns[index].finditer(  # type: ignore[union-attr]
+                            text, next_allowed[index]
+                        )
+                        if match.end() > min_end
+                    )
+                    if self.first_only[index]:
+                        found[index].extend(islice(matches, 1))
+                    else:
+                        found[index].extend(matches)
+                break
+
+            hit = scanner.search(text, position)
+            if hit is None:
+                break
+
+            start = hit.start()
+            for index in list(pending):
+                if next_allowed[index] > start:
+                    continue
+                match = patterns[index].match(text, start)  # type: ignore[union-attr]
+                if match is None:
+                    continue
+                next_allowed[index] = max(match.end(), start + 1)
+                if match.end() <= min_end:
+                    continue
+                found[index].append(match)
+                if self.first_only[index]:
+                    pending.discard(index)
+                    scanner = self._scanner(frozenset(pending), binary)
+
+            position = start + 1
+
+        return found
+
+    def scan(self, search_strings: List[SearchText], min_end: int = 0) -> ScanResult:
+        """
+        Scan every search string for all registered patterns.
+
+        Matches ending at or before min_end are left out of the result.
+        """
+        result = ScanResult(min_end)
+        satisfied = set()
+
+        for text in search_strings:
+            if not text:
+                continue
+
+            active = [
+                index for index in range(len(self.patterns)) if index not in satisfied
+            ]
+            for index, matches in self.scan_string(text, active, min_end).items():
+                result.add(self.patterns[index], text, matches)
+                if matches and self.first_only[index]:
+                    satisfied.add(index)
+
+        return result
+
+    def scan_string(
+        self, text: SearchText, indexes: List[int], min_end: int = 0
+    ) -> Dict[int, List[re.Match]]:
+        """
+        Scan one string for some of the registered patterns, given by index.
+
+        Returns the matches of each of them, leaving out the ones ending at
+        or before min_end.
+        """
+        found: Dict[int, List[re.Match]] = {}
+        if not text or not indexes:
+            return found
+        for group, scanned in self._plan(indexes, text):
+            found.update(self._scan_group(group, scanned, min_end))
+        return found
+
+    def _plan(
+        self, active: List[int], text: SearchText
+    ) -> List[Tuple[List[int], SearchText]]:
+        """
+        Pair each group of the active patterns with the text it scans.
+
+        Patterns without a bytes form scan bytes through a decoded copy, which
+        is only made if there are any.
+        """
+        if not isinstance(text, bytes):
+            return [(group, text) for group in self._groups(active)]
+
+        native = [
+            index for index in active if bytes_pattern(self.patterns[index]) is not None
+        ]
+        decoded = [index for index in active if index not in native]
+        plan: List[Tuple[List[int], SearchText]] = [
+            (group, text) for group in self._groups(native)
+        ]
+        if decoded:
+            text = text.decode("latin-1")
+            plan.extend((group, text) for group in self._groups(decoded))
+        return plan
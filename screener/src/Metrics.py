@@ -0,0 +1,442 @@
+from abc import ABC, abstractmethod
+import bisect
+import cProfile
+from contextlib import contextmanager
+from dataclasses import fields, is_dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import heapq
+import io
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+"""Latency buckets in seconds, from 100 microseconds to a few seconds"""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class CounterValue:
+    """A single monotonically increasing value"""
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class HistogramValue:
+    """A single distribution of observations over fixed buckets"""
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+class MetricFamily(ABC):
+    """A named metric with a value per combination of label values"""
+
+    type: str = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _new_child(self) -> Any:
+        """A new value for one combination of label values"""
+        pass
+
+    def labels(self, *values: str) -> Any:
+        """
+        The value for the given label values.
+
+        Hot paths should look their value up once and keep it.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    @abstractmethod
+    def _render_child(self, values: Tuple[str, ...], child: Any) -> List[str]:
+        """The exposition lines of the value for some label values"""
+        pass
+
+
+class Counter(MetricFamily):
+    type = "counter"
+
+    def _new_child(self) -> CounterValue:
+        return CounterValue()
+
+    def _render_child(self, values: Tuple[str, ...], child: CounterValue) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"]
+
+
+class Histogram(MetricFamily):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def _render_child(self, values: Tuple[str, ...], child: HistogramValue) -> List[str]:
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+
+        lines = []
+        cumulative = 0
+        names = self.labelnames + ("le",)
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(
+                f"{self.name}_bucket{_format_labels(names, values + (le,))} {cumulative}"
+            )
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(MetricFamily):
+    """A value read from a callback each time the metrics are rendered"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]) -> None:
+        super().__init__(name, help)
+        self.read = read
+
+    def _new_child(self) -> Callable[[], float]:
+        return self.read
+
+    def _render_child(self, values: Tuple[str, ...], child: Callable[[], float]) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {float(child())}"]
+
+    def render(self) -> List[str]:
+        try:
+            lines = self._render_child((), self.read)
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *lines]
+
+
+class MetricsRegistry:
+    """
+    MetricsRegistry holds every metric and renders them in the Prometheus
+    text exposition format.
+
+    Registering a metric that already exists returns the existing one, so
+    modules can declare the metrics they use at import time.
+    """
+
+    def __init__(self) -> None:
+        self._families: Dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, family: MetricFamily) -> Any:
+        with self._lock:
+            return self._families.setdefault(family.name, family)
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        """Register a gauge, replacing any earlier one of the same name"""
+        gauge = Gauge(name, help, read)
+        with self._lock:
+            self._families[name] = gauge
+        return gauge
+
+    def gauges_from_stats(self, prefix: str, stats: Any) -> None:
+        """Expose every field of a stats dataclass as a gauge"""
+        if not is_dataclass(stats):
+            raise TypeError("stats must be a dataclass instance")
+        for field in fields(stats):
+            self.gauge(
+                f"{prefix}_{field.name}",
+                f"{type(stats).__name__}.{field.name}",
+                lambda name=field.name: getattr(stats, name),
+            )
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format"""
+        with self._lock:
+            families = list(self._families.values())
+        lines: List[str] = []
+        for family in families:
+            lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+"""The registry the screeners, executor and writer report to"""
+
+
+SCREENER_CALLS = REGISTRY.counter(
+    "traffic_slice_screener_calls_total", "Times each screener screened a flow", ("screener",)
+)
+SCREENER_BYTES = REGISTRY.counter(
+    "traffic_slice_screener_bytes_scanned_total",
+    "Characters of traffic each screener screened",
+    ("screener",),
+)
+SCREENER_TRIGGERS = REGISTRY.counter(
+    "traffic_slice_screener_triggers_total", "Times each screener triggered", ("screener",)
+)
+SCREENER_SECONDS = REGISTRY.histogram(
+    "traffic_slice_screener_seconds", "Time each screener took per flow", ("screener",)
+)
+FLOW_SECONDS = REGISTRY.histogram(
+    "traffic_slice_flow_seconds", "Time taken to screen a flow with every screener", ("kind",)
+)
+DB_WRITE_SECONDS = REGISTRY.histogram(
+    "traffic_slice_db_write_seconds", "Time taken to commit a batch of alerts"
+)
+DB_BATCH_SIZE = REGISTRY.histogram(
+    "traffic_slice_db_batch_size",
+    "Alerts committed per batch",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+
+
+class MetricsServer:
+    """Serves the metrics of a registry over HTTP on a background thread"""
+
+    def __init__(
+        self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9464
+    ) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics-server", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsSnapshot:
+    """Writes the metrics of a registry to a file every interval seconds"""
+
+    def __init__(self, registry: MetricsRegistry, path: str, interval: float = 15.0) -> None:
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics-snapshot", daemon=True
+        )
+        self._thread.start()
+
+    def write(self) -> None:
+        """Write a snapshot now, replacing the previous one atomically"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.registry.render())
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Failed to write metrics snapshot to {self.path}: {e}")
+
+    def close(self) -> None:
+        """Stop the snapshot thread after writing a final snapshot"""
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.write()
+        except OSError as e:
+            print(f"Failed to write metrics snapshot to {self.path}: {e}")
+
+
+class FlowProfiler:
+    """
+    FlowProfiler runs cProfile on a random sample of flows and keeps the
+    profiles of the slowest ones.
+
+    The profiles of the keep slowest sampled flows are held in memory and,
+    if output_dir is given, written there as .prof files that pstats and
+    snakeviz can read. Flows that are not sampled pay for one random() call.
+    Flows sampled while another is being profiled are screened unprofiled.
+    """
+
+    def __init__(
+        self, sample_rate: float = 0.01, keep: int = 10, output_dir: Optional[str] = None
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.output_dir = output_dir
+        # min-heap of (seconds, flow_id, stats), the fastest kept profile first
+        self._slowest: List[Tuple[float, str, pstats.Stats]] = []
+        self._lock = threading.Lock()
+        # held while a flow is profiled
+        self._profiling = threading.Lock()
+
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+    @contextmanager
+    def profile(self, flow_id: str) -> Iterator[None]:
+        """Profile the enclosed code if this flow is sampled"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield
+            return
+
+        # only one profile can run at a time, and since Python 3.12 only one
+        # in the whole process, so flows sampled while one runs aren't profiled
+        if not self._profiling.acquire(blocking=False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool is active
+            self._profiling.release()
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._profiling.release()
+            self._record(time.perf_counter() - start, flow_id, profiler)
+
+    def _record(self, seconds: float, flow_id: str, profiler: cProfile.Profile) -> None:
+        with self._lock:
+            if len(self._slowest) >= self.keep and seconds <= self._slowest[0][0]:
+                return
+            stats = pstats.Stats(profiler)
+            entry = (seconds, flow_id, stats)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+                evicted = None
+            else:
+                evicted = heapq.heapreplace(self._slowest, entry)
+
+        if self.output_dir:
+            stats.dump_stats(self._path(flow_id))
+            if evicted is not None:
+                try:
+                    os.unlink(self._path(evicted[1]))
+                except OSError:
+                    pass
+
+    def _path(self, flow_id: str) -> str:
+        return os.path.join(self.output_dir or ".", f"flow-{flow_id}.prof")
+
+    def slowest(self) -> List[Tuple[float, str]]:
+        """(seconds, flow id) of the kept profiles, slowest first"""
+        with self._lock:
+            return [(seconds, flow_id) for seconds, flow_id, _ in sorted(self._slowest, reverse=True)]
+
+    def report(self, limit: int = 15) -> str:
+        """The top functions by cumulative time of the slowest kept profile"""
+        with self._lock:
+            if not self._slowest:
+                return "No flows profiled"
+            seconds, flow_id, stats = max(self._slowest, key=lambda entry: entry[0])
+        output = io.StringIO()
+        stats.stream = output  # type: ignore[attr-defined]
+        stats.sort_stats("cumulative").print_stats(limit)
+        return f"Slowest profiled flow {flow_id} took {seconds:.4f}s\n{output.getvalue()}"
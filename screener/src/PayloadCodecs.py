@@ -0,0 +1,158 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+import threading
+from typing import Dict, List, Optional, Tuple
+import zlib
+
+try:
+    import zstandard  # optional, compresses better and faster than zlib
+except ImportError:
+    zstandard = None
+
+
+class PayloadCodec(ABC):
+    """
+    A way of compressing stored payloads.
+
+    The name of the codec is stored with every payload compressed with it,
+    so it must never change once payloads have been written. Codecs can
+    compress with a shared dictionary trained from earlier payloads, which
+    matters for the small, repetitive JSON most traffic carries.
+    """
+
+    name: str
+
+    @abstractmethod
+    def compress(self, content: bytes, dictionary: Optional[bytes] = None) -> bytes:
+        """Compress a payload, with the dictionary it was trained with if any"""
+        pass
+
+    @abstractmethod
+    def decompress(self, content: bytes, dictionary: Optional[bytes] = None) -> bytes:
+        """Decompress a payload with the dictionary it was compressed with"""
+        pass
+
+    @abstractmethod
+    def train(self, samples: List[bytes], size: int) -> bytes:
+        """Build a dictionary of at most size bytes from sample payloads"""
+        pass
+
+
+class ZlibCodec(PayloadCodec):
+    """Deflate from the standard library, always available"""
+
+    name = "zlib"
+
+    MAX_DICTIONARY_SIZE = 32 * 1024
+    """Deflate can only refer back this far, so larger dictionaries are cut"""
+
+    SEGMENT_SIZE = 32
+    """The length of the substrings dictionaries are built from"""
+
+    def __init__(self, level: int = 6) -> None:
+        self.level = level
+
+    def compress(self, content: bytes, dictionary: Optional[bytes] = None) -> bytes:
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(content) + compressor.flush()
+
+    def decompress(self, content: bytes, dictionary: Optional[bytes] = None) -> bytes:
+        if dictionary:
+            decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(content) + decompressor.flush()
+
+    def train(self, samples: List[bytes], size: int) -> bytes:
+        """
+        Keep the substrings shared by the most samples.
+
+        The most common come last, where deflate refers to them most cheaply.
+        """
+        size = min(size, self.MAX_DICTIONARY_SIZE)
+        step = self.SEGMENT_SIZE // 2
+        counts: Counter = Counter()
+        for sample in samples:
+            counts.update(
+                {sample[i : i + self.SEGMENT_SIZE] for i in range(0, len(sample) - step, step)}
+            )
+
+        chosen: List[bytes] = []
+        total = 0
+        for segment, count in counts.most_common():
+            if count < 2 or total + len(segment) > size:
+                break
+            chosen.append(segment)
+            total += len(segment)
+        return b"".join(reversed(chosen))
+
+
+class ZstdCodec(PayloadCodec):
+    """Zstandard, when the zstandard package is installed"""
+
+    name = "zstd"
+
+    def __init__(self, level: int = 3) -> None:
+        self.level = level
+        # compressors are not thread safe and loading a dictionary is not free
+        self._local = threading.local()
+
+    def _cached(self, kind: str, dictionary: Optional[bytes]):
+        cache: Dict[Tuple[str, Optional[bytes]], object] = self._local.__dict__.setdefault(
+            "cache", {}
+        )
+        key = (kind, dictionary)
+        found = cache.get(key)
+        if found is None:
+            data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            if kind == "compress":
+                found = zstandard.ZstdCompressor(level=self.level, dict_data=data)
+            else:
+                found = zstandard.ZstdDecompressor(dict_data=data)
+            if len(cache) >= 8:
+                cache.clear()
+            cache[key] = found
+        return found
+
+    def compress(self, content: bytes, dictionary: Optional[bytes] = None) -> bytes:
+        return self._cached("compress", dictionary).compress(content)
+
+    def decompress(self, content: bytes, dictionary: Optional[bytes] = None) -> bytes:
+        return self._cached("decompress", dictionary).decompress(content)
+
+    def train(self, samples: List[bytes], size: int) -> bytes:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+PAYLOAD_CODECS: Dict[str, PayloadCodec] = {"zlib": ZlibCodec()}
+"""The codecs available, by the name stored with the payloads they compress"""
+
+if zstandard is not None:
+    PAYLOAD_CODECS["zstd"] = ZstdCodec()
+
+
+DEFAULT_CODEC = "zstd" if zstandard is not None else "zlib"
+"""The best codec available"""
+
+
+def get_codec(name: str) -> PayloadCodec:
+    """The codec of a name, failing clearly when it is not installed"""
+    codec = PAYLOAD_CODECS.get(name)
+    if codec is None:
+        raise ValueError(
+            f"Payloads compressed with {name!r} can't be read, "
+            f"available codecs are {list(PAYLOAD_CODECS)}"
+        )
+    return codec
+
+
+def decode_payload(
+    content: Optional[bytes], codec: Optional[str], dictionary: Optional[bytes] = None
+) -> Optional[bytes]:
+    """The original bytes of a stored payload, codec being None for one stored as is"""
+    if content is None or codec is None:
+        return content
+    return get_codec(codec).decompress(content, dictionary)
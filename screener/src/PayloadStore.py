@@ -0,0 +1,451 @@
+import hashlib
+import sqlite3
+from typing import List, Optional, Tuple
+
+from PayloadCodecs import PayloadCodec, decode_payload, get_codec
+from SqlScript import execute_script
+
+
+PAYLOAD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payload_blobs (
+    hash TEXT PRIMARY KEY,
+    content BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_http_requests_payload_hash ON http_requests(payload_hash);
+CREATE INDEX IF NOT EXISTS idx_tcp_messages_payload_hash ON tcp_messages(payload_hash);
+
+CREATE VIEW IF NOT EXISTS http_requests_with_content AS
+SELECT
+    r.id, r.flow_id, r.url, r.method, r.headers,
+    COALESCE(CAST(b.content AS TEXT), r.request_content) AS request_content,
+    r.timestamp
+FROM http_requests r
+LEFT JOIN payload_blobs b ON b.hash = r.payload_hash;
+
+CREATE VIEW IF NOT EXISTS tcp_messages_with_content AS
+SELECT
+    m.id, m.flow_id, m.client_host, m.client_port, m.server_host, m.server_port,
+    COALESCE(b.content, m.message_content) AS message_content,
+    m.timestamp
+FROM tcp_messages m
+LEFT JOIN payload_blobs b ON b.hash = m.payload_hash;
+"""
+"""The payload blob table and the views that read payloads through it"""
+
+
+COMPRESSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payload_dictionaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    codec TEXT NOT NULL,
+    content BLOB NOT NULL,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+"""
+"""The dictionaries payloads are compressed with"""
+
+PAYLOAD_VIEWS = """
+DROP VIEW IF EXISTS http_requests_with_content;
+CREATE VIEW http_requests_with_content AS
+SELECT
+    r.id, r.flow_id, r.url, r.method, r.headers,
+    CASE WHEN b.hash IS NULL THEN r.request_content
+        WHEN b.codec IS NULL THEN CAST(b.content AS TEXT) END AS request_content,
+    b.codec AS payload_codec,
+    r.timestamp
+FROM http_requests r
+LEFT JOIN payload_blobs b ON b.hash = r.payload_hash;
+
+DROP VIEW IF EXISTS tcp_messages_with_content;
+CREATE VIEW tcp_messages_with_content AS
+SELECT
+    m.id, m.flow_id, m.client_host, m.client_port, m.server_host, m.server_port,
+    CASE WHEN b.hash IS NULL THEN m.message_content
+        WHEN b.codec IS NULL THEN b.content END AS message_content,
+    b.codec AS payload_codec,
+    m.timestamp
+FROM tcp_messages m
+LEFT JOIN payload_blobs b ON b.hash = m.payload_hash;
+"""
+"""
+Views that read payloads wherever they are stored, in plain SQL so any
+SQLite client can query them. The content of a compressed payload is NULL,
+with its codec in payload_codec, and is read with read_http_request_content
+or read_tcp_message_content instead
+"""
+
+DECODED_HTTP_REQUESTS = """
+SELECT
+    r.id, r.flow_id, r.url, r.method, r.headers,
+    COALESCE(CAST(payload_content(b.content, b.codec, d.content) AS TEXT), r.request_content) AS request_content,
+    r.timestamp
+FROM http_requests r
+LEFT JOIN payload_blobs b ON b.hash = r.payload_hash
+LEFT JOIN payload_dictionaries d ON d.id = b.dictionary_id
+"""
+"""
+The HTTP requests with their payloads decompressed, for connections that
+called register_payload_functions
+"""
+
+DECODED_TCP_MESSAGES = """
+SELECT
+    m.id, m.flow_id, m.client_host, m.client_port, m.server_host, m.server_port,
+    COALESCE(payload_content(b.content, b.codec, d.content), m.message_content) AS message_content,
+    m.timestamp
+FROM tcp_messages m
+LEFT JOIN payload_blobs b ON b.hash = m.payload_hash
+LEFT JOIN payload_dictionaries d ON d.id = b.dictionary_id
+"""
+"""
+The TCP messages with their payloads decompressed, for connections that
+called register_payload_functions
+"""
+
+
+def payload_hash(content: bytes) -> str:
+    """The content address of a payload"""
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def encode_text(text: str) -> bytes:
+    """Encode request text for storage, keeping any undecodable bytes intact"""
+    return text.encode("utf-8", "surrogateescape")
+
+
+def decode_text(content: bytes) -> str:
+    """The inverse of encode_text"""
+    return content.decode("utf-8", "surrogateescape")
+
+
+def _columns(cursor: sqlite3.Cursor, table: str) -> List[str]:
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+def ensure_payload_store(connection: sqlite3.Connection) -> None:
+    """
+    Add the payload blob table and payload_hash columns if they are missing.
+
+    Cheap and safe to call on every connect. Existing rows keep their inline
+    content until backfill_payload_store moves it. Runs in the transaction
+    of the caller, which commits it.
+    """
+    cursor = connection.cursor()
+    if "payload_hash" not in _columns(cursor, "http_requests"):
+        cursor.execute(
+            "ALTER TABLE http_requests ADD COLUMN payload_hash TEXT REFERENCES payload_blobs(hash)"
+        )
+    if "payload_hash" not in _columns(cursor, "tcp_messages"):
+        cursor.execute(
+            "ALTER TABLE tcp_messages ADD COLUMN payload_hash TEXT REFERENCES payload_blobs(hash)"
+        )
+    execute_script(connection, PAYLOAD_SCHEMA)
+
+
+def ensure_payload_compression(connection: sqlite3.Connection) -> None:
+    """
+    Add the codec columns and dictionary table if they are missing, and
+    leave compressed payloads out of the views.
+
+    Cheap and safe to call on every connect. Existing payloads have no codec
+    and are read as they are. Runs in the transaction of the caller, which
+    commits it.
+    """
+    cursor = connection.cursor()
+    columns = _columns(cursor, "payload_blobs")
+    if "codec" not in columns:
+        cursor.execute("ALTER TABLE payload_blobs ADD COLUMN codec TEXT")
+    if "dictionary_id" not in columns:
+        cursor.execute(
+            "ALTER TABLE payload_blobs ADD COLUMN dictionary_id INTEGER REFERENCES payload_dictionaries(id)"
+        )
+    execute_script(connection, COMPRESSION_SCHEMA)
+    execute_script(connection, PAYLOAD_VIEWS)
+
+
+def register_payload_functions(connection: sqlite3.Connection) -> None:
+    """
+    Let the SQL of a connection decompress payloads with
+    payload_content(content, codec, dictionary), as DECODED_HTTP_REQUESTS
+    and DECODED_TCP_MESSAGES do
+    """
+    connection.create_function("payload_content", 3, decode_payload, deterministic=True)
+
+
+class PayloadCompressor:
+    """
+    PayloadCompressor compresses the payloads a writer stores.
+
+    Payloads smaller than min_size, and ones that don't get any smaller, are
+    stored as they are. The codec, and the dictionary if one is used, are
+    stored with every payload so it can always be read back.
+    """
+
+    codec: PayloadCodec
+    """How payloads are compressed"""
+
+    dictionary_id: Optional[int]
+    """The ID of the dictionary in payload_dictionaries, None to compress without one"""
+
+    dictionary: Optional[bytes]
+
+    min_size: int
+    """Payloads smaller than this are not worth compressing"""
+
+    compressed: int
+    """The number of payloads compressed so far"""
+
+    def __init__(
+        self,
+        codec: PayloadCodec,
+        dictionary_id: Optional[int] = None,
+        dictionary: Optional[bytes] = None,
+        min_size: int = 64,
+    ) -> None:
+        self.codec = codec
+        self.dictionary_id = dictionary_id
+        self.dictionary = dictionary
+        self.min_size = min_size
+        self.compressed = 0
+
+    def compress(self, content: bytes) -> Tuple[bytes, Optional[str], Optional[int]]:
+        """The bytes to store for a payload, with their codec and dictionary ID"""
+        if len(content) < self.min_size:
+            return content, None, None
+        compressed = self.codec.compress(content, self.dictionary)
+        if len(compressed) >= len(content):
+            return content, None, None
+        self.compressed += 1
+        return compressed, self.codec.name, self.dictionary_id
+
+
+def load_payload_compressor(
+    connection: sqlite3.Connection, codec: str, min_size: int = 64
+) -> PayloadCompressor:
+    """A compressor for a codec using the newest dictionary trained for it, if any"""
+    row = connection.execute(
+        "SELECT id, content FROM payload_dictionaries WHERE codec = ? ORDER BY id DESC LIMIT 1",
+        (codec,),
+    ).fetchone()
+    if row is None:
+        return PayloadCompressor(get_codec(codec), min_size=min_size)
+    return PayloadCompressor(get_codec(codec), row[0], row[1], min_size=min_size)
+
+
+def train_payload_dictionary(
+    connection: sqlite3.Connection,
+    codec: str,
+    size: int = 64 * 1024,
+    sample_count: int = 2000,
+) -> int:
+    """
+    Train a dictionary for a codec from the newest stored payloads and keep
+    it in payload_dictionaries. Returns its ID.
+    """
+    rows = connection.execute(
+        """
+        SELECT b.content, b.codec, d.content
+        FROM payload_blobs b
+        LEFT JOIN payload_dictionaries d ON d.id = b.dictionary_id
+        ORDER BY b.rowid DESC
+        LIMIT ?
+        """,
+        (sample_count,),
+    ).fetchall()
+    samples = [decode_payload(content, name, dictionary) for content, name, dictionary in rows]
+    dictionary = get_codec(codec).train([sample for sample in samples if sample], size)
+
+    with connection:
+        cursor = connection.execute(
+            "INSERT INTO payload_dictionaries (codec, content) VALUES (?, ?)",
+            (codec, dictionary),
+        )
+    return cursor.lastrowid
+
+
+def store_payload(
+    cursor: sqlite3.Cursor,
+    content: Optional[bytes],
+    compressor: Optional[PayloadCompressor] = None,
+) -> Optional[str]:
+    """
+    Store a payload once and return its hash, or None if there is no payload.
+
+    The hash is of the original bytes, so a payload is only compressed the
+    first time it is seen.
+    """
+    if content is None:
+        return None
+
+    content_hash = payload_hash(content)
+    if compressor is None:
+        cursor.execute(
+            "INSERT OR IGNORE INTO payload_blobs (hash, content, size) VALUES (?, ?, ?)",
+            (content_hash, content, len(content)),
+        )
+        return content_hash
+
+    if cursor.execute("SELECT 1 FROM payload_blobs WHERE hash = ?", (content_hash,)).fetchone():
+        return content_hash
+    stored, codec, dictionary_id = compressor.compress(content)
+    cursor.execute(
+        """
+        INSERT INTO payload_blobs (hash, content, size, codec, dictionary_id)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (content_hash, stored, len(content), codec, dictionary_id),
+    )
+    return content_hash
+
+
+def read_http_request_content(
+    connection: sqlite3.Connection, http_request_id: int
+) -> Optional[str]:
+    """Read the body of a stored HTTP request, wherever it is stored"""
+    row = connection.execute(
+        """
+        SELECT b.content, b.codec, d.content, r.request_content
+        FROM http_requests r
+        LEFT JOIN payload_blobs b ON b.hash = r.payload_hash
+        LEFT JOIN payload_dictionaries d ON d.id = b.dictionary_id
+        WHERE r.id = ?
+        """,
+        (http_request_id,),
+    ).fetchone()
+    if row is None:
+        return None
+
+    blob, codec, dictionary, inline = row
+    return decode_text(decode_payload(blob, codec, dictionary)) if blob is not None else inline
+
+
+def read_tcp_message_content(
+    connection: sqlite3.Connection, tcp_message_id: int
+) -> Optional[bytes]:
+    """Read the content of a stored TCP message, wherever it is stored"""
+    row = connection.execute(
+        """
+        SELECT b.content, b.codec, d.content, m.message_content
+        FROM tcp_messages m
+        LEFT JOIN payload_blobs b ON b.hash = m.payload_hash
+        LEFT JOIN payload_dictionaries d ON d.id = b.dictionary_id
+        WHERE m.id = ?
+        """,
+        (tcp_message_id,),
+    ).fetchone()
+    if row is None:
+        return None
+
+    blob, codec, dictionary, inline = row
+    return decode_payload(blob, codec, dictionary) if blob is not None else inline
+
+
+def backfill_payload_store(
+    connection: sqlite3.Connection,
+    batch_size: int = 500,
+    compressor: Optional[PayloadCompressor] = None,
+) -> int:
+    """
+    Move inline payloads of existing rows into the blob table, compressing
+    them with compressor if one is given.
+
+    Works in batches so a large database is never locked for long.
+    Returns the number of rows moved.
+    """
+    with connection:
+        ensure_payload_store(connection)
+
+    moved = 0
+    for table, column, is_text in (
+        ("http_requests", "request_content", True),
+        ("tcp_messages", "message_content", False),
+    ):
+        while True:
+            with connection:
+                cursor = connection.cursor()
+                rows = cursor.execute(
+                    f"""
+                    SELECT id, {column} FROM {table}
+                    WHERE payload_hash IS NULL AND {column} IS NOT NULL
+                    LIMIT ?
+                    """,
+                    (batch_size,),
+                ).fetchall()
+                if not rows:
+                    break
+
+                for row_id, content in rows:
+                    if is_text and isinstance(content, str):
+                        content = encode_text(content)
+                    elif isinstance(content, str):
+                        content = content.encode("utf-8")
+                    cursor.execute(
+                        f"UPDATE {table} SET payload_hash = ?, {column} = NULL WHERE id = ?",
+                        (store_payload(cursor, content, compressor), row_id),
+                    )
+                moved += len(rows)
+
+    return moved
+
+
+def recompress_payloads(
+    connection: sqlite3.Connection, compressor: PayloadCompressor, batch_size: int = 500
+) -> int:
+    """
+    Compress the stored payloads again with a compressor and its dictionary,
+    including the ones stored as they are.
+
+    Payloads that end up stored as they are, being too small or not
+    compressible, are not counted. Works in batches so a large database is
+    never locked for long. Returns the number of payloads recompressed.
+    """
+    recompressed = 0
+    last = 0
+    while True:
+        with connection:
+            cursor = connection.cursor()
+            rows = cursor.execute(
+                """
+                SELECT b.rowid, b.content, b.codec, d.content
+                FROM payload_blobs b
+                LEFT JOIN payload_dictionaries d ON d.id = b.dictionary_id
+                WHERE b.rowid > ?
+                AND (b.codec IS NULL OR b.codec != ? OR b.dictionary_id IS NOT ?)
+                ORDER BY b.rowid
+                LIMIT ?
+                """,
+                (last, compressor.codec.name, compressor.dictionary_id, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+
+            for rowid, content, codec, dictionary in rows:
+                stored, new_codec, dictionary_id = compressor.compress(
+                    decode_payload(content, codec, dictionary)
+                )
+                if new_codec is None and codec is None:
+                    continue
+                cursor.execute(
+                    "UPDATE payload_blobs SET content = ?, codec = ?, dictionary_id = ? WHERE rowid = ?",
+                    (stored, new_codec, dictionary_id, rowid),
+                )
+                if new_codec is not None:
+                    recompressed += 1
+            last = rows[-1][0]
+
+    return recompressed
+
+
+def delete_orphaned_payloads(connection: sqlite3.Connection) -> int:
+    """Delete blobs that no stored request or message points to"""
+    with connection:
+        cursor = connection.execute(
+            """
+            DELETE FROM payload_blobs
+            WHERE hash NOT IN (SELECT payload_hash FROM http_requests WHERE payload_hash IS NOT NULL)
+            AND hash NOT IN (SELECT payload_hash FROM tcp_messages WHERE payload_hash IS NOT NULL)
+            """
+        )
+    return cursor.rowcount
@@ -0,0 +1,299 @@
+import contextlib
+from dataclasses import dataclass
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional
+import zlib
+
+from mitmproxy import exceptions, flow, io as mitmproxy_io, tcp
+from mitmproxy.io import compat, tnetstring
+
+from AlertCollector import AlertCollector
+from AlertRecord import AlertRecord
+from AlertWriter import AlertWriter
+from AllScreenersCombined import AllScreenersCombined
+
+
+SHARD_BY_HOST = "host"
+SHARD_ROUND_ROBIN = "round-robin"
+
+FlowState = Dict[str, Any]
+
+
+@dataclass
+class ReplayStats:
+    """Counters describing a replay"""
+
+    files: int = 0
+    """Dumps read"""
+
+    flows: int = 0
+    """HTTP and TCP flows screened"""
+
+    skipped: int = 0
+    """Flows of other types, such as UDP or DNS, that were not screened"""
+
+    alerts: int = 0
+    """Alerts raised and handed to the writer"""
+
+    seconds: float = 0.0
+    """Wall clock time of the replay"""
+
+
+def read_flow_states(fo: BinaryIO) -> Iterator[FlowState]:
+    """
+    Stream the states of the flows in a dump, one at a time.
+
+    The same as mitmproxy's FlowReader, except that flows are not built from
+    their state, which is left to the worker that screens them. HAR files are
+    read with FlowReader, since they are not stored as states.
+    """
+    reader = mitmproxy_io.FlowReader(fo)
+    if reader.peek(4).startswith((b"{", b"\xef\xbb\xbf{")):
+        for har_flow in reader.stream():
+            yield har_flow.get_state()
+        return
+
+    try:
+        while True:
+            yield compat.migrate_flow(tnetstring.load(fo))
+    except (ValueError, TypeError, IndexError) as e:
+        if str(e) == "not a tnetstring: empty file":
+            return  # Error is due to EOF
+        raise exceptions.FlowReadException("Invalid data format.") from e
+
+
+def shard_key(state: FlowState) -> str:
+    """The server a flow went to, so flows of the same host share a worker"""
+    if state["type"] == "http":
+        return state["request"]["host"]
+    address = state["server_conn"].get("address")
+    return f"{address[0]}:{address[1]}" if address else ""
+
+
+def replay_flow(addon: AllScreenersCombined, state: FlowState) -> None:
+    """Screen a flow the way mitmproxy would have hooked it when it was captured"""
+    replayed = flow.Flow.from_state(state)
+    if isinstance(replayed, tcp.TCPFlow):
+        messages, replayed.messages = replayed.messages, []
+        for message in messages:
+            replayed.messages.append(message)
+            addon.tcp_message(replayed)
+        addon.tcp_end(replayed)
+    else:
+        addon.request(replayed)
+
+
+def _replay_worker(
+    inbox: "multiprocessing.Queue[Optional[List[FlowState]]]",
+    results: "multiprocessing.Queue[Optional[List[AlertRecord]]]",
+    addon_options: Dict[str, Any],
+    quiet: bool,
+) -> None:
+    """Screen batches of flow states until a None arrives, sending back the alerts"""
+    collector = AlertCollector()
+    output = open(os.devnull, "w") if quiet else None
+    try:
+        with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+            addon = AllScreenersCombined(alert_sink=collector, **addon_options)
+            while True:
+                batch = inbox.get()
+                if batch is None:
+                    break
+                for state in batch:
+                    replay_flow(addon, state)
+                results.put(collector.take())
+            addon.done()
+    finally:
+        results.put(None)
+        if output:
+            output.close()
+
+
+class Replay:
+    """
+    Replay screens mitmproxy flow dumps offline, on a pool of processes.
+
+    Dumps are read as a stream and their flows handed to the workers in
+    batches over bounded queues, so memory stays flat however large the
+    dumps are. Each worker has its own AllScreenersCombined, which collects
+    the alerts it raises instead of writing them. The alerts are sent back
+    and merged into the database by a single AlertWriter in large batches.
+
+    Flows are sharded by host by default. Each host then goes to one worker,
+    in capture order, so rate based screeners such as TimestampScreener see
+    the same traffic they would have seen live. Round-robin sharding spreads
+    the load more evenly when a few hosts dominate, at the cost of splitting
+    those rates across workers.
+
+    Alerts are stamped with the time the traffic was captured, not the time
+    it was replayed, and repeats are coalesced by the same capture times.
+    """
+
+    database_path: str
+    """The database the alerts are merged into"""
+
+    workers: int
+    """The number of worker processes"""
+
+    batch_size: int
+    """The number of flows handed to a worker at once"""
+
+    shard: str
+    """How flows are spread over the workers, SHARD_BY_HOST or SHARD_ROUND_ROBIN"""
+
+    stats: ReplayStats
+    """Counters of the last replay"""
+
+    def __init__(
+        self,
+        database_path: str,
+        workers: Optional[int] = None,
+        batch_size: int = 64,
+        shard: str = SHARD_BY_HOST,
+        queued_batches: int = 4,
+        write_batch_size: int = 1000,
+        suppression_window: Optional[float] = 600.0,
+        quiet: bool = True,
+        addon_options: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Args:
+            database_path: The database the alerts are merged into
+            workers: The number of worker processes, one per CPU by default
+            batch_size: The number of flows handed to a worker at once
+            shard: "host" or "round-robin"
+            queued_batches: The number of batches waiting per worker at most
+            write_batch_size: The number of alerts written per transaction
+            suppression_window: The number of seconds repeats of an alert are
+                coalesced for, None to write every alert
+            quiet: Whether to silence the per alert output of the workers
+            addon_options: Extra arguments for the AllScreenersCombined of
+                each worker, such as secret_sources or tcp_carry_size
+        """
+        if shard not in (SHARD_BY_HOST, SHARD_ROUND_ROBIN):
+            raise ValueError(f"Unknown sharding: {shard}")
+
+        self.database_path = database_path
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.shard = shard
+        self.queued_batches = queued_batches
+        self.write_batch_size = write_batch_size
+        self.suppression_window = suppression_window
+        self.quiet = quiet
+        self.addon_options = addon_options or {}
+        self.stats = ReplayStats()
+
+    def run(self, paths: Iterable[str]) -> ReplayStats:
+        """Replay every flow of the dumps at paths"""
+        self.stats = ReplayStats()
+        started = time.perf_counter()
+
+        # spawn, so workers do not inherit the threads and connections of the parent
+        context = multiprocessing.get_context("spawn")
+        inboxes = [context.Queue(maxsize=self.queued_batches) for _ in range(self.workers)]
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_replay_worker,
+                args=(inbox, results, self.addon_options, self.quiet),
+                name=f"replay-{index}",
+                daemon=True,
+            )
+            for index, inbox in enumerate(inboxes)
+        ]
+        for process in processes:
+            process.start()
+
+        writer = AlertWriter(
+            self.database_path,
+            batch_size=self.write_batch_size,
+            put_timeout=None,
+            suppression_window=self.suppression_window,
+        )
+        merger = threading.Thread(
+            target=self._merge, args=(results, processes, writer), name="replay-merge"
+        )
+        merger.start()
+
+        try:
+            pending: List[List[FlowState]] = [[] for _ in range(self.workers)]
+            for state in self._states(paths):
+                index = self._worker_for(state)
+                pending[index].append(state)
+                if len(pending[index]) >= self.batch_size:
+                    self._hand_over(inboxes[index], processes[index], pending[index])
+                    pending[index] = []
+            for index, batch in enumerate(pending):
+                if batch:
+                    self._hand_over(inboxes[index], processes[index], batch)
+        finally:
+            for inbox, process in zip(inboxes, processes):
+                if process.is_alive():
+                    self._hand_over(inbox, process, None)
+            merger.join()
+            for process in processes:
+                process.join()
+            writer.close()
+
+        self.stats.seconds = time.perf_counter() - started
+        return self.stats
+
+    def _states(self, paths: Iterable[str]) -> Iterator[FlowState]:
+        """The states of the HTTP and TCP flows of every dump, in order"""
+        for path in paths:
+            self.stats.files += 1
+            with open(path, "rb") as fo:
+                for state in read_flow_states(fo):
+                    if state.get("type") not in ("http", "tcp"):
+                        self.stats.skipped += 1
+                        continue
+                    self.stats.flows += 1
+                    yield state
+
+    def _worker_for(self, state: FlowState) -> int:
+        if self.shard == SHARD_ROUND_ROBIN:
+            return self.stats.flows % self.workers
+        # crc32 rather than hash, which is salted per process
+        return zlib.crc32(shard_key(state).encode("utf-8", "surrogateescape")) % self.workers
+
+    def _hand_over(
+        self,
+        inbox: "multiprocessing.Queue[Optional[List[FlowState]]]",
+        process: multiprocessing.process.BaseProcess,
+        batch: Optional[List[FlowState]],
+    ) -> None:
+        """Put a batch on a worker's queue, waiting while the queue is full"""
+        while True:
+            try:
+                inbox.put(batch, timeout=1.0)
+                return
+            except queue.Full:
+                if not process.is_alive():
+                    raise RuntimeError(f"Replay worker {process.name} stopped unexpectedly")
+
+    def _merge(
+        self,
+        results: "multiprocessing.Queue[Optional[List[AlertRecord]]]",
+        processes: List[multiprocessing.process.BaseProcess],
+        writer: AlertWriter,
+    ) -> None:
+        """Hand the alerts of every worker to the writer until all have finished"""
+        running = len(processes)
+        while running:
+            try:
+                result = results.get(timeout=1.0)
+            except queue.Empty:
+                # a worker that crashed never sends its None
+                running = min(running, sum(process.is_alive() for process in processes))
+                continue
+            if result is None:
+                running -= 1
+                continue
+            for record in result:
+                writer.submit(record)
+            self.stats.alerts += len(result)
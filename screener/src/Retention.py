@@ -0,0 +1,418 @@
+from dataclasses import dataclass
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from AlertWriter import format_timestamp
+from Database import close_database, connect_database
+from PayloadStore import DECODED_HTTP_REQUESTS, DECODED_TCP_MESSAGES
+
+
+@dataclass(frozen=True)
+class RetainedTable:
+    """A table whose rows expire, and what goes with them"""
+
+    name: str
+
+    source: str
+    """What the rows are archived from, a query that inlines the decompressed payloads of traffic"""
+
+    links: Tuple[Tuple[str, str], ...]
+    """The (junction table, column) pairs whose rows point to the table's rows"""
+
+    has_payloads: bool = False
+
+
+RETAINED_TABLES: Dict[str, RetainedTable] = {
+    "alerts": RetainedTable(
+        "alerts",
+        "SELECT * FROM alerts",
+        (("alert_http_requests", "alert_id"), ("alert_tcp_messages", "alert_id")),
+    ),
+    "http_requests": RetainedTable(
+        "http_requests",
+        DECODED_HTTP_REQUESTS,
+        (("alert_http_requests", "http_request_id"),),
+        has_payloads=True,
+    ),
+    "tcp_messages": RetainedTable(
+        "tcp_messages",
+        DECODED_TCP_MESSAGES,
+        (("alert_tcp_messages", "tcp_message_id"),),
+        has_payloads=True,
+    ),
+}
+"""The tables retention applies to"""
+
+
+PARTITIONS: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    "day": ((), "+1 day"),
+    "week": (("-6 days", "weekday 1"), "+7 days"),
+}
+"""
+The date() modifiers that take a timestamp to the start of its partition,
+and the length of a partition. Weeks start on Monday
+"""
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    How long rows are kept in the live database.
+
+    The ages are in days, None keeping the table's rows forever. Rows
+    expire a whole partition at a time, once every row of the partition is
+    older than the table's age, so every day or week is archived to a
+    single file.
+    """
+
+    alerts_days: Optional[float] = 90.0
+
+    http_requests_days: Optional[float] = 30.0
+
+    tcp_messages_days: Optional[float] = 30.0
+
+    partition: str = "day"
+    """How expired rows are grouped, by day or by week"""
+
+    archive_dir: Optional[str] = None
+    """Where expired partitions are archived, None to delete them outright"""
+
+    def __post_init__(self) -> None:
+        if self.partition not in PARTITIONS:
+            raise ValueError(f"Unknown partition {self.partition!r}, expected one of {list(PARTITIONS)}")
+
+    def days(self, table: str) -> Optional[float]:
+        """The number of days the rows of a table are kept"""
+        return getattr(self, f"{table}_days")
+
+
+@dataclass
+class RetentionStats:
+    """Counters describing what retention has done"""
+
+    runs: int = 0
+    """Passes over the database completed"""
+
+    failed_runs: int = 0
+    """Passes that stopped on an error"""
+
+    archived_partitions: int = 0
+    """Partitions written to archive files"""
+
+    deleted_rows: int = 0
+    """Expired rows deleted from the live database, junction rows not included"""
+
+    deleted_payloads: int = 0
+    """Payload blobs deleted once nothing pointed to them"""
+
+    vacuumed_pages: int = 0
+    """Free pages given back to the file system"""
+
+
+def _partition_start(partition: str, timestamp: str) -> str:
+    """The SQL expression for the start of the partition of a timestamp expression"""
+    modifiers, _ = PARTITIONS[partition]
+    return "date(" + ", ".join([timestamp] + [f"'{modifier}'" for modifier in modifiers]) + ")"
+
+
+def expired_partitions(
+    connection: sqlite3.Connection, table: str, days: float, partition: str, now: float
+) -> List[Tuple[str, str]]:
+    """
+    The (start, end) of the partitions of a table whose rows are all older
+    than days, oldest first
+    """
+    _, length = PARTITIONS[partition]
+    # rows before the start of the partition the cutoff falls in have expired
+    cutoff = connection.execute(
+        f"SELECT {_partition_start(partition, '?')}", (format_timestamp(now - days * 86400),)
+    ).fetchone()[0]
+    rows = connection.execute(
+        f"""
+        SELECT DISTINCT {_partition_start(partition, 'timestamp')}
+        FROM {table}
+        WHERE timestamp < ?
+        ORDER BY 1
+        """,
+        (cutoff,),
+    ).fetchall()
+    return [
+        (first, connection.execute("SELECT date(?, ?)", (first, length)).fetchone()[0])
+        for (first,) in rows
+        if first is not None
+    ]
+
+
+def _archive_path(archive_dir: str, table: str, start: str) -> str:
+    """A file name for the archive of a partition that is not taken yet"""
+    path = os.path.join(archive_dir, f"{table}-{start}.sqlite.gz")
+    suffix = 1
+    # rows that arrive after their partition was archived get a file of their own
+    while os.path.exists(path):
+        path = os.path.join(archive_dir, f"{table}-{start}-{suffix}.sqlite.gz")
+        suffix += 1
+    return path
+
+
+def archive_partition(
+    connection: sqlite3.Connection, table: str, start: str, end: str, archive_dir: str
+) -> str:
+    """
+    Copy the rows of a partition of a table to a gzipped SQLite file.
+
+    Traffic is archived with its payloads inlined and rows of the junction
+    tables that point to the partition's rows are archived with them, so
+    each archive can be read on its own. Returns the path of the archive.
+    """
+    retained = RETAINED_TABLES[table]
+    os.makedirs(archive_dir, exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=archive_dir, prefix=f".{table}-{start}-", suffix=".sqlite")
+    os.close(fd)
+    try:
+        connection.execute("ATTACH DATABASE ? AS archive", (partial,))
+        try:
+            with connection:
+                connection.execute(
+                    f"""
+                    CREATE TABLE archive.{table} AS
+                    SELECT * FROM ({retained.source})
+                    WHERE timestamp >= ? AND timestamp < ?
+                    """,
+                    (start, end),
+                )
+                for link, column in retained.links:
+                    connection.execute(
+                        f"""
+                        CREATE TABLE archive.{link} AS
+                        SELECT * FROM main.{link}
+                        WHERE {column} IN (SELECT id FROM archive.{table})
+                        """
+                    )
+        finally:
+            connection.execute("DETACH DATABASE archive")
+
+        path = _archive_path(archive_dir, table, start)
+        with open(partial, "rb") as source, gzip.open(path + ".partial", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.replace(path + ".partial", path)
+        return path
+    finally:
+        os.unlink(partial)
+
+
+def delete_partition(
+    connection: sqlite3.Connection,
+    table: str,
+    start: str,
+    end: str,
+    batch_size: int = 500,
+) -> Tuple[int, int]:
+    """
+    Delete the rows of a partition of a table, with the junction rows and
+    payloads only they pointed to.
+
+    Works in batches so the writer is never locked out for long. Returns the
+    number of rows and payloads deleted.
+    """
+    retained = RETAINED_TABLES[table]
+    deleted_rows = 0
+    deleted_payloads = 0
+    while True:
+        with connection:
+            cursor = connection.cursor()
+            rows = cursor.execute(
+                f"""
+                SELECT id{", payload_hash" if retained.has_payloads else ""}
+                FROM {table}
+                WHERE timestamp >= ? AND timestamp < ?
+                LIMIT ?
+                """,
+                (start, end, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+
+            ids = [(row[0],) for row in rows]
+            for link, column in retained.links:
+                cursor.executemany(f"DELETE FROM {link} WHERE {column} = ?", ids)
+            cursor.executemany(f"DELETE FROM {table} WHERE id = ?", ids)
+            deleted_rows += len(ids)
+
+            if retained.has_payloads:
+                hashes = {row[1] for row in rows if row[1] is not None}
+                for content_hash in hashes:
+                    cursor.execute(
+                        """
+                        DELETE FROM payload_blobs WHERE hash = ?1
+                        AND NOT EXISTS (SELECT 1 FROM http_requests WHERE payload_hash = ?1)
+                        AND NOT EXISTS (SELECT 1 FROM tcp_messages WHERE payload_hash = ?1)
+                        """,
+                        (content_hash,),
+                    )
+                    deleted_payloads += cursor.rowcount
+    return deleted_rows, deleted_payloads
+
+
+def incremental_vacuum(connection: sqlite3.Connection, pages_per_step: int = 1024) -> int:
+    """
+    Give the free pages of the database back to the file system a few at a
+    time, so the writer is never locked out for long.
+
+    Only does anything once the database is in incremental auto-vacuum mode.
+    Returns the number of pages freed.
+    """
+    if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    before = free = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    while free:
+        # the pragma frees a page per step, which only executescript runs to the end
+        connection.executescript(f"PRAGMA incremental_vacuum({pages_per_step});")
+        remaining = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        free = remaining
+    return before - free
+
+
+def apply_retention(
+    connection: sqlite3.Connection,
+    policy: RetentionPolicy,
+    stats: Optional[RetentionStats] = None,
+    now: Optional[float] = None,
+    batch_size: int = 500,
+) -> RetentionStats:
+    """
+    Archive and delete every expired partition, then vacuum the space freed.
+
+    A partition is archived before it is deleted, so a failure in between
+    archives it again on the next pass rather than losing it.
+    """
+    if stats is None:
+        stats = RetentionStats()
+    if now is None:
+        now = time.time()
+
+    deleted = 0
+    for table in RETAINED_TABLES:
+        days = policy.days(table)
+        if days is None:
+            continue
+        for start, end in expired_partitions(connection, table, days, policy.partition, now):
+            if policy.archive_dir is not None:
+                archive_partition(connection, table, start, end, policy.archive_dir)
+                stats.archived_partitions += 1
+            rows, payloads = delete_partition(connection, table, start, end, batch_size)
+            stats.deleted_rows += rows
+            stats.deleted_payloads += payloads
+            deleted += rows
+
+    if deleted:
+        stats.vacuumed_pages += incremental_vacuum(connection)
+        # the deletes went through the WAL, which would otherwise stay at its largest
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    stats.runs += 1
+    return stats
+
+
+def attach_archive(
+    connection: sqlite3.Connection, path: str, schema: str = "archive"
+) -> str:
+    """
+    Attach an archived partition to a connection as schema, to be queried
+    alongside the live tables.
+
+    The archive is decompressed to a temporary file, which is returned so
+    that it can be deleted once the archive is detached.
+    """
+    fd, unpacked = tempfile.mkstemp(suffix=".sqlite")
+    with os.fdopen(fd, "wb") as target, gzip.open(path, "rb") as source:
+        shutil.copyfileobj(source, target)
+    connection.execute("ATTACH DATABASE ? AS " + schema, (unpacked,))
+    return unpacked
+
+
+class RetentionService:
+    """
+    RetentionService applies a retention policy to the database in the
+    background.
+
+    Every interval seconds, it archives the partitions that have expired to
+    policy.archive_dir, deletes them from the live database in small
+    batches, and gives the space freed back with incremental vacuum. The
+    live database then holds no more than the policy keeps, so writes and
+    queries take as long after months of capture as on the first day.
+
+    The service has a connection of its own. With the database in WAL mode,
+    the writer only waits for it while it deletes a batch.
+    """
+
+    database_path: str
+    """The database retention is applied to"""
+
+    policy: RetentionPolicy
+    """How long rows are kept, and where expired ones are archived"""
+
+    interval: float
+    """The number of seconds between passes"""
+
+    stats: RetentionStats
+    """What retention has done so far"""
+
+    def __init__(
+        self,
+        database_path: str,
+        policy: RetentionPolicy,
+        interval: float = 3600.0,
+        start: bool = True,
+    ) -> None:
+        """
+        Args:
+            database_path: The database retention is applied to
+            policy: How long rows are kept, and where expired ones are archived
+            interval: The number of seconds between passes
+            start: Whether to start applying the policy in the background now
+        """
+        self.database_path = database_path
+        self.policy = policy
+        self.interval = interval
+        self.stats = RetentionStats()
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if start:
+            self.start()
+
+    def start(self) -> None:
+        """Start applying the policy in the background, beginning after one interval"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop after the pass in progress, if any"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_once(self) -> None:
+        """Apply the policy now"""
+        # the writer owns the schema and has migrated it by the time this runs
+        connection = connect_database(self.database_path, migrate_schema=False)
+        try:
+            apply_retention(connection, self.policy, self.stats)
+        except Exception as e:
+            print(f"Failed to apply retention to {self.database_path}: {e}")
+            self.stats.failed_runs += 1
+        finally:
+            close_database(connection)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.run_once()
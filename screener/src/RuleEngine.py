@@ -0,0 +1,478 @@
+from dataclasses import dataclass, field
+import hashlib
+import json
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from AhoCorasick import AhoCorasick
+from MatchEngine import MatchEngine, SearchText, match_text, required_literal
+from Metrics import SCREENER_BYTES, SCREENER_CALLS, SCREENER_SECONDS
+from ScreeningContext import ScreeningContext
+
+
+RULE_KINDS = ("regex", "literal", "json_path", "key")
+"""
+What a rule's patterns are: regular expressions, literal strings, paths of
+values in the structured body or query, or names of keys and headers
+"""
+
+TARGETS = ("body", "url", "headers")
+"""The parts of a request a rule can search, in the order they are searched"""
+
+MIN_PREFILTER_LENGTH = 3
+"""The shortest literal worth looking for before running a regex"""
+
+
+@dataclass
+class Rule:
+    """A detector declared in a rules file"""
+
+    name: str
+    """Identifies the rule in alert messages"""
+
+    alert_name: str
+    """The name of the alert the rule raises"""
+
+    kind: str
+    """One of RULE_KINDS"""
+
+    patterns: List[str]
+    """The rule matches when any of these does"""
+
+    targets: Tuple[str, ...] = TARGETS
+    """The parts of a request the rule searches"""
+
+    severity: int = 1
+
+    type: Optional[str] = None
+    """The type of the alert, the rule name by default"""
+
+    ignore_case: bool = False
+    """Whether regexes and literals match regardless of case"""
+
+
+def _parse_rule(entry: Dict[str, Any]) -> Rule:
+    """Read and check one rule of a rules file"""
+    name = str(entry["name"])
+    kind = str(entry.get("kind", "regex"))
+    if kind not in RULE_KINDS:
+        raise ValueError(f"Rule {name!r} has unknown kind {kind!r}, expected one of {RULE_KINDS}")
+
+    patterns = entry.get("patterns", entry.get("pattern"))
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not patterns:
+        raise ValueError(f"Rule {name!r} has no pattern")
+
+    targets = entry.get("targets", TARGETS)
+    if isinstance(targets, str):
+        targets = [targets]
+    unknown = [target for target in targets if target not in TARGETS]
+    if unknown:
+        raise ValueError(f"Rule {name!r} has unknown targets {unknown}, expected some of {TARGETS}")
+
+    return Rule(
+        name=name,
+        alert_name=str(entry.get("alert_name", name)),
+        kind=kind,
+        patterns=[str(pattern) for pattern in patterns],
+        # kept in search order whatever order they were listed in
+        targets=tuple(target for target in TARGETS if target in targets),
+        severity=int(entry.get("severity", 1)),
+        type=entry.get("type"),
+        ignore_case=bool(entry.get("ignore_case", False)),
+    )
+
+
+def load_rules(path: str) -> List[Rule]:
+    """
+    Read the rules of a TOML, YAML or JSON file, by its extension.
+
+    The file holds a "rules" list, each rule with a name, the alert_name it
+    raises, its kind, a pattern or a list of patterns, and optionally its
+    targets, severity, type and ignore_case, for example in TOML
+
+        [[rules]]
+        name = "aws_access_key"
+        alert_name = "AWS Access Key Leak"
+        pattern = "AKIA[0-9A-Z]{16}"
+        severity = 3
+
+        [[rules]]
+        name = "tracking_ids"
+        alert_name = "Tracking ID Leak"
+        kind = "literal"
+        patterns = ["idfa=", "gaid=", "adid="]
+        targets = ["url"]
+        ignore_case = true
+
+        [[rules]]
+        name = "credentials"
+        alert_name = "Credential Field"
+        kind = "key"
+        patterns = ["password", "passwd", "authorization"]
+        severity = 2
+
+        [[rules]]
+        name = "user_email"
+        alert_name = "Email Leak"
+        kind = "json_path"
+        patterns = ["user.email", "users[*].email", "**.contact.email"]
+
+    YAML files need PyYAML, the "yaml" extra.
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+
+    if path.endswith(".toml"):
+        import tomllib
+
+        data = tomllib.loads(content.decode("utf-8"))
+    elif path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(f"Reading {path} needs PyYAML, install the yaml extra") from None
+        data = yaml.safe_load(content)
+    else:
+        data = json.loads(content)
+
+    rules = [_parse_rule(entry) for entry in data.get("rules", [])]
+    names = [rule.name for rule in rules]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Rule names must be unique, {duplicates} are used more than once")
+    return rules
+
+
+def _path_pattern(path: str) -> str:
+    """
+    A regex for the value paths a json_path pattern matches.
+
+    Paths are written as StructuredBody writes them, such as "user.emails[0]",
+    optionally after "$.". A "*" stands for one key, "[*]" for any index and
+    "**" for any number of levels.
+    """
+    if path.startswith("$."):
+        path = path[2:]
+    parts = re.split(r"(\*\*\.?|\[\*\]|\*)", path)
+    out = []
+    for part in parts:
+        if part.startswith("**"):
+            out.append(r"(?:.*\.)?" if part.endswith(".") else r".*")
+        elif part == "[*]":
+            out.append(r"\[\d+\]")
+        elif part == "*":
+            out.append(r"[^.\[]+")
+        else:
+            out.append(re.escape(part))
+    return "".join(out)
+
+
+@dataclass
+class _Literal:
+    """A keyword of a literal automaton"""
+
+    rules: List[int] = field(default_factory=list)
+    """The literal rules it belongs to"""
+
+    patterns: List[int] = field(default_factory=list)
+    """The regexes it is the prefilter of, by MatchEngine index"""
+
+
+class _LiteralIndex:
+    """Literals searched for in one pass with an Aho-Corasick automaton"""
+
+    def __init__(self) -> None:
+        self.keywords: Dict[str, _Literal] = {}
+        self._automaton = AhoCorasick()
+
+    def add(self, keyword: str) -> _Literal:
+        return self.keywords.setdefault(keyword, _Literal())
+
+    def build(self) -> None:
+        for keyword, literal in self.keywords.items():
+            self._automaton.add(keyword, (len(keyword), literal))
+        self._automaton.build()
+
+    def iter(self, text: str) -> Iterator[Tuple[int, int, _Literal]]:
+        """Yield (start, end, literal) for every occurrence in the text"""
+        if not self.keywords:
+            return
+        for end, (length, literal) in self._automaton.iter(text):
+            yield end + 1 - length, end + 1, literal
+
+
+class RuleSet:
+    """
+    RuleSet compiles declarative rules into as few passes over a request as
+    it can, however many rules there are.
+
+    - Every literal, those of literal rules and the prefilters of regex
+      rules, goes into one Aho-Corasick automaton, with a second one over
+      the lowercased text for the rules that ignore case. Each search string
+      is walked once by each.
+    - A regex rule whose every match contains a literal, such as "AKIA" for
+      "AKIA[0-9A-Z]{16}", is only run over strings the automaton found that
+      literal in. The rest always run.
+    - The regexes that do run are scanned together by a MatchEngine, which
+      combines them into a single alternation.
+    - Key and json_path rules are looked up in the structured views of the
+      request, which are only parsed if there are such rules, with one walk
+      over every key and value path.
+
+    matches works out every rule's verdict on a context once, and keeps it
+    in the context for the RuleScreener of each rule.
+    """
+
+    rules: List[Rule]
+    """The rules, in the order they were declared"""
+
+    digest: str
+    """Identifies the compiled rules"""
+
+    def __init__(self, rules: List[Rule]) -> None:
+        self.rules = rules
+        self.digest = hashlib.blake2b(
+            repr(rules).encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+        # the regexes, and the rules each belongs to, by MatchEngine index
+        self._engine = MatchEngine()
+        self._pattern_rules: List[List[int]] = []
+        self._positions: Dict[re.Pattern, int] = {}
+        # the regexes without a prefilter, by target
+        self._unfiltered: Dict[str, Set[int]] = {target: set() for target in TARGETS}
+        self._exact = _LiteralIndex()
+        self._folded = _LiteralIndex()
+        # the rules of each key and exact path, by target
+        self._keys: Dict[str, Dict[str, List[int]]] = {target: {} for target in TARGETS}
+        self._paths: Dict[str, List[int]] = {}
+        self._path_patterns: List[Tuple[re.Pattern, int]] = []
+
+        for index, rule in enumerate(rules):
+            try:
+                self._compile(index, rule)
+            except re.error as e:
+                raise ValueError(f"Rule {rule.name!r} has an invalid pattern: {e}") from None
+        self._exact.build()
+        self._folded.build()
+
+        # one pass to rule out most paths before trying each wildcard pattern
+        self._any_path = (
+            re.compile("|".join(f"(?:{pattern.pattern})" for pattern, _ in self._path_patterns))
+            if self._path_patterns
+            else None
+        )
+        self._needs_structure = bool(
+            self._keys["body"] or self._keys["url"] or self._paths or self._path_patterns
+        )
+
+        # look the metrics up once, matches is on the hot path
+        self._calls = SCREENER_CALLS.labels("RuleScreener")
+        self._bytes = SCREENER_BYTES.labels("RuleScreener")
+        self._seconds = SCREENER_SECONDS.labels("RuleScreener")
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def _compile(self, index: int, rule: Rule) -> None:
+        """Add a rule to the matchers of its kind"""
+        if rule.kind == "regex":
+            for source in rule.patterns:
+                self._compile_regex(
+                    index, rule, re.compile(source, re.IGNORECASE if rule.ignore_case else 0)
+                )
+
+        elif rule.kind == "literal":
+            for literal in rule.patterns:
+                if not literal:
+                    raise ValueError(f"Rule {rule.name!r} has an empty literal")
+                if rule.ignore_case:
+                    self._folded.add(literal.lower()).rules.append(index)
+                else:
+                    self._exact.add(literal).rules.append(index)
+
+        elif rule.kind == "key":
+            for key in rule.patterns:
+                for target in rule.targets:
+                    self._keys[target].setdefault(key.lower(), []).append(index)
+
+        else:
+            for path in rule.patterns:
+                if "*" in path:
+                    self._path_patterns.append((re.compile(_path_pattern(path)), index))
+                else:
+                    self._paths.setdefault(path.removeprefix("$."), []).append(index)
+
+    def _compile_regex(self, index: int, rule: Rule, pattern: re.Pattern) -> None:
+        """Add a regex to the engine, behind a prefilter if it has a required literal"""
+        position = self._positions.get(pattern)
+        if position is None:
+            # re.compile hands out the same object for the same pattern, so
+            # rules sharing a regex share its scan
+            position = len(self._engine.patterns)
+            self._positions[pattern] = position
+            self._engine.register(pattern, first_only=True)
+            self._pattern_rules.append([])
+        self._pattern_rules[position].append(index)
+
+        # case-insensitive patterns, including ones turned so with (?i), have
+        # a lowercased literal
+        ignore_case = bool(pattern.flags & re.IGNORECASE)
+        literal = required_literal(pattern, MIN_PREFILTER_LENGTH)
+        if literal is None or (ignore_case and not literal.isascii()):
+            for target in rule.targets:
+                self._unfiltered[target].add(position)
+            return
+        automaton = self._folded if ignore_case else self._exact
+        prefilter = automaton.add(literal)
+        if position not in prefilter.patterns:
+            prefilter.patterns.append(position)
+
+    def describe(self) -> str:
+        """How the rules were compiled"""
+        literals = len(self._exact.keywords) + len(self._folded.keywords)
+        prefiltered = len(self._engine.patterns) - len(set().union(*self._unfiltered.values()))
+        keys = len({key for keys in self._keys.values() for key in keys})
+        paths = len(self._paths) + len(self._path_patterns)
+        return (
+            f"{len(self.rules)} rules: {literals} literals, {len(self._engine.patterns)} "
+            f"regexes ({prefiltered} behind literal prefilters), {keys} keys, {paths} paths"
+        )
+
+    def matches(self, context: ScreeningContext) -> Dict[int, str]:
+        """
+        The alert message of every rule that matches the context, by rule index.
+
+        Worked out once per context and shared by every rule's screener.
+        """
+        found = context.shared.get(self)
+        if found is None:
+            start = time.perf_counter()
+            found = self._match(context)
+            self._seconds.observe(time.perf_counter() - start)
+            self._calls.inc()
+            self._bytes.inc(context.size)
+            context.shared[self] = found
+        return found
+
+    def _match(self, context: ScreeningContext) -> Dict[int, str]:
+        found: Dict[int, str] = {}
+        texts: List[Tuple[str, SearchText]] = [
+            ("body", context.search_body),
+            ("url", context.url),
+            ("headers", context.headers_text),
+        ]
+        for target, text in texts:
+            if text:
+                self._match_text(context, target, text, found)
+        if self._needs_structure:
+            self._match_structure(context, found)
+        if self._keys["headers"]:
+            for name, _ in context.headers:
+                self._found_key(found, "headers", name)
+        return found
+
+    def _match_text(
+        self, context: ScreeningContext, target: str, text: SearchText, found: Dict[int, str]
+    ) -> None:
+        """Run the literal and regex rules of a target over its text"""
+        armed = set(self._unfiltered[target])
+
+        # the automata work on str, bytes stand for their latin-1 characters
+        decoded = text.decode("latin-1") if isinstance(text, bytes) else text
+        searches = [(self._exact, decoded)]
+        if self._folded.keywords:
+            lowered = decoded.lower()
+            searches.append((self._folded, lowered))
+            if not decoded.isascii():
+                # lowercasing only agrees with how regexes fold case for ASCII,
+                # so the case-insensitive regexes can't be ruled out
+                for literal in self._folded.keywords.values():
+                    armed.update(literal.patterns)
+
+        for index, searched in searches:
+            for start, end, literal in index.iter(searched):
+                # a regex match may reach past the overlap whatever the offset
+                armed.update(literal.patterns)
+                if end <= context.overlap:
+                    continue
+                for rule_index in literal.rules:
+                    rule = self.rules[rule_index]
+                    if rule_index not in found and target in rule.targets:
+                        found[rule_index] = (
+                            f"Found '{decoded[start:end]}' matching rule '{rule.name}' in {target}"
+                        )
+
+        # the regexes of rules that matched already needn't run
+        active = sorted(
+            position
+            for position in armed
+            if any(
+                rule_index not in found and target in self.rules[rule_index].targets
+                for rule_index in self._pattern_rules[position]
+            )
+        )
+        for position, matches in self._engine.scan_string(text, active, context.overlap).items():
+            if not matches:
+                continue
+            for rule_index in self._pattern_rules[position]:
+                rule = self.rules[rule_index]
+                if rule_index not in found and target in rule.targets:
+                    found[rule_index] = (
+                        f"Found '{match_text(matches[0])}' matching rule '{rule.name}' in {target}"
+                    )
+
+    def _match_structure(self, context: ScreeningContext, found: Dict[int, str]) -> None:
+        """
+        Run the key and json_path rules over the keys and value paths of the
+        request, with form and query paths prefixed as StructuredBody.fields
+        prefixes them
+        """
+        structured = context.structured
+        sources: List[Tuple[str, List[Tuple[str, str, Any]]]] = []
+        if context.search_body:
+            json_index = structured.json_index
+            if json_index is not None:
+                sources.append(("body", json_index.fields))
+                # the keys of objects and arrays are not the key of any field
+                if self._keys["body"]:
+                    for item in json_index.objects:
+                        for key in item:
+                            self._found_key(found, "body", str(key))
+            if structured.form is not None:
+                sources.append(
+                    ("body", [(f"form.{key}", key, value) for key, value in structured.form.items()])
+                )
+        if context.url:
+            sources.append(
+                ("url", [(f"query.{key}", key, value) for key, value in structured.query.items()])
+            )
+
+        for target, fields in sources:
+            for path, key, value in fields:
+                self._found_key(found, target, key)
+                for rule_index in self._paths.get(path, ()):
+                    self._found_path(found, target, rule_index, path, value)
+                if self._any_path is not None and self._any_path.fullmatch(path):
+                    for pattern, rule_index in self._path_patterns:
+                        if pattern.fullmatch(path):
+                            self._found_path(found, target, rule_index, path, value)
+
+    def _found_key(self, found: Dict[int, str], target: str, key: str) -> None:
+        """Record the key rules of a target matching a key"""
+        for rule_index in self._keys[target].get(key.lower(), ()):
+            if rule_index not in found:
+                found[rule_index] = (
+                    f"Found key '{key}' matching rule '{self.rules[rule_index].name}' in {target}"
+                )
+
+    def _found_path(
+        self, found: Dict[int, str], target: str, rule_index: int, path: str, value: Any
+    ) -> None:
+        """Record a json_path rule matching the path of a value"""
+        rule = self.rules[rule_index]
+        if rule_index not in found and target in rule.targets:
+            found[rule_index] = f"Found '{value}' at '{path}' matching rule '{rule.name}' in {target}"
@@ -0,0 +1,235 @@
+from dataclasses import dataclass, field
+from importlib import import_module
+from importlib.metadata import entry_points
+import json
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from AlertWriter import AlertSink
+from Screeners.IndividualScreener import IndividualScreener
+
+
+ENTRY_POINT_GROUP = "traffic_slice.screeners"
+"""The entry point group third party packages register their screeners in"""
+
+BUILTIN_SCREENERS: Dict[str, str] = {
+    "env_var": "Screeners.EnvVarScreener:EnvVarScreener",
+    "file_name": "Screeners.FileNameScreener:FileNameScreener",
+    "mac_addr": "Screeners.MacAddrScreener:MacAddrScreener",
+    "location": "Screeners.LocationScreener:LocationScreener",
+    "timestamp": "Screeners.TimestampScreener:TimestampScreener",
+    "rules": "Screeners.RuleScreener:build_rule_screeners",
+}
+"""The screeners that ship with the proxy, by name, in their default order"""
+
+ScreenerFactory = Callable[..., Union[IndividualScreener, List[IndividualScreener]]]
+"""Builds a screener, or a group of them, from an alert writer and its options"""
+
+
+@dataclass
+class ScreenerConfig:
+    """A screener to build, and how"""
+
+    name: str
+    """The name the screener is registered under, or its own name with a target"""
+
+    target: Optional[str] = None
+    """A "module:attribute" factory to build it with instead of the registered one"""
+
+    options: Dict[str, Any] = field(default_factory=dict)
+    """Keyword arguments for the factory, after the alert writer"""
+
+    enabled: bool = True
+    """Whether the screener is built at all"""
+
+
+DEFAULT_CONFIG: List[ScreenerConfig] = [
+    # the rules screeners only run with a rules file to build them from
+    ScreenerConfig(name) for name in BUILTIN_SCREENERS if name != "rules"
+]
+"""Every built-in screener that needs no options, with its default options"""
+
+
+def load_screener_config(path: str) -> List[ScreenerConfig]:
+    """
+    Read the screeners to build from a JSON file.
+
+    The file holds an object whose "screeners" list names each screener,
+    either as a string or as an object with a name and, optionally, a
+    target, options and enabled, for example
+
+        {"screeners": [
+            "env_var",
+            {"name": "location", "options": {"stale_after": 600}},
+            {"name": "rules", "options": {"path": "rules.toml"}},
+            {"name": "tokens", "target": "my_screeners:TokenScreener"}
+        ]}
+
+    Screeners are built in the order they are listed.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    configs = []
+    for entry in data["screeners"]:
+        if isinstance(entry, str):
+            entry = {"name": entry}
+        configs.append(
+            ScreenerConfig(
+                name=str(entry["name"]),
+                target=entry.get("target"),
+                options=dict(entry.get("options", {})),
+                enabled=bool(entry.get("enabled", True)),
+            )
+        )
+    return configs
+
+
+@dataclass
+class ScreenerLoad:
+    """What building a screener cost"""
+
+    name: str
+
+    target: str
+    """Where its factory was loaded from"""
+
+    import_seconds: float
+    """Time spent importing its module, zero if it was already imported"""
+
+    init_seconds: float
+    """Time spent in its constructor"""
+
+    modules: int
+    """The number of modules imported along with it"""
+
+
+class ScreenerRegistry:
+    """
+    ScreenerRegistry builds the screeners a configuration enables.
+
+    Screeners are registered by name with a "module:attribute" target, the
+    built-in ones and any that third party packages publish in the
+    traffic_slice.screeners entry point group, for example in pyproject.toml
+
+        [project.entry-points."traffic_slice.screeners"]
+        tokens = "my_screeners:TokenScreener"
+
+    Nothing is imported when a screener is registered. Each module is
+    imported when a screener from it is first built, so disabled screeners
+    never pull in their dependencies, and the cost of importing and building
+    each screener is recorded in loads.
+
+    A factory may build a group of screeners at once, such as one for each
+    rule of a rules file, by returning a list of them.
+    """
+
+    loads: List[ScreenerLoad]
+    """What building each screener cost, in the order they were built"""
+
+    def __init__(self, entry_point_group: Optional[str] = ENTRY_POINT_GROUP) -> None:
+        """
+        Args:
+            entry_point_group: Where to discover third party screeners, None
+                to only use the registered ones
+        """
+        self._targets: Dict[str, Union[str, ScreenerFactory]] = dict(BUILTIN_SCREENERS)
+        self._entry_point_group = entry_point_group
+        self._discovered = entry_point_group is None
+        self.loads = []
+
+    def register(self, name: str, target: Union[str, ScreenerFactory]) -> None:
+        """Register a screener by a "module:attribute" target or a factory"""
+        self._targets[name] = target
+
+    def available(self) -> List[str]:
+        """The names of every screener that can be built"""
+        self._discover()
+        return list(self._targets)
+
+    def _discover(self) -> None:
+        """Register the screeners of installed packages, reading only their metadata"""
+        if self._discovered:
+            return
+        self._discovered = True
+        for entry_point in entry_points(group=self._entry_point_group):
+            # registered screeners win over installed ones of the same name
+            self._targets.setdefault(entry_point.name, entry_point.value)
+
+    def _resolve(self, config: ScreenerConfig) -> Union[str, ScreenerFactory]:
+        target = config.target or self._targets.get(config.name)
+        if target is None:
+            self._discover()
+            target = self._targets.get(config.name)
+        if target is None:
+            raise ValueError(
+                f"Unknown screener {config.name!r}, available screeners are {self.available()}"
+            )
+        return target
+
+    def build(
+        self,
+        alert_writer: Optional[AlertSink],
+        configs: Optional[List[ScreenerConfig]] = None,
+        extra_options: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> List[IndividualScreener]:
+        """
+        Build the enabled screeners of a configuration, in its order.
+
+        Args:
+            alert_writer: Where the screeners send triggered alerts
+            configs: The screeners to build, every built-in one by default
+            extra_options: Options for screeners by name, such as objects
+                shared with the rest of the proxy, that override the
+                configured ones
+        """
+        screeners = []
+        for config in configs if configs is not None else DEFAULT_CONFIG:
+            if not config.enabled:
+                continue
+            options = {**config.options, **(extra_options or {}).get(config.name, {})}
+            built = self._build(config, alert_writer, options)
+            if isinstance(built, list):
+                screeners.extend(built)
+            else:
+                screeners.append(built)
+        return screeners
+
+    def _build(
+        self, config: ScreenerConfig, alert_writer: Optional[AlertSink], options: Dict[str, Any]
+    ) -> Union[IndividualScreener, List[IndividualScreener]]:
+        target = self._resolve(config)
+
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        factory: Any = target
+        if isinstance(target, str):
+            module_name, _, attribute = target.partition(":")
+            factory = import_module(module_name)
+            for part in attribute.split("."):
+                factory = getattr(factory, part)
+        imported = time.perf_counter()
+        screener = factory(alert_writer, **options)
+        built = time.perf_counter()
+
+        self.loads.append(
+            ScreenerLoad(
+                name=config.name,
+                target=target if isinstance(target, str) else repr(target),
+                import_seconds=imported - start,
+                init_seconds=built - imported,
+                modules=len(sys.modules) - modules,
+            )
+        )
+        return screener
+
+    def report(self) -> str:
+        """A table of what building each screener cost"""
+        lines = [f"{'screener':<16} {'import ms':>10} {'init ms':>10} {'modules':>8}"]
+        for load in self.loads:
+            lines.append(
+                f"{load.name:<16} {load.import_seconds * 1000:>10.1f} "
+                f"{load.init_seconds * 1000:>10.1f} {load.modules:>8}"
+            )
+        return "\n".join(lines)
@@ -1,20 +1,49 @@
 from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
+from ScreeningContext import ScreeningContext
 from Screeners.IndividualScreener import IndividualScreener
-import sqlite3
-from typing import List, Optional
+from SecretIndex import EnvironmentSource, SecretIndex, SecretSource, StaticSource
+from typing import Dict, Hashable, List, Optional
 
 
 class EnvVarScreener(IndividualScreener):
     """
     EnvVarScreener screens traffic for known environment variable values.
-    Detects the following secrets:
+    Detects the following secrets by default:
     - System level secret key
     - User level secret key
+    - Environment variables of this process that look like secrets
+
+    More secrets can be watched for by passing extra sources, such as .env
+    files or a vault export.
     """
 
-    def __init__(self, db_connection: sqlite3.Connection) -> None:
+    # Define the secret keys as class constants
+    SYSTEM_LEVEL_KEY = "CqyTJns6LOXtDRxmlkuNAFfV91UjgreE"
+    USER_LEVEL_KEY = "TqyTJns6LOXtDRxmlkuNAFfV91UjgreEq"
+
+    DEFAULT_SECRETS: Dict[str, str] = {
+        "system level secret key": SYSTEM_LEVEL_KEY,
+        "user level secret key": USER_LEVEL_KEY,
+    }
+
+    secret_index: SecretIndex
+    """The index of every secret being watched for"""
+
+    def __init__(
+        self,
+        alert_writer: AlertSink,
+        sources: Optional[List[SecretSource]] = None,
+        refresh_interval: float = 30.0,
+    ) -> None:
         """
         Initialize the EnvVarScreener.
+
+        Args:
+            alert_writer: Where triggered alerts are sent
+            sources: Where to load secrets from, defaults to the built-in keys
+                and the process environment
+            refresh_interval: How often to check the sources for changes
         """
         alert_setup: AlertSetup = AlertSetup(
             alert_name="Environment Variable Leak",
@@ -22,22 +51,31 @@ class EnvVarScreener(IndividualScreener):
             severity=5,
         )
 
-        super().__init__(alert_setup, db_connection)
+        super().__init__(alert_setup, alert_writer)
 
-    # Define the secret keys as class constants
-    SYSTEM_LEVEL_KEY = "CqyTJns6LOXtDRxmlkuNAFfV91UjgreE"
-    USER_LEVEL_KEY = "TqyTJns6LOXtDRxmlkuNAFfV91UjgreEq"
+        if sources is None:
+            sources = [StaticSource(self.DEFAULT_SECRETS), EnvironmentSource()]
+        self.secret_index = SecretIndex(sources)
+        self.secret_index.watch(refresh_interval)
+
+    def cache_state(self) -> Hashable:
+        """The secrets watched for, which change when a source is reloaded"""
+        return self.secret_index.generation
 
-    def screen(self, search_strings: List[str]) -> Optional[str]:
+    def screen(self, context: ScreeningContext) -> Optional[str]:
         """
         Screen the provided strings for known secret keys.
 
         Returns:
-            A message describing which specific secret was found, None otherwise
+            A message describing which specific secrets were found, None otherwise
         """
-        for search_string in search_strings:
-            if self.SYSTEM_LEVEL_KEY in search_string:
-                return "Found system level secret key in traffic"
-            if self.USER_LEVEL_KEY in search_string:
-                return "Found user level secret key in traffic"
-        return None
+        found: Dict[str, None] = {}
+        for search_string in context.search_strings:
+            for name in self.secret_index.scan(search_string, context.overlap):
+                found[name] = None
+
+        if not found:
+            return None
+        if len(found) == 1:
+            return f"Found {next(iter(found))} in traffic"
+        return f"Found {len(found)} secrets in traffic: {', '.join(found)}"
@@ -1,6 +1,6 @@
 from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
 from Screeners.RegexScreener import RegexScreener
-import sqlite3
 
 
 class FileNameScreener(RegexScreener):
@@ -15,14 +15,14 @@ class FileNameScreener(RegexScreener):
 
     def __init__(
         self,
-        db_connection: sqlite3.Connection,
+        alert_writer: AlertSink,
     ) -> None:
         """
         Initialize the FileNameScreener with a regex pattern for common file types.
 
         Args:
             alert_setup: The alert configuration
-            db_connection: SQLite database connection
+            alert_writer: Where triggered alerts are sent
         """
         alert_setup: AlertSetup = AlertSetup(
             alert_name="File Name Leak",
@@ -33,4 +33,4 @@ class FileNameScreener(RegexScreener):
         # Pattern matches filenames with common extensions
         # Format: word characters followed by a dot and common extensions
         file_pattern = r"\b[\w\-\.]+\.(pdf|doc|docx|txt|rtf|csv|xls|xlsx|exe|dll|bat|sh|py|js|html|htm|php|jpg|jpeg|png|gif|mp3|mp4|avi|mkv|zip|rar|7z|tar|gz)\b"
-        super().__init__(alert_setup, db_connection, file_pattern)
+        super().__init__(alert_setup, alert_writer, file_pattern)
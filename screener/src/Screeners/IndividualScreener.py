@@ -1,13 +1,19 @@
 from abc import ABC, abstractmethod
-import sqlite3
-from typing import List, Optional
-import uuid
+import re
+import time
+from typing import Any, Hashable, List, Optional, Tuple
 from mitmproxy import tcp
 from mitmproxy import http
 from mitmproxy.utils import strutils
 import logging
 
+from AlertRecord import AlertRecord, HttpRequestRecord, TcpMessageRecord
 from AlertSetup import AlertSetup
+from AlertSuppression import alert_fingerprint
+from AlertWriter import AlertSink
+from Metrics import SCREENER_BYTES, SCREENER_CALLS, SCREENER_SECONDS, SCREENER_TRIGGERS
+from ScreeningContext import ScreeningContext, TcpScreeningContext
+from TcpStreams import TcpStreams
 
 
 class IndividualScreener(ABC):
@@ -25,192 +31,255 @@ class IndividualScreener(ABC):
     alert_setup: AlertSetup
     """The setup of the alert that this screener screens for"""
 
-    db_connection: sqlite3.Connection
-    """The connection to the database"""
+    alert_writer: AlertSink
+    """Where triggered alerts are sent"""
 
-    def __init__(
-        self, alert_setup: AlertSetup, db_connection: sqlite3.Connection
-    ) -> None:
+    tcp_streams: TcpStreams
+    """The carried over TCP data, when this screener is used as an addon on its own"""
+
+    cache_version: str = "1"
+    """
+    Part of the VerdictCache key, to be bumped whenever a change to the
+    screener changes what screen_material finds
+    """
+
+    def __init__(self, alert_setup: AlertSetup, alert_writer: AlertSink) -> None:
         self.alert_setup = alert_setup
-        self.db_connection = db_connection
-
-    def save_tcp_message_to_db(self, tcp_message: tcp.TCPFlow) -> int:
-        """Save the TCP message to the database and return the ID"""
-        cursor = self.db_connection.cursor()
-        cursor.execute(
-            """
-            INSERT INTO tcp_messages (
-                flow_id, client_host, client_port, 
-                server_host, server_port, message_content
-            ) VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                tcp_message.id,
-                (
-                    tcp_message.client_conn.address[0]
-                    if tcp_message.client_conn and tcp_message.client_conn.address
-                    else None
-                ),  # client host
-                (
-                    tcp_message.client_conn.address[1]
-                    if tcp_message.client_conn and tcp_message.client_conn.address
-                    else None
-                ),  # client port
-                (
-                    tcp_message.server_conn.address[0]
-                    if tcp_message.server_conn and tcp_message.server_conn.address
-                    else None
-                ),  # server host
-                (
-                    tcp_message.server_conn.address[1]
-                    if tcp_message.server_conn and tcp_message.server_conn.address
-                    else None
-                ),  # server port
-                tcp_message.messages[0].content if tcp_message.messages else None,
-            ),
+        self.alert_writer = alert_writer
+        self.tcp_streams = TcpStreams()
+
+        # look the metrics up once, run_screen is on the hot path
+        name = type(self).__name__
+        self._calls = SCREENER_CALLS.labels(name)
+        self._bytes = SCREENER_BYTES.labels(name)
+        self._triggers = SCREENER_TRIGGERS.labels(name)
+        self._seconds = SCREENER_SECONDS.labels(name)
+
+    def build_tcp_message_record(
+        self, tcp_message: tcp.TCPFlow, context: Optional[TcpScreeningContext] = None
+    ) -> TcpMessageRecord:
+        """
+        Snapshot the TCP message so it can be written later
+
+        The message that was screened is stored if the context is given,
+        otherwise the newest message of the connection.
+        """
+        client_address = (
+            tcp_message.client_conn.address
+            if tcp_message.client_conn and tcp_message.client_conn.address
+            else None
         )
-        self.db_connection.commit()
-
-        new_id = cursor.lastrowid
-        if new_id is None:
-            raise Exception("Failed to save TCP message to database")
-        return new_id
-
-    def save_http_request_to_db(self, http_request: http.HTTPFlow) -> int:
-        """Save the HTTP request to the database and return the ID"""
-        cursor = self.db_connection.cursor()
-
-        cursor.execute("SELECT id FROM http_requests WHERE flow_id = ?", (http_request.id,))
-        existing_id = cursor.fetchone()
-
-        new_flow_id = http_request.id
-        if existing_id:
-            new_flow_id = f"{http_request.id}-{uuid.uuid4().hex[:8]}"
-            
-        cursor.execute(
-            """
-            INSERT INTO http_requests (
-                flow_id, url, method, headers, request_content
-            ) VALUES (?, ?, ?, ?, ?)
-            """,
-            (
-                new_flow_id,
-                http_request.request.url,
-                http_request.request.method,
-                str(http_request.request.headers),
-                http_request.request.text,
-            ),
+        server_address = (
+            tcp_message.server_conn.address
+            if tcp_message.server_conn and tcp_message.server_conn.address
+            else None
         )
-        self.db_connection.commit()
-
-        new_id = cursor.lastrowid
-        if new_id is None:
-            raise Exception("Failed to save HTTP request to database")
-        return new_id
-
-    def save_alert_to_db(
-        self, message: str, application_from: str, destination_domain: str
-    ) -> int:
-        """Save the alert to the database without any relationships.
-
-        Returns the ID of the alert.
-        """
-        cursor = self.db_connection.cursor()
-        cursor.execute(
-            """
-            INSERT INTO alerts (alert_name, message, application_from, destination_domain, type, severity)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                self.alert_setup.alert_name,
-                message,
-                application_from,
-                destination_domain,
-                self.alert_setup.type,
-                self.alert_setup.severity,
+
+        return TcpMessageRecord(
+            flow_id=tcp_message.id,
+            client_host=client_address[0] if client_address else None,
+            client_port=client_address[1] if client_address else None,
+            server_host=server_address[0] if server_address else None,
+            server_port=server_address[1] if server_address else None,
+            message_content=(
+                context.message.content
+                if context is not None
+                else tcp_message.messages[-1].content if tcp_message.messages else None
             ),
         )
 
-        new_id = cursor.lastrowid
-        if new_id is None:
-            raise Exception("Failed to save alert to database")
-        return new_id
-
-    def add_tcp_message_to_alert(self, alert_id: int, tcp_message_id: int) -> None:
-        """Add a TCP message to an alert"""
-        cursor = self.db_connection.cursor()
-        cursor.execute(
-            "INSERT INTO alert_tcp_messages (alert_id, tcp_message_id) VALUES (?, ?)",
-            (alert_id, tcp_message_id),
-        )
-        self.db_connection.commit()
-
-    def add_http_request_to_alert(self, alert_id: int, http_request_id: int) -> None:
-        """Add an HTTP request to an alert"""
-        cursor = self.db_connection.cursor()
-        cursor.execute(
-            "INSERT INTO alert_http_requests (alert_id, http_request_id) VALUES (?, ?)",
-            (alert_id, http_request_id),
+    def build_http_request_record(
+        self, http_request: http.HTTPFlow, context: Optional[ScreeningContext] = None
+    ) -> HttpRequestRecord:
+        """Snapshot the HTTP request so it can be written later"""
+        if context is None:
+            context = ScreeningContext(http_request)
+
+        return HttpRequestRecord(
+            flow_id=http_request.id,
+            url=context.url,
+            method=http_request.request.method,
+            headers=context.headers_text,
+            request_content=context.body,
         )
-        self.db_connection.commit()
 
     def on_trigger(
         self,
         message: str,
         tcp_message: Optional[tcp.TCPFlow] = None,
         http_request: Optional[http.HTTPFlow] = None,
+        context: Optional[ScreeningContext] = None,
     ) -> None:
-        """Handle the trigger of the screener"""
+        """
+        Handle the trigger of the screener
 
-        print(f"Triggering {self.alert_setup.alert_name} with message: {message}")
+        The screening context of the HTTP request or TCP message is reused if given.
+        """
 
-        # TODO update this logic to be more storage efficient
+        print(f"Triggering {self.alert_setup.alert_name} with message: {message}")
 
         application_from = "UNKNOWN"
         destination_domain = "UNKNOWN"
 
-        if http_request:
-            application_from = http_request.request.headers.get("User-Agent", "UNKNOWN")
-            destination_domain = http_request.request.url.split("/")[2]
-
-        # Store the alert in a the database
-        alert_id = self.save_alert_to_db(message, application_from, destination_domain)
-
-        # Store the TCP message in the database
-        if tcp_message:
-            tcp_message_id = self.save_tcp_message_to_db(tcp_message)
-            self.add_tcp_message_to_alert(alert_id, tcp_message_id)
-
-        # Store the HTTP request in the database
-        if http_request:
-            http_request_id = self.save_http_request_to_db(http_request)
-            self.add_http_request_to_alert(alert_id, http_request_id)
-
-    def request(self, flow: http.HTTPFlow) -> None:
-        """Handle HTTP requests"""
-        search_strings: List[str] = []
-        if flow.request.text:
-            search_strings.append(flow.request.text)
-        if flow.request.url:
-            search_strings.append(flow.request.url)
-        if flow.request.headers:
-            search_strings.append(str(flow.request.headers))
-
-        triggered_message = self.screen(search_strings)
+        if http_request and context is None:
+            context = ScreeningContext(http_request)
+        if context is not None:
+            application_from = context.user_agent
+            destination_domain = context.host
+
+        # Queue the alert and the traffic that triggered it to be written
+        self.alert_writer.submit(
+            AlertRecord(
+                alert_name=self.alert_setup.alert_name,
+                message=message,
+                application_from=application_from,
+                destination_domain=destination_domain,
+                type=self.alert_setup.type,
+                severity=self.alert_setup.severity,
+                created_at=context.timestamp if context is not None else time.time(),
+                fingerprint=alert_fingerprint(
+                    self.alert_setup.alert_name,
+                    application_from,
+                    destination_domain,
+                    self.normalize_match(message),
+                ),
+                http_request=(
+                    self.build_http_request_record(http_request, context)
+                    if http_request
+                    else None
+                ),
+                tcp_message=(
+                    self.build_tcp_message_record(
+                        tcp_message,
+                        context if isinstance(context, TcpScreeningContext) else None,
+                    )
+                    if tcp_message
+                    else None
+                ),
+            )
+        )
+
+    def normalize_match(self, message: str) -> str:
+        """
+        The part of a trigger message that tells repeats of an alert apart.
+
+        Alerts with the same normalized match, from the same application to
+        the same destination, are coalesced into one. By default that is the
+        message itself, ignoring case and whitespace. Screeners whose messages
+        carry counts or measurements override this to leave them out.
+        """
+        return " ".join(message.lower().split())
+
+    def scan_patterns(self) -> List[Tuple[re.Pattern, bool]]:
+        """
+        The regex patterns this screener searches for.
+
+        Each pattern is paired with whether only its first match is needed.
+        AllScreenersCombined scans for all of these in a single pass and hands
+        the matches to screen through the context's ScanResult.
+        """
+        return []
+
+    def request(
+        self, flow: http.HTTPFlow, context: Optional[ScreeningContext] = None
+    ) -> None:
+        """
+        Handle HTTP requests
+
+        AllScreenersCombined passes a context shared with the other screeners.
+        """
+        if context is None:
+            context = ScreeningContext(flow)
+
+        triggered_message = self.run_screen(context)
         if triggered_message:
-            self.on_trigger(triggered_message, tcp_message=None, http_request=flow)
+            self.on_trigger(
+                triggered_message, tcp_message=None, http_request=flow, context=context
+            )
 
-    def tcp_message(self, flow: tcp.TCPFlow) -> None:
-        """Handle TCP messages"""
-        pass
+    def tcp_message(
+        self, flow: tcp.TCPFlow, context: Optional[TcpScreeningContext] = None
+    ) -> None:
+        """
+        Handle TCP messages
+
+        Only the newest message is screened, with the tail of the previous
+        message in the same direction in front of it. AllScreenersCombined
+        passes a context shared with the other screeners.
+        """
+        if context is None:
+            context = self.tcp_streams.context(flow)
+            if context is None:
+                return
+
+        triggered_message = self.run_screen(context)
+        if triggered_message:
+            self.on_trigger(
+                triggered_message, tcp_message=flow, http_request=None, context=context
+            )
+
+    def run_screen(self, context: ScreeningContext) -> Optional[str]:
+        """Screen a context, recording the call in the screener metrics"""
+        return self.run_verdict(context, self.run_screen_material(context))
+
+    def run_screen_material(self, context: ScreeningContext) -> Any:
+        """Screen the material of a context, recording the call in the screener metrics"""
+        start = time.perf_counter()
+        found = self.screen_material(context)
+        self._seconds.observe(time.perf_counter() - start)
+        self._calls.inc()
+        self._bytes.inc(context.size)
+        return found
+
+    def run_verdict(self, context: ScreeningContext, found: Any) -> Optional[str]:
+        """The verdict on what was found in a context, counting it if it triggers"""
+        message = self.verdict(context, found)
+        if message:
+            self._triggers.inc()
+        return message
+
+    def screen_material(self, context: ScreeningContext) -> Any:
+        """
+        The part of screening that depends on nothing but the search material
+        of the context, which is what a VerdictCache keeps.
+
+        For a screener whose verdict depends on the material alone, this is
+        the verdict itself. Screeners with state, or that compare the material
+        with something that changes, return what they found and decide in
+        verdict, which runs for every flow whether this was cached or not.
+        """
+        return self.screen(context)
+
+    def verdict(self, context: ScreeningContext, found: Any) -> Optional[str]:
+        """The alert message for what screen_material found, None if it doesn't trigger"""
+        return found
+
+    def cache_state(self) -> Hashable:
+        """
+        Anything besides the material that screen_material depends on, such
+        as a set of secrets that is reloaded. Cached results are not used
+        once it changes.
+        """
+        return None
+
+    def tcp_end(self, flow: tcp.TCPFlow) -> None:
+        """Free the state of a closed TCP connection"""
+        self.tcp_streams.close(flow)
+
+    def tcp_error(self, flow: tcp.TCPFlow) -> None:
+        """Free the state of a failed TCP connection"""
+        self.tcp_streams.close(flow)
 
     # TODO we need a way to detect if a tcp message is part of a http request
     # TODO maybe we check the socket or ports or something
 
     @abstractmethod
-    def screen(self, search_strings: List[str]) -> Optional[str]:
+    def screen(self, context: ScreeningContext) -> Optional[str]:
         """
-        Screen the given search strings
+        Screen the search material of the given context
+
+        Matches for the patterns from scan_patterns should be looked up
+        through context.scan rather than by running the patterns directly.
 
         Returns a message if the screen is triggered.
         Otherwise, returns None.
@@ -1,64 +1,93 @@
 from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
+from DeviceLocator import DeviceLocator
+from Geofence import GeofenceIndex, ProtectedLocation
+from MatchEngine import DIRECT_SCAN, ScanResult, SearchText, match_text
+from ScreeningContext import ScreeningContext
+from StructuredBody import JsonIndex
 from Screeners.IndividualScreener import IndividualScreener
-import sqlite3
-from typing import List, Optional, Tuple
-import json
+from typing import Any, Dict, List, Optional, Tuple
 import re
-from collections import defaultdict
-import time
-from mitmproxy import http
 import math
-import geocoder
 
 
 class LocationScreener(IndividualScreener):
     """
     Screens traffic for location data in different formats.
     Detects when coordinates in traffic are close to the device's actual location.
+
+    The device's location comes from a DeviceLocator, which refreshes it in
+    the background, so screening never waits on a location lookup. The
+    locator is started the first time the location is needed, so building
+    the screener makes no network calls. Alerts say how old the location is
+    once it is older than stale_after seconds.
+
+    Coordinates are also checked against any number of protected locations,
+    such as offices or homes, each with its own radius. These are kept in a
+    GeofenceIndex, so the cost of checking a coordinate stays about the same
+    however many there are, and alerts name the location that was matched.
     """
 
-    def __init__(self, db_connection: sqlite3.Connection) -> None:
+    def __init__(
+        self,
+        alert_writer: AlertSink,
+        suspicious_hosts: Optional[List[str]] = None,
+        location_keywords: Optional[List[str]] = None,
+        device_locator: Optional[DeviceLocator] = None,
+        stale_after: float = 3600.0,
+        protected_locations: Optional[List[ProtectedLocation]] = None,
+    ) -> None:
         alert_setup: AlertSetup = AlertSetup(
             alert_name="Location Data Leak",
             type="location",
             severity=3,
         )
-        super().__init__(alert_setup, db_connection)
+        super().__init__(alert_setup, alert_writer)
         
-        # keep track frequency of location data per application
-        self.app_alerts = defaultdict(int)
-        self.last_alert_time = time.time()
-        
-        # Get the device's actual location and cache it
-        self.device_location = self.get_device_location()
-        self.location_refresh_time = time.time()
+        # Where the device is, kept up to date in the background
+        self.device_locator = device_locator or DeviceLocator(start=False)
+        self.stale_after = stale_after
         
         # Distance threshold in kilometers - coordinates within this distance
         # from the device are considered "nearby"
         self.distance_threshold = 10.0  # 10km
 
-    def get_device_location(self) -> Tuple[float, float]:
+        # Fixed sites that coordinates must not be near, each with its own radius
+        self.geofence = GeofenceIndex(protected_locations or [])
+
+        # Regular expression pattern to match coordinate pairs in the format "latitude,longitude"
+        # Matches decimal numbers (positive or negative) separated by a comma with optional whitespace
+        # Examples: "37.7749,-122.4194" or "37.7749, -122.4194" or "-33.8688, 151.2093"
+        self.coord_pattern = re.compile(r"-?\d+\.\d+\s*,\s*-?\d+\.\d+")
+
+        # Lowercase hosts of location services and keywords that are alerted on
+        self.suspicious_hosts = suspicious_hosts or []
+        self.location_keywords = location_keywords or []
+
+    @property
+    def device_location(self) -> Tuple[float, float]:
         """
-        Get the device's current location using geocoder.
-        Returns (latitude, longitude) tuple.
+        The device's last known location as a (latitude, longitude) tuple,
+        (0.0, 0.0) until it is known.
         """
-        try:
-            # Try to get location from IP-based geocoding
-            g = geocoder.ip('me')
-            if g.ok:
-                return (g.lat, g.lng)
-            
-            # Fallback to a different IP geocoding provider if first one fails
-            # Note: This might require additional permissions depending on the platform
-            g = geocoder.ipinfo('me')  # Using ipinfo instead of geoip
-            if g.ok:
-                return (g.lat, g.lng)
-                
-            # If all else fails, return a default location
-            return (0.0, 0.0)
-        except Exception:
-            # Default coordinates if location detection fails
-            return (0.0, 0.0)
+        self.device_locator.start()
+        return self.device_locator.coordinates
+
+    def staleness_note(self) -> str:
+        """A note on the age of the device location for alerts, empty if it is recent"""
+        age = self.device_locator.age
+        if age is None:
+            return " (device location unknown)"
+        if age > self.stale_after:
+            return f" (device location is {age / 3600:.1f}h old)"
+        return ""
+    
+    def normalize_match(self, message: str) -> str:
+        """
+        Repeats are coalesced by the place the coordinates are near, whatever
+        the coordinates, distances and location age in their messages
+        """
+        return re.sub(r"-?\d+(?:\.\d+)?", "#", super().normalize_match(message))
     
     def calculate_distance(self, lat1: float, lon1: float, lat2: float, lon2: float) -> float:
         """
@@ -84,167 +113,202 @@ class LocationScreener(IndividualScreener):
         
         return distance
 
-    def extract_coordinates(self, text: str) -> List[Tuple[float, float]]:
+    def scan_patterns(self) -> List[Tuple[re.Pattern, bool]]:
+        """Every coordinate pair is checked"""
+        return [(self.coord_pattern, False)]
+
+    def extract_coordinates(
+        self, text: SearchText, scan: ScanResult = DIRECT_SCAN
+    ) -> List[Tuple[float, float]]:
         """Extract all valid coordinate pairs from text."""
-        # Regular expression pattern to match coordinate pairs in the format "latitude,longitude"
-        # Matches decimal numbers (positive or negative) separated by a comma with optional whitespace
-        # Examples: "37.7749,-122.4194" or "37.7749, -122.4194" or "-33.8688, 151.2093"
-        coord_pattern = r"-?\d+\.\d+\s*,\s*-?\d+\.\d+"
-        matches = re.finditer(coord_pattern, text)
+        matches = scan.finditer(self.coord_pattern, text)
         
         coordinates = []
         for match in matches:
             try:
-                lat, lon = map(float, re.split(r'\s*,\s*', match.group()))
+                lat, lon = map(float, re.split(r'\s*,\s*', match_text(match)))
                 if -90 <= lat <= 90 and -180 <= lon <= 180:
                     coordinates.append((lat, lon))
             except ValueError:
                 continue
         return coordinates
 
-    def is_coordinate_pair(self, text: str) -> Tuple[bool, Optional[str]]:
+    def is_coordinate_pair(
+        self, text: SearchText, scan: ScanResult = DIRECT_SCAN
+    ) -> Tuple[bool, Optional[str]]:
         """
         Check if text contains coordinate pairs and if they are close to the device's location.
         Returns (is_coordinate, alert_message)
         """
-        coordinates = self.extract_coordinates(text)
+        coordinates = self.extract_coordinates(text, scan)
         
         if not coordinates:
             return False, None
-            
-        # Refresh device location if more than 15 minutes have passed
-        current_time = time.time()
-        if current_time - self.location_refresh_time > 900:  # 15 minutes
-            self.device_location = self.get_device_location()
-            self.location_refresh_time = current_time
-            
-        device_lat, device_lng = self.device_location
-        
-        for lat, lng in coordinates:
-            distance = self.calculate_distance(device_lat, device_lng, lat, lng)
-            
-            if distance <= self.distance_threshold:
-                return True, f"Detected coordinates ({lat:.4f}, {lng:.4f}) are {distance:.2f}km from your actual location"
+
+        nearby = self.find_nearby(coordinates)
+        if nearby:
+            lat, lng, distance, place = nearby
+            return True, f"Detected coordinates ({lat:.4f}, {lng:.4f}) are {distance:.2f}km from {place}"
         
         # Found coordinates, but they're not close to the device
         return True, "Coordinate pair detected in traffic"
 
-    def extract_json_coordinates(self, data) -> List[Tuple[float, float]]:
-        """Recursively extract coordinates from JSON data"""
+    def coordinates_from_object(
+        self, data: Dict[str, Any]
+    ) -> Optional[Tuple[float, float]]:
+        """Read a coordinate pair from an object with lat/lng or latitude/longitude keys"""
+        # Check for common location patterns in objects
+        if all(k in data for k in ['lat', 'lng']):
+            lat_key, lng_key = 'lat', 'lng'
+        elif all(k in data for k in ['latitude', 'longitude']):
+            lat_key, lng_key = 'latitude', 'longitude'
+        else:
+            return None
+
+        try:
+            lat, lng = float(data[lat_key]), float(data[lng_key])
+        except (ValueError, TypeError):
+            return None
+        if -90 <= lat <= 90 and -180 <= lng <= 180:
+            return (lat, lng)
+        return None
+
+    def extract_json_coordinates(self, json_index: JsonIndex) -> List[Tuple[float, float]]:
+        """Extract coordinates from every object in a flattened JSON document"""
         coordinates = []
-        
-        if isinstance(data, dict):
-            # Check for common location patterns in objects
-            if all(k in data for k in ['lat', 'lng']):
-                try:
-                    lat, lng = float(data['lat']), float(data['lng'])
-                    if -90 <= lat <= 90 and -180 <= lng <= 180:
-                        coordinates.append((lat, lng))
-                except (ValueError, TypeError):
-                    pass
-            elif all(k in data for k in ['latitude', 'longitude']):
-                try:
-                    lat, lng = float(data['latitude']), float(data['longitude'])
-                    if -90 <= lat <= 90 and -180 <= lng <= 180:
-                        coordinates.append((lat, lng))
-                except (ValueError, TypeError):
-                    pass
-                    
-            # Recursively search nested structures
-            for v in data.values():
-                if isinstance(v, (dict, list)):
-                    coordinates.extend(self.extract_json_coordinates(v))
-        elif isinstance(data, list):
-            for item in data:
-                if isinstance(item, (dict, list)):
-                    coordinates.extend(self.extract_json_coordinates(item))
-                    
+        for data in json_index.objects:
+            coordinate = self.coordinates_from_object(data)
+            if coordinate:
+                coordinates.append(coordinate)
         return coordinates
 
-    def check_json_for_location(self, text: str) -> Tuple[bool, Optional[str]]:
+    def find_nearby(
+        self, coordinates: List[Tuple[float, float]]
+    ) -> Optional[Tuple[float, float, float, str]]:
+        """
+        Return the first coordinate near the device or a protected location,
+        its distance and a description of the place it is near
+        """
+        device_lat, device_lng = self.device_location
+        sites = self.geofence.match(coordinates)
+
+        for (lat, lng), site in zip(coordinates, sites):
+            distance = self.calculate_distance(device_lat, device_lng, lat, lng)
+
+            if distance <= self.distance_threshold:
+                return lat, lng, distance, f"your actual location{self.staleness_note()}"
+            if site is not None:
+                return lat, lng, site.distance_km, f"protected location '{site.location.name}'"
+        return None
+
+    def check_json_for_location(
+        self, json_index: Optional[JsonIndex]
+    ) -> Tuple[bool, Optional[str]]:
         """
         Check JSON content for location data, comparing with device location.
         Returns (found_location, alert_message)
         """
-        try:
-            data = json.loads(text)
-            
-            # First, look for coordinates
-            coordinates = self.extract_json_coordinates(data)
-            
-            if coordinates:
-                device_lat, device_lng = self.device_location
-                
-                for lat, lng in coordinates:
-                    distance = self.calculate_distance(device_lat, device_lng, lat, lng)
-                    
-                    if distance <= self.distance_threshold:
-                        return True, f"Detected coordinates ({lat:.4f}, {lng:.4f}) in JSON are {distance:.2f}km from your actual location"
-            
-            # If no nearby coordinates, check for location keywords
-            def search_dict(d):
-                if isinstance(d, dict):
-                    for k, v in d.items():
-                        if isinstance(v, (dict, list)):
-                            if search_dict(v):
-                                return True
-                elif isinstance(d, list):
-                    for item in d:
-                        if search_dict(item):
-                            return True
-                return False
-                
-            if search_dict(data):
-                return True, "Location-related data detected in JSON payload"
-                
+        if json_index is None:
             return False, None
-            
-        except json.JSONDecodeError:
+
+        nearby = self.find_nearby(self.extract_json_coordinates(json_index))
+        if nearby:
+            lat, lng, distance, place = nearby
+            return True, f"Detected coordinates ({lat:.4f}, {lng:.4f}) in JSON are {distance:.2f}km from {place}"
+
+        return False, None
+
+    def check_parameters_for_location(
+        self, parameters: Optional[Dict[str, str]]
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Check form or query parameters for location data, comparing with device location.
+        Returns (found_location, alert_message)
+        """
+        if not parameters:
             return False, None
 
-    def screen(self, search_strings: List[str]) -> Optional[str]:
+        coordinate = self.coordinates_from_object(parameters)
+        nearby = self.find_nearby([coordinate]) if coordinate else None
+        if nearby:
+            lat, lng, distance, place = nearby
+            return True, f"Detected coordinates ({lat:.4f}, {lng:.4f}) in request parameters are {distance:.2f}km from {place}"
+
+        return False, None
+
+    def screen_material(self, context: ScreeningContext) -> Tuple[Tuple[str, Any], ...]:
         """
-        Screen the provided strings for location data.
-        Checks if coordinates are near the device's actual location.
+        What the provided strings hold that could be location data, in the
+        order it is checked.
+
+        Each finding is a (kind, value) pair, either a "message" alerted as
+        is, or "pairs", "json" or "parameters" coordinates, which verdict
+        compares with the device location since that moves. Nothing after a
+        message or coordinate pairs is looked at, as those decide the verdict.
         """
-        for search_string in search_strings:
+        findings: List[Tuple[str, Any]] = []
+        for search_string, lowered in zip(context.search_strings, context.lowered):
             # Skip empty strings
             if not search_string:
                 continue
 
             # Check for suspicious hosts
-            if any(host in search_string.lower() for host in self.suspicious_hosts):
-                return f"Request to known location service detected"
+            if any(context.contains(lowered, host) for host in self.suspicious_hosts):
+                findings.append(("message", "Request to known location service detected"))
+                break
 
             # Check for coordinate pairs
-            is_coord, coord_message = self.is_coordinate_pair(search_string)
-            if is_coord:
-                return coord_message
+            coordinates = self.extract_coordinates(search_string, context.scan)
+            if coordinates:
+                findings.append(("pairs", tuple(coordinates)))
+                break
 
-            # Check JSON content
-            json_found, json_message = self.check_json_for_location(search_string)
-            if json_found:
-                return json_message
+            # Check JSON content, parsed once per flow
+            json_index = context.structured.json_index_for(search_string)
+            if json_index is not None:
+                coordinates = self.extract_json_coordinates(json_index)
+                if coordinates:
+                    findings.append(("json", tuple(coordinates)))
+
+            # Check form and query parameters
+            parameters = context.structured.parameters_for(search_string)
+            coordinate = self.coordinates_from_object(parameters) if parameters else None
+            if coordinate:
+                findings.append(("parameters", (coordinate,)))
 
             # Check for location keywords in headers or URL as a last resort
-            for keyword in self.location_keywords:
-                if keyword in search_string.lower():
-                    return f"Location-related keyword '{keyword}' detected"
+            keyword = next(
+                (keyword for keyword in self.location_keywords if context.contains(lowered, keyword)),
+                None,
+            )
+            if keyword is not None:
+                findings.append(("message", f"Location-related keyword '{keyword}' detected"))
+                break
 
-        return None
+        return tuple(findings)
 
-    def request(self, flow: http.HTTPFlow) -> None:
-        """Override request to implement rate limiting"""
-        app_id = flow.request.host
-        current_time = time.time()
-        
-        # Reset counters if more than 10 minutes have passed
-        if current_time - self.last_alert_time > 600:
-            self.app_alerts.clear()
-            self.last_alert_time = current_time
+    def verdict(
+        self, context: ScreeningContext, found: Tuple[Tuple[str, Any], ...]
+    ) -> Optional[str]:
+        """Check the coordinates found against the device's current location"""
+        for kind, value in found:
+            if kind == "message":
+                return value
 
-        # Call parent's request method
-        super().request(flow)
-        
-        # Increment alert counter for this app
-        self.app_alerts[app_id] += 1
\ No newline at end of file
+            nearby = self.find_nearby(list(value))
+            if nearby:
+                lat, lng, distance, place = nearby
+                where = {"pairs": "", "json": " in JSON", "parameters": " in request parameters"}[kind]
+                return f"Detected coordinates ({lat:.4f}, {lng:.4f}){where} are {distance:.2f}km from {place}"
+            if kind == "pairs":
+                # Found coordinates, but they're not close to the device
+                return "Coordinate pair detected in traffic"
+
+        return None
+
+    def screen(self, context: ScreeningContext) -> Optional[str]:
+        """
+        Screen the provided strings for location data.
+        Checks if coordinates are near the device's actual location.
+        """
+        return self.verdict(context, self.screen_material(context))
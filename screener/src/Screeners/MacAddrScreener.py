@@ -1,6 +1,6 @@
 from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
 from Screeners.RegexScreener import RegexScreener
-import sqlite3
 
 
 class MacAddrScreener(RegexScreener):
@@ -13,13 +13,13 @@ class MacAddrScreener(RegexScreener):
 
     def __init__(
         self,
-        db_connection: sqlite3.Connection,
+        alert_writer: AlertSink,
     ) -> None:
         """
         Initialize the MacAddrScreener with the MAC address regex pattern.
 
         Args:
-            db_connection: SQLite database connection
+            alert_writer: Where triggered alerts are sent
         """
 
         alert_setup: AlertSetup = AlertSetup(
@@ -29,4 +29,4 @@ class MacAddrScreener(RegexScreener):
         )
 
         mac_pattern = r"(?:[0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}"
-        super().__init__(alert_setup, db_connection, mac_pattern)
+        super().__init__(alert_setup, alert_writer, mac_pattern)
@@ -1,9 +1,11 @@
 import re
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
+from MatchEngine import match_text
+from ScreeningContext import ScreeningContext
 from Screeners import IndividualScreener
-import sqlite3
 
 
 class RegexScreener(IndividualScreener):
@@ -14,7 +16,7 @@ class RegexScreener(IndividualScreener):
     def __init__(
         self,
         alert_setup: AlertSetup,
-        db_connection: sqlite3.Connection,
+        alert_writer: AlertSink,
         regex_pattern: str,
     ) -> None:
         """
@@ -22,22 +24,26 @@ class RegexScreener(IndividualScreener):
 
         Args:
             alert_setup: The alert configuration
-            db_connection: SQLite database connection
+            alert_writer: Where triggered alerts are sent
             regex_pattern: The regular expression pattern to match
         """
-        super().__init__(alert_setup, db_connection)
+        super().__init__(alert_setup, alert_writer)
         self.pattern = re.compile(regex_pattern)
 
-    def screen(self, search_strings: List[str]) -> Optional[str]:
+    def scan_patterns(self) -> List[Tuple[re.Pattern, bool]]:
+        """Only the first match of the pattern is reported"""
+        return [(self.pattern, True)]
+
+    def screen(self, context: ScreeningContext) -> Optional[str]:
         """
         Screen the given strings against the regex pattern.
 
         Returns:
             A message describing the match if found, None otherwise
         """
-        for search_string in search_strings:
-            match = self.pattern.search(search_string)
+        for search_string in context.search_strings:
+            match = context.scan.search(self.pattern, search_string)
             if match:
-                return f"Found '{match.group()}' matching pattern '{self.pattern.pattern}' in traffic"
+                return f"Found '{match_text(match)}' matching pattern '{self.pattern.pattern}' in traffic"
 
         return None
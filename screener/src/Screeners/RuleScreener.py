@@ -0,0 +1,85 @@
+from typing import Any, Hashable, List, Optional
+
+from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
+from RuleEngine import Rule, RuleSet, load_rules
+from ScreeningContext import ScreeningContext
+from Screeners.IndividualScreener import IndividualScreener
+
+
+class RuleScreener(IndividualScreener):
+    """
+    RuleScreener raises the alert of one rule of a RuleSet.
+
+    Every rule of a set gets its own screener, so each raises its own alert
+    with its own name and severity, but the rules are matched together: the
+    first screener of the set to look at a flow runs the whole set over it,
+    and the others read their verdict from what it found.
+    """
+
+    rule_set: RuleSet
+    """The compiled rules the rule belongs to"""
+
+    index: int
+    """The index of the rule in the set"""
+
+    def __init__(self, alert_writer: AlertSink, rule_set: RuleSet, index: int) -> None:
+        """
+        Args:
+            alert_writer: Where triggered alerts are sent
+            rule_set: The compiled rules the rule belongs to
+            index: The index of the rule in the set
+        """
+        rule = rule_set.rules[index]
+        alert_setup: AlertSetup = AlertSetup(
+            alert_name=rule.alert_name,
+            type=rule.type or rule.name,
+            severity=rule.severity,
+        )
+        super().__init__(alert_setup, alert_writer)
+        self.rule_set = rule_set
+        self.index = index
+
+    @property
+    def rule(self) -> Rule:
+        return self.rule_set.rules[self.index]
+
+    def run_screen_material(self, context: ScreeningContext) -> Any:
+        """
+        The rule's verdict on the context.
+
+        The set records the screener metrics once for all of its rules, under
+        RuleScreener, rather than each rule recording a lookup.
+        """
+        return self.screen(context)
+
+    def screen(self, context: ScreeningContext) -> Optional[str]:
+        return self.rule_set.matches(context).get(self.index)
+
+    def cache_state(self) -> Hashable:
+        """Which rule of which rules this is"""
+        return (self.rule_set.digest, self.index)
+
+
+def build_rule_screeners(
+    alert_writer: AlertSink,
+    path: Optional[str] = None,
+    rules: Optional[List[Rule]] = None,
+) -> List[RuleScreener]:
+    """
+    Compile the rules of a rules file, or the rules given, into one RuleSet
+    and build a screener for each of them.
+
+    Args:
+        alert_writer: Where triggered alerts are sent
+        path: A TOML, YAML or JSON rules file, see load_rules
+        rules: The rules to use instead of a file
+    """
+    if rules is None:
+        if path is None:
+            raise ValueError("The rules screeners need a rules file path or rules")
+        rules = load_rules(path)
+
+    rule_set = RuleSet(rules)
+    print(f"Compiled {rule_set.describe()}")
+    return [RuleScreener(alert_writer, rule_set, index) for index in range(len(rule_set))]
@@ -1,10 +1,11 @@
 from AlertSetup import AlertSetup
+from AlertWriter import AlertSink
+from MatchEngine import DIRECT_SCAN, ScanResult, SearchText, match_text
+from ScreeningContext import ScreeningContext
 from Screeners.IndividualScreener import IndividualScreener
-import sqlite3
-from typing import List, Optional
+from typing import List, Optional, Tuple
+from WindowedRate import WindowedRate
 import re
-from collections import defaultdict
-import time
 
 class TimestampScreener(IndividualScreener):
     """
@@ -13,20 +14,25 @@ class TimestampScreener(IndividualScreener):
     - Unix timestamps (e.g., 1709663548)
     - ISO 8601 timestamps (e.g., 2024-03-05T19:32:28Z)
     - Common date formats (e.g., 2024-03-05, 03/05/2024)
+
+    Requests with timestamps are counted per application in a WindowedRate,
+    which keeps the memory and time this takes bounded on a busy proxy.
     """
 
-    def __init__(self, db_connection: sqlite3.Connection) -> None:
+    def __init__(self, alert_writer: AlertSink, max_apps: int = 10000) -> None:
         alert_setup: AlertSetup = AlertSetup(
             alert_name="Excessive Timestamps",
             type="timestamps",
             severity=2,  # Medium-low severity
         )
-        super().__init__(alert_setup, db_connection)
+        super().__init__(alert_setup, alert_writer)
         
-        # Track timestamps per application within time windows
-        self.app_timestamps = defaultdict(list)
         self.THRESHOLD = 5  # Alert if more than 5 timestamps in window
         self.TIME_WINDOW = 60  # 60 second window
+
+        # Count timestamp-containing requests per application within the window,
+        # forgetting applications that have gone quiet
+        self.app_timestamps = WindowedRate(self.TIME_WINDOW, max_keys=max_apps)
         
         # Timestamp patterns
         self.patterns = [
@@ -67,58 +73,67 @@ class TimestampScreener(IndividualScreener):
         except ValueError:
             return False
 
-    def cleanup_old_timestamps(self, app_id: str) -> None:
-        """Remove timestamps outside the current time window"""
-        current_time = time.time()
-        self.app_timestamps[app_id] = [
-            ts for ts in self.app_timestamps[app_id]
-            if current_time - ts < self.TIME_WINDOW
-        ]
+    def normalize_match(self, message: str) -> str:
+        """Repeats are coalesced whatever the counts in their messages"""
+        return re.sub(r"\d+", "#", super().normalize_match(message))
+
+    def scan_patterns(self) -> List[Tuple[re.Pattern, bool]]:
+        """Every timestamp match is counted"""
+        return [(self.timestamp_pattern, False)]
 
-    def find_timestamps(self, text: str) -> List[str]:
+    def find_timestamps(self, text: SearchText, scan: ScanResult = DIRECT_SCAN) -> List[str]:
         """Find all timestamp patterns in the given text"""
-        matches = self.timestamp_pattern.finditer(text)
+        matches = (match_text(match) for match in scan.finditer(self.timestamp_pattern, text))
         return [
-            match.group() for match in matches
-            if self.is_valid_timestamp(match.group())
+            timestamp for timestamp in matches
+            if self.is_valid_timestamp(timestamp)
         ]
 
-    def screen(self, search_strings: List[str]) -> Optional[str]:
-        """
-        Screen the provided strings for timestamp patterns.
-        Alerts if too many timestamps are found within the time window.
-        """
+    def screen_material(self, context: ScreeningContext) -> int:
+        """The number of timestamps in the provided strings"""
         timestamps_found = []
         
-        for search_string in search_strings:
+        for search_string in context.search_strings:
             if not search_string:
                 continue
                 
-            timestamps_found.extend(self.find_timestamps(search_string))
-        
-        if not timestamps_found:
+            timestamps_found.extend(self.find_timestamps(search_string, context.scan))
+
+        return len(timestamps_found)
+
+    def verdict(self, context: ScreeningContext, found: int) -> Optional[str]:
+        """
+        Count a request with timestamps in the window of its application.
+        Alerts if too many timestamps are found within the time window.
+
+        This runs for every request, so repeats whose timestamps were counted
+        from the verdict cache are still counted in the window.
+        """
+        if not found:
             return None
             
         # Use the host as the app identifier
-        app_id = (
-            search_strings[1].split("/")[2]  # URL is typically the second search string
-            if len(search_strings) > 1 and "/" in search_strings[1]
-            else "unknown"
-        )
-        
-        # Cleanup old timestamps
-        self.cleanup_old_timestamps(app_id)
-        
-        # Add current timestamp
-        current_time = time.time()
-        self.app_timestamps[app_id].append(current_time)
+        app_id = context.host
         
+        # the time the request was sent, so replayed traffic is windowed as it happened
+        current_time = context.timestamp
+
+        # Count this request, along with the others in the window
+        recent_count = self.app_timestamps.add(app_id, current_time)
+
         # Check if we've exceeded the threshold
-        if len(self.app_timestamps[app_id]) > self.THRESHOLD:
+        if recent_count > self.THRESHOLD:
             return (
-                f"Detected {len(timestamps_found)} timestamps in request. "
-                f"Application has sent {len(self.app_timestamps[app_id])} "
+                f"Detected {found} timestamps in request. "
+                f"Application has sent {recent_count} "
                 f"timestamp-containing requests in the last {self.TIME_WINDOW} seconds."
             )
             
-        return None 
\ No newline at end of file
+        return None
+
+    def screen(self, context: ScreeningContext) -> Optional[str]:
+        """
+        Screen the provided strings for timestamp patterns.
+        Alerts if too many timestamps are found within the time window.
+        """
+        return self.verdict(context, self.screen_material(context))
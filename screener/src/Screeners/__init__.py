@@ -1,17 +1,30 @@
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
 from .IndividualScreener import IndividualScreener
-from .MacAddrScreener import MacAddrScreener
-from .FileNameScreener import FileNameScreener
-from .EnvVarScreener import EnvVarScreener
-from .ClipboardScreener import ClipboardScreener
-from .TimestampScreener import TimestampScreener
-from .LocationScreener import LocationScreener
+
+if TYPE_CHECKING:
+    from .MacAddrScreener import MacAddrScreener
+    from .FileNameScreener import FileNameScreener
+    from .EnvVarScreener import EnvVarScreener
+    from .TimestampScreener import TimestampScreener
+    from .LocationScreener import LocationScreener
+    from .RuleScreener import RuleScreener
 
 __all__ = [
     "IndividualScreener",
     "MacAddrScreener",
     "FileNameScreener",
     "EnvVarScreener",
-    "ClipboardScreener",
     "TimestampScreener",
     "LocationScreener",
+    "RuleScreener",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    # each screener is imported the first time it is used, so disabled
+    # screeners never pull in their dependencies
+    if name in __all__:
+        return getattr(import_module(f".{name}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,254 @@
+import codecs
+from functools import cached_property
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from mitmproxy import http, tcp
+from mitmproxy.net.http.headers import infer_content_encoding
+
+from MatchEngine import DIRECT_SCAN, MatchEngine, ScanResult, SearchText
+from StructuredBody import StructuredBody
+
+
+# Encodings that decode ASCII bytes to the same characters
+_ASCII_COMPATIBLE = {"ascii", "utf-8", "iso8859-1", "cp1252", "gb18030"}
+
+# Lowercases bytes the way str.lower lowercases their latin-1 characters
+_LATIN1_LOWER = bytes(ord(chr(code).lower()) for code in range(256))
+
+
+class ScreeningContext:
+    """
+    ScreeningContext holds the material screened for a single flow.
+
+    It is built once per flow and shared by every screener. Each piece of
+    material is computed the first time it is used and memoized, so decoding
+    the body or formatting the headers happens at most once per flow no matter
+    how many screeners look at it.
+
+    Bodies that decode one byte to one character of the same code point,
+    which is every latin-1 body and every ASCII body, are screened as raw
+    bytes and never decoded unless a screener asks for body.
+    """
+
+    flow: http.HTTPFlow
+    """The flow being screened"""
+
+    match_engine: Optional[MatchEngine]
+    """The engine used to prescan the search strings, if any"""
+
+    overlap: int = 0
+    """Leading characters of the search strings that were already screened"""
+
+    kind: str = "http"
+    """The kind of traffic screened, used to label metrics"""
+
+    def __init__(
+        self, flow: http.HTTPFlow, match_engine: Optional[MatchEngine] = None
+    ) -> None:
+        self.flow = flow
+        self.match_engine = match_engine
+
+    @cached_property
+    def timestamp(self) -> float:
+        """When the request was sent, which is in the past for replayed traffic"""
+        return self.flow.request.timestamp_start or time.time()
+
+    @cached_property
+    def body(self) -> str:
+        """The decoded request body, surrogate-escaped where it isn't valid in its charset"""
+        return self.flow.request.get_text(strict=False) or ""
+
+    @cached_property
+    def raw_body(self) -> bytes:
+        """The request body with any Content-Encoding undone, but not decoded to text"""
+        return self.flow.request.get_content(strict=False) or b""
+
+    @cached_property
+    def body_is_bytes(self) -> bool:
+        """Whether the body is screened as raw bytes rather than as decoded text"""
+        if not self.raw_body:
+            return False
+        try:
+            encoding = codecs.lookup(
+                infer_content_encoding(self.content_type, self.raw_body)
+            ).name
+        except LookupError:
+            return False
+        if encoding == "iso8859-1":
+            return True
+        return encoding in _ASCII_COMPATIBLE and self.raw_body.isascii()
+
+    @cached_property
+    def search_body(self) -> SearchText:
+        """The body as it is screened, raw bytes or decoded text"""
+        return self.raw_body if self.body_is_bytes else self.body
+
+    @cached_property
+    def url(self) -> str:
+        """The full request URL"""
+        return self.flow.request.url or ""
+
+    @cached_property
+    def host(self) -> str:
+        """The host (and port, if given) the request is sent to"""
+        parts = self.url.split("/")
+        return parts[2] if len(parts) > 2 else "UNKNOWN"
+
+    @cached_property
+    def headers_text(self) -> str:
+        """The request headers formatted as a single string"""
+        if not self.flow.request.headers:
+            return ""
+        return str(self.flow.request.headers)
+
+    @cached_property
+    def headers(self) -> List[Tuple[str, str]]:
+        """The individual request headers as (name, value) pairs"""
+        return list(self.flow.request.headers.items(multi=True))
+
+    @cached_property
+    def content_type(self) -> str:
+        """The raw Content-Type header of the request"""
+        return self.flow.request.headers.get("Content-Type", "")
+
+    @cached_property
+    def user_agent(self) -> str:
+        """The User-Agent of the application that sent the request"""
+        return self.flow.request.headers.get("User-Agent", "UNKNOWN")
+
+    @cached_property
+    def search_strings(self) -> List[SearchText]:
+        """
+        The non-empty body, URL and headers, in that order.
+
+        The body is bytes if body_is_bytes, see match_text for reading matches.
+        """
+        return [text for text in (self.search_body, self.url, self.headers_text) if text]
+
+    @cached_property
+    def size(self) -> int:
+        """The number of characters screened"""
+        return sum(len(text) for text in self.search_strings)
+
+    @cached_property
+    def lowered(self) -> List[SearchText]:
+        """The search strings in lowercase, index for index"""
+        return [
+            text.translate(_LATIN1_LOWER) if isinstance(text, bytes) else text.lower()
+            for text in self.search_strings
+        ]
+
+    @cached_property
+    def scan(self) -> ScanResult:
+        """The prescanned pattern matches for the search strings"""
+        if self.match_engine is None:
+            return ScanResult(self.overlap) if self.overlap else DIRECT_SCAN
+        return self.match_engine.scan(self.search_strings, self.overlap)
+
+    @cached_property
+    def structured(self) -> StructuredBody:
+        """The JSON, form and query views of the request, parsed on demand"""
+        return StructuredBody(self)
+
+    @cached_property
+    def shared(self) -> Dict[Hashable, Any]:
+        """
+        Results worked out once per flow for several screeners, such as the
+        matches of a RuleSet, keyed by whatever worked them out
+        """
+        return {}
+
+    def contains(self, text: SearchText, needle: str) -> bool:
+        """Whether needle occurs in text other than within the overlap"""
+        start = max(0, self.overlap - len(needle) + 1)
+        if isinstance(text, bytes):
+            try:
+                return text.find(needle.encode("latin-1"), start) != -1
+            except UnicodeEncodeError:
+                return False
+        return text.find(needle, start) != -1
+
+
+class TcpScreeningContext(ScreeningContext):
+    """
+    The screening context of a single TCP message.
+
+    The message is screened as one search string, decoded as latin-1 so every
+    byte maps to one character. The tail of the previous message in the same
+    direction is put in front of it so that values split across segments are
+    still found, and overlap marks how much of the string that tail takes up.
+    """
+
+    flow: tcp.TCPFlow  # type: ignore[assignment]
+    """The connection the message was sent on"""
+
+    message: tcp.TCPMessage
+    """The message being screened"""
+
+    text: str
+    """The carried over tail followed by the decoded message"""
+
+    kind = "tcp"
+
+    def __init__(
+        self,
+        flow: tcp.TCPFlow,
+        message: tcp.TCPMessage,
+        text: str,
+        overlap: int = 0,
+        match_engine: Optional[MatchEngine] = None,
+    ) -> None:
+        """
+        Args:
+            flow: The connection the message was sent on
+            message: The message being screened
+            text: The carried over tail followed by the decoded message
+            overlap: The length of the carried over tail
+            match_engine: The engine used to prescan the text, if any
+        """
+        super().__init__(flow, match_engine)  # type: ignore[arg-type]
+        self.message = message
+        self.overlap = overlap
+        self.text = text
+
+    @cached_property
+    def timestamp(self) -> float:
+        """When the message was sent"""
+        return self.message.timestamp or time.time()
+
+    @property
+    def body(self) -> str:
+        return self.text
+
+    @property
+    def search_body(self) -> SearchText:
+        return self.text
+
+    @property
+    def url(self) -> str:
+        return ""
+
+    @cached_property
+    def host(self) -> str:
+        """The address of the server end of the connection"""
+        address = self.flow.server_conn.address if self.flow.server_conn else None
+        if not address:
+            return "UNKNOWN"
+        return f"{address[0]}:{address[1]}"
+
+    @property
+    def headers_text(self) -> str:
+        return ""
+
+    @property
+    def headers(self) -> List[Tuple[str, str]]:
+        return []
+
+    @property
+    def content_type(self) -> str:
+        return ""
+
+    @property
+    def user_agent(self) -> str:
+        return "UNKNOWN"
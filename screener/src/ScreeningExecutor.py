@@ -0,0 +1,350 @@
+import asyncio
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+import multiprocessing
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from mitmproxy import http, tcp
+
+from MatchEngine import MatchEngine
+from Metrics import FLOW_SECONDS, FlowProfiler
+from ScreeningContext import ScreeningContext, TcpScreeningContext
+from Screeners.IndividualScreener import IndividualScreener
+from VerdictCache import VerdictCache
+
+
+Verdicts = List[Tuple[int, str]]
+"""(index of the screener, alert message) for every screener that triggered"""
+
+VerdictHandler = Callable[[ScreeningContext, Verdicts], None]
+"""Called on the event loop with the verdicts of a screened flow"""
+
+
+def build_match_engine(screeners: List[IndividualScreener]) -> MatchEngine:
+    """Build a MatchEngine for the scan patterns of every screener"""
+    match_engine = MatchEngine()
+    for screener in screeners:
+        for pattern, first_only in screener.scan_patterns():
+            match_engine.register(pattern, first_only)
+    return match_engine
+
+
+def screen_all(
+    screeners: List[IndividualScreener],
+    context: ScreeningContext,
+    profiler: Optional[FlowProfiler] = None,
+    cache: Optional[VerdictCache] = None,
+) -> Verdicts:
+    """
+    Run every screener over a context without triggering any alerts.
+
+    With a cache, material that was screened before isn't screened again,
+    only the verdicts on what was found in it are. The flow is profiled if
+    the profiler samples it.
+    """
+    verdicts: Verdicts = []
+    start = time.perf_counter()
+    with profiler.profile(context.flow.id) if profiler else nullcontext():
+        found = None
+        if cache is not None:
+            key = cache.key(screeners, context)
+            found = cache.get(key)
+        if found is None:
+            found = [screener.run_screen_material(context) for screener in screeners]
+            if cache is not None:
+                cache.put(key, found)
+        for index, (screener, result) in enumerate(zip(screeners, found)):
+            message = screener.run_verdict(context, result)
+            if message:
+                verdicts.append((index, message))
+    FLOW_SECONDS.labels(context.kind).observe(time.perf_counter() - start)
+    return verdicts
+
+
+# Each worker process builds its own screeners, engine and cache once, in _init_worker
+_worker_screeners: List[IndividualScreener] = []
+_worker_engine: Optional[MatchEngine] = None
+_worker_cache: Optional[VerdictCache] = None
+
+
+def _init_worker(
+    factory: Callable[[], List[IndividualScreener]],
+    cache_factory: Optional[Callable[[], VerdictCache]] = None,
+) -> None:
+    global _worker_screeners, _worker_engine, _worker_cache
+    _worker_screeners = factory()
+    _worker_engine = build_match_engine(_worker_screeners)
+    _worker_cache = cache_factory() if cache_factory is not None else None
+
+
+def _screen_in_worker(kind: str, state: Any, text: str, overlap: int) -> Verdicts:
+    """Rebuild a flow from its state in a worker process and screen it"""
+    if kind == "tcp":
+        tcp_flow = tcp.TCPFlow.from_state(state)
+        context: ScreeningContext = TcpScreeningContext(
+            tcp_flow, tcp_flow.messages[-1], text, overlap, _worker_engine
+        )
+    else:
+        context = ScreeningContext(http.HTTPFlow.from_state(state), _worker_engine)
+    return screen_all(_worker_screeners, context, cache=_worker_cache)
+
+
+@dataclass
+class ScreeningExecutorStats:
+    """Counters describing the work handed to the executor"""
+
+    submitted: int = 0
+    """Flows handed to the pool"""
+
+    completed: int = 0
+    """Flows screened within their deadline"""
+
+    timed_out: int = 0
+    """Flows whose deadline passed before screening finished"""
+
+    late: int = 0
+    """Timed out flows whose verdicts were applied once screening finished"""
+
+    failed: int = 0
+    """Flows whose screening raised an exception"""
+
+    shed: int = 0
+    """Flows let through unscreened because the in-flight limit was reached"""
+
+    max_in_flight: int = 0
+    """Highest number of flows being screened at once"""
+
+
+class ScreeningExecutor:
+    """
+    ScreeningExecutor screens flows on a worker pool, off the event loop.
+
+    Contexts are built on the event loop and screened on a pool of threads
+    or processes, and the verdicts are applied back on the loop, where the
+    alerts are queued for the AlertWriter. Screening never touches the
+    database.
+
+    In hold mode the hook awaits the verdict, so mitmproxy holds the flow
+    until screening finishes or the deadline passes. Otherwise the flow goes
+    through at once and any alerts are raised after the fact. Either way, a
+    flow that misses its deadline keeps being screened and its alerts are
+    raised when it finishes.
+
+    At most max_in_flight flows are screened at once. When the limit is
+    reached, held flows wait for a slot and passthrough flows go unscreened.
+
+    In process mode each worker builds its own screeners with worker_factory,
+    so state such as the timestamp rate windows is kept per worker, and so
+    are the verdict cache, the screener metrics and profiles, which the
+    parent never sees.
+    """
+
+    THREAD = "thread"
+    PROCESS = "process"
+
+    mode: str
+    """Whether flows are screened on threads or processes"""
+
+    hold: bool
+    """Whether flows are held until they are screened"""
+
+    deadline: Optional[float]
+    """The number of seconds a flow is held at most, None to wait forever"""
+
+    max_in_flight: int
+    """The maximum number of flows screened at once"""
+
+    verdict_cache: Optional[VerdictCache]
+    """Remembers what was found in material already screened, None to screen everything"""
+
+    stats: ScreeningExecutorStats
+    """Dispatch counters"""
+
+    def __init__(
+        self,
+        screeners: List[IndividualScreener],
+        match_engine: Optional[MatchEngine] = None,
+        mode: str = THREAD,
+        max_workers: int = 4,
+        max_in_flight: int = 256,
+        deadline: Optional[float] = 2.0,
+        hold: bool = True,
+        worker_factory: Optional[Callable[[], List[IndividualScreener]]] = None,
+        profiler: Optional[FlowProfiler] = None,
+        verdict_cache: Optional[VerdictCache] = None,
+    ) -> None:
+        """
+        Args:
+            screeners: The screeners flows are screened with in thread mode
+            match_engine: The engine contexts are prescanned with in thread mode
+            mode: "thread" or "process"
+            max_workers: The size of the pool
+            max_in_flight: The maximum number of flows screened at once
+            deadline: The number of seconds a flow is held at most
+            hold: Whether flows are held until they are screened
+            worker_factory: Builds the screeners of each worker process,
+                required in process mode and must be picklable
+            profiler: Profiles a sample of flows in thread mode
+            verdict_cache: Shared by the threads in thread mode, each worker
+                process builds an empty one with the same limits
+        """
+        self.screeners = screeners
+        self.match_engine = match_engine
+        self.mode = mode
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.hold = hold
+        self.profiler = profiler
+        self.verdict_cache = verdict_cache
+        self.stats = ScreeningExecutorStats()
+
+        self._pool: Executor
+        if mode == self.THREAD:
+            self._pool = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="screener"
+            )
+        elif mode == self.PROCESS:
+            if worker_factory is None:
+                raise ValueError("Process mode needs a worker_factory")
+            # spawn, since forking a process with running threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(
+                    worker_factory,
+                    verdict_cache.factory() if verdict_cache is not None else None,
+                ),
+            )
+        else:
+            raise ValueError(f"Unknown screening mode: {mode}")
+
+        # held flows wait for a slot, passthrough flows are shed without one
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        """The number of flows being screened"""
+        return self._in_flight
+
+    def dispatch(
+        self, context: ScreeningContext, on_verdicts: VerdictHandler
+    ) -> Optional[Awaitable[None]]:
+        """
+        Screen a context on the pool. Must be called on the event loop.
+
+        Returns an awaitable to hold the flow with in hold mode, None otherwise.
+        """
+        if self.hold:
+            return self._screen_held(context, on_verdicts)
+
+        if self._in_flight >= self.max_in_flight:
+            self.stats.shed += 1
+            return None
+        self._reserve()
+        self._track(self._screen(context, on_verdicts))
+        return None
+
+    async def drain(self) -> None:
+        """Wait until every flow dispatched so far has been screened"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def close(self) -> None:
+        """Stop the pool, waiting for work already on it"""
+        self._pool.shutdown(wait=True)
+
+    def _track(self, coroutine: Awaitable[None]) -> None:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _submit(self, context: ScreeningContext) -> Future:
+        """Hand a context to the pool"""
+        if self.mode == self.THREAD:
+            return self._pool.submit(
+                screen_all, self.screeners, context, self.profiler, self.verdict_cache
+            )
+
+        if isinstance(context, TcpScreeningContext):
+            # send only the screened message, not the whole connection
+            flow = tcp.TCPFlow(context.flow.client_conn, context.flow.server_conn)
+            flow.id = context.flow.id
+            flow.messages = [context.message]
+            return self._pool.submit(
+                _screen_in_worker, "tcp", flow.get_state(), context.text, context.overlap
+            )
+        return self._pool.submit(
+            _screen_in_worker, "http", context.flow.get_state(), "", 0
+        )
+
+    def _reserve(self) -> None:
+        self._in_flight += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self._in_flight)
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        if self.hold:
+            self._slots.release()
+
+    async def _screen_held(
+        self, context: ScreeningContext, on_verdicts: VerdictHandler
+    ) -> None:
+        await self._slots.acquire()
+        self._reserve()
+        await self._screen(context, on_verdicts)
+
+    async def _screen(
+        self, context: ScreeningContext, on_verdicts: VerdictHandler
+    ) -> None:
+        """Screen a context that holds a slot, and apply its verdicts"""
+        try:
+            future = self._submit(context)
+        except Exception as e:
+            self._release()
+            self.stats.failed += 1
+            print(f"Failed to submit flow for screening: {e}")
+            return
+
+        # the slot is held until the work is done, even past the deadline
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        self.stats.submitted += 1
+
+        verdicts_future = asyncio.wrap_future(future)
+        try:
+            verdicts = await asyncio.wait_for(
+                asyncio.shield(verdicts_future), self.deadline
+            )
+        except asyncio.TimeoutError:
+            self.stats.timed_out += 1
+            self._track(self._finish_late(verdicts_future, context, on_verdicts))
+            return
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"Failed to screen flow {context.flow.id}: {e}")
+            return
+
+        self.stats.completed += 1
+        on_verdicts(context, verdicts)
+
+    async def _finish_late(
+        self,
+        verdicts_future: "asyncio.Future[Verdicts]",
+        context: ScreeningContext,
+        on_verdicts: VerdictHandler,
+    ) -> None:
+        """Apply the verdicts of a flow that missed its deadline"""
+        try:
+            verdicts = await verdicts_future
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"Failed to screen flow {context.flow.id}: {e}")
+            return
+
+        self.stats.late += 1
+        on_verdicts(context, verdicts)
@@ -0,0 +1,360 @@
+from abc import ABC, abstractmethod
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+from AhoCorasick import AhoCorasick
+
+
+class SecretSource(ABC):
+    """
+    A source of secret values to watch for.
+
+    Subclasses implement load, which returns a mapping of a human readable
+    name to the secret value, and fingerprint, which changes whenever the
+    source's contents may have changed.
+    """
+
+    @abstractmethod
+    def load(self) -> Dict[str, str]:
+        """The secrets of the source by name"""
+        pass
+
+    @abstractmethod
+    def fingerprint(self) -> Hashable:
+        """A value that changes whenever the secrets may have changed"""
+        pass
+
+
+class StaticSource(SecretSource):
+    """
+    Secrets given directly in code or configuration.
+
+    The values are held in plaintext for as long as the source exists, so the
+    index can load them again whenever it is rebuilt.
+    """
+
+    def __init__(self, secrets: Dict[str, str]) -> None:
+        self.secrets = dict(secrets)
+
+    def load(self) -> Dict[str, str]:
+        return dict(self.secrets)
+
+    def fingerprint(self) -> Hashable:
+        return None
+
+
+class EnvironmentSource(SecretSource):
+    """Secrets in the environment of the screener process"""
+
+    DEFAULT_NAME_PATTERN = (
+        r"(?i)(?!GOOGLE_APPLICATION_CREDENTIALS$)(?!.*_(?:PATH|FILE|DIR|SOCK)$)"
+        r"(?:.*_)?"
+        r"(?:SECRETS?|TOKENS?|PASSWORD|PASSWD|CREDENTIALS?|(?:API|ACCESS|PRIVATE)_?KEY)"
+        r"(?:_.*)?"
+    )
+    """
+    Names with one of the words as a whole underscore separated part, so
+    variables holding ordinary paths, like XAUTHORITY, SSH_AUTH_SOCK or
+    GNOME_KEYRING_CONTROL, are not mistaken for secrets. Names of the files
+    secrets are kept in, like GOOGLE_APPLICATION_CREDENTIALS or ones ending
+    in _PATH, _FILE, _DIR or _SOCK, are left out too
+    """
+
+    def __init__(self, name_pattern: str = DEFAULT_NAME_PATTERN) -> None:
+        """
+        Args:
+            name_pattern: Only variables whose name fully matches this pattern
+                are treated as secrets
+        """
+        self.name_pattern = re.compile(name_pattern)
+
+    def load(self) -> Dict[str, str]:
+        return {
+            f"environment variable {name}": value
+            for name, value in os.environ.items()
+            if self.name_pattern.fullmatch(name)
+        }
+
+    def fingerprint(self) -> Hashable:
+        return hashlib.blake2b(
+            repr(sorted(self.load().items())).encode(), digest_size=16
+        ).digest()
+
+
+class FileSource(SecretSource):
+    """A secret source backed by a file, reloaded when the file changes"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def fingerprint(self) -> Hashable:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self) -> Dict[str, str]:
+        try:
+            with open(self.path, "r") as f:
+                return self.parse(f.read())
+        except (OSError, ValueError) as e:
+            print(f"Failed to load secrets from {self.path}: {e}")
+            return {}
+
+    @abstractmethod
+    def parse(self, content: str) -> Dict[str, str]:
+        """The secrets in the content of the file by name"""
+        pass
+
+
+class DotEnvSource(FileSource):
+    """Secrets in a .env file of KEY=VALUE lines"""
+
+    def parse(self, content: str) -> Dict[str, str]:
+        found = {}
+        for line in content.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            if line.startswith("export "):
+                line = line[len("export ") :]
+
+            name, value = line.split("=", 1)
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+                value = value[1:-1]
+            found[f"{name.strip()} from {self.path}"] = value
+        return found
+
+
+class VaultExportSource(FileSource):
+    """
+    Secrets in a JSON export from a secret store.
+
+    Every string in the document is treated as a secret and named by its path.
+    """
+
+    def parse(self, content: str) -> Dict[str, str]:
+        found: Dict[str, str] = {}
+
+        def flatten(data: Any, path: str) -> None:
+            if isinstance(data, dict):
+                for key, value in data.items():
+                    flatten(value, f"{path}/{key}" if path else str(key))
+            elif isinstance(data, list):
+                for index, value in enumerate(data):
+                    flatten(value, f"{path}/{index}")
+            elif isinstance(data, str):
+                found[f"vault secret {path}"] = data
+
+        flatten(json.loads(content), "")
+        return found
+
+
+class SecretIndex:
+    """
+    SecretIndex finds known secret values in text with a single linear scan.
+
+    The index doesn't keep secrets in full. Each one is reduced to a short
+    prefix and a keyed BLAKE2 digest of the full value. The prefixes are kept
+    in plaintext, indexed in an Aho-Corasick automaton, and every prefix hit
+    is confirmed by hashing the text window of the candidate's length and
+    comparing digests. The sources are loaded again on every rebuild, so
+    the full values stay wherever the sources keep them, such as the
+    environment, a file, or the memory of a StaticSource.
+
+    Bodies screened as bytes are searched for the latin-1 form of each
+    secret with a second automaton over the latin-1 prefixes, run over the
+    latin-1 decoding of the body so every offset is the same in both, and
+    candidate windows are hashed straight from memoryview slices of the body
+    without copying it.
+
+    The index is rebuilt in the background when a source's fingerprint changes.
+    """
+
+    sources: List[SecretSource]
+    """Where secrets are loaded from"""
+
+    prefix_length: int
+    """How many leading characters of each secret are indexed, in plaintext"""
+
+    min_length: int
+    """Secrets shorter than this are ignored to avoid false positives"""
+
+    generation: int
+    """How many times the index has been built, so users can tell it changed"""
+
+    def __init__(
+        self,
+        sources: List[SecretSource],
+        prefix_length: int = 6,
+        min_length: int = 8,
+    ) -> None:
+        self.sources = sources
+        self.prefix_length = prefix_length
+        self.min_length = min_length
+
+        # digests are keyed so they are useless outside this process
+        self._key = secrets.token_bytes(32)
+
+        self._automaton = AhoCorasick()
+        self._automaton.build()
+        # the automaton over the latin-1 prefixes, for bodies screened as bytes
+        self._byte_automaton = AhoCorasick()
+        self._byte_automaton.build()
+        self._size = 0
+        self._fingerprints: List[Hashable] = []
+        self.generation = 0
+        self._rebuild_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+        self.rebuild()
+
+    def __len__(self) -> int:
+        """The number of secrets indexed"""
+        return self._size
+
+    def _digest(self, value: str) -> bytes:
+        return self._digest_bytes(value.encode("utf-8", "surrogatepass"))
+
+    def _digest_bytes(self, data: Union[bytes, memoryview]) -> bytes:
+        return hashlib.blake2b(data, key=self._key, digest_size=16).digest()
+
+    def rebuild(self) -> None:
+        """Reload every source and swap in a freshly built automaton"""
+        with self._rebuild_lock:
+            fingerprints = [source.fingerprint() for source in self.sources]
+
+            candidates: Dict[str, Dict[Tuple[int, bytes], str]] = {}
+            byte_candidates: Dict[bytes, Dict[Tuple[int, bytes], str]] = {}
+            for source in self.sources:
+                for name, value in source.load().items():
+                    if len(value) < self.min_length:
+                        continue
+                    prefix = value[: self.prefix_length]
+                    key = (len(value), self._digest(value))
+                    candidates.setdefault(prefix, {}).setdefault(key, name)
+
+                    try:
+                        encoded = value.encode("latin-1")
+                    except UnicodeEncodeError:
+                        continue  # can't occur in a body screened as bytes
+                    byte_key = (len(encoded), self._digest_bytes(encoded))
+                    byte_candidates.setdefault(
+                        encoded[: self.prefix_length], {}
+                    ).setdefault(byte_key, name)
+
+            automaton = AhoCorasick()
+            size = 0
+            for prefix, by_digest in candidates.items():
+                automaton.add(
+                    prefix,
+                    (
+                        len(prefix),
+                        [
+                            (length, digest, name)
+                            for (length, digest), name in by_digest.items()
+                        ],
+                    ),
+                )
+                size += len(by_digest)
+            automaton.build()
+
+            # bytes are searched through their latin-1 decoding, where every
+            # byte is the character at the same offset
+            byte_automaton = AhoCorasick()
+            for byte_prefix, by_digest in byte_candidates.items():
+                byte_automaton.add(
+                    byte_prefix.decode("latin-1"),
+                    (
+                        len(byte_prefix),
+                        [
+                            (length, digest, name)
+                            for (length, digest), name in by_digest.items()
+                        ],
+                    ),
+                )
+            byte_automaton.build()
+
+            # swapping the reference is atomic, scans in flight keep the old one
+            self._automaton = automaton
+            self._byte_automaton = byte_automaton
+            self._size = size
+            self._fingerprints = fingerprints
+            self.generation += 1
+
+    def refresh(self) -> bool:
+        """Rebuild if any source changed. Returns whether a rebuild happened"""
+        fingerprints = [source.fingerprint() for source in self.sources]
+        if fingerprints == self._fingerprints:
+            return False
+        self.rebuild()
+        return True
+
+    def watch(self, interval: float = 30.0) -> None:
+        """Check the sources for changes every interval seconds in the background"""
+        if self._watcher is not None:
+            return
+
+        def run() -> None:
+            while not self._stop.wait(interval):
+                try:
+                    if self.refresh():
+                        print(f"Secret index rebuilt with {len(self)} secrets")
+                except Exception as e:
+                    print(f"Failed to refresh the secret index: {e}")
+
+        self._watcher = threading.Thread(
+            target=run, name="secret-index-watcher", daemon=True
+        )
+        self._watcher.start()
+
+    def stop(self) -> None:
+        """Stop watching the sources"""
+        self._stop.set()
+
+    def scan(self, text: Union[str, bytes], min_end: int = 0) -> List[str]:
+        """
+        Return the names of every secret found in the text, in order found.
+
+        Occurrences ending at or before min_end are ignored.
+        """
+        if isinstance(text, bytes):
+            return self._scan_bytes(text, min_end)
+
+        found: Dict[str, None] = {}
+        for end, (prefix_length, candidates) in self._automaton.iter(text):
+            start = end - prefix_length + 1
+            for length, digest, name in candidates:
+                if name in found or start + length <= min_end:
+                    continue
+                window = text[start : start + length]
+                if len(window) == length and self._digest(window) == digest:
+                    found[name] = None
+        return list(found)
+
+    def _scan_bytes(self, data: bytes, min_end: int = 0) -> List[str]:
+        """scan for a body screened as bytes"""
+        automaton = self._byte_automaton
+        if not len(automaton):
+            return []
+
+        view = memoryview(data)
+        found: Dict[str, None] = {}
+        for end, (prefix_length, candidates) in automaton.iter(data.decode("latin-1")):
+            start = end - prefix_length + 1
+            for length, digest, name in candidates:
+                if name in found or start + length <= min_end:
+                    continue
+                # candidates are hashed straight from the body, without copying it
+                window = view[start : start + length]
+                if len(window) == length and self._digest_bytes(window) == digest:
+                    found[name] = None
+        return list(found)
@@ -0,0 +1,21 @@
+import sqlite3
+
+
+def execute_script(connection: sqlite3.Connection, script: str) -> None:
+    """
+    Run the statements of an SQL script one at a time.
+
+    Unlike executescript, which commits first, this leaves the transaction
+    of the connection open, so a script can be part of a larger one such as
+    a schema migration. Statements are split where sqlite3 considers them
+    complete, so the bodies of triggers stay whole.
+    """
+    statement = ""
+    for part in script.split(";"):
+        statement += part + ";"
+        if sqlite3.complete_statement(statement):
+            connection.execute(statement)
+            statement = ""
+    # whatever is left after the last semicolon, such as a trailing comment
+    if statement[:-1].strip():
+        connection.execute(statement[:-1])
@@ -0,0 +1,157 @@
+from functools import cached_property
+import json
+import re
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+if TYPE_CHECKING:
+    from ScreeningContext import ScreeningContext
+
+
+# JSON documents worth parsing start with an object or an array
+_JSON_START = re.compile(r"\s*[\[{]")
+_JSON_START_BYTES = re.compile(rb"\s*[\[{]")
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+
+def looks_like_json(text: Union[str, bytes]) -> bool:
+    """Cheap check for whether text could be a JSON object or array"""
+    if isinstance(text, bytes):
+        return bool(text) and _JSON_START_BYTES.match(text) is not None
+    return bool(text) and _JSON_START.match(text) is not None
+
+
+def parse_json(text: Union[str, bytes]) -> Optional[Any]:
+    """
+    Parse text as JSON, returning None if it is not a JSON object or array.
+
+    Bytes are read as latin-1, as the body text would have been, and ASCII
+    bytes are parsed without decoding them at all.
+    """
+    if not looks_like_json(text):
+        return None
+    if isinstance(text, bytes) and not text.isascii():
+        text = text.decode("latin-1")
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+class JsonIndex:
+    """
+    A flattened view of a parsed JSON document, built with a single walk.
+
+    objects holds every JSON object in document order (parents before their
+    children), and fields holds every scalar value with its path.
+    """
+
+    objects: List[Dict[str, Any]]
+    """Every object in the document, in pre-order"""
+
+    fields: List[Tuple[str, str, Any]]
+    """(path, key, value) for every scalar in the document"""
+
+    def __init__(self, data: Any) -> None:
+        self.objects = []
+        self.fields = []
+
+        stack: List[Tuple[str, str, Any]] = [("", "", data)]
+        while stack:
+            path, key, value = stack.pop()
+            if isinstance(value, dict):
+                self.objects.append(value)
+                children = [
+                    (f"{path}.{child_key}" if path else str(child_key), str(child_key), child)
+                    for child_key, child in value.items()
+                ]
+            elif isinstance(value, list):
+                children = [
+                    (f"{path}[{index}]", key, child) for index, child in enumerate(value)
+                ]
+            else:
+                self.fields.append((path, key, value))
+                continue
+            # reversed so children come off the stack in document order
+            stack.extend(reversed(children))
+
+
+class StructuredBody:
+    """
+    StructuredBody parses the structured parts of a request at most once.
+
+    The content type is detected once, and the JSON body, form body and URL
+    query are each parsed only when a screener first asks for them. Text that
+    cannot be a JSON object or array never reaches json.loads.
+    """
+
+    context: "ScreeningContext"
+    """The screening context of the request"""
+
+    def __init__(self, context: "ScreeningContext") -> None:
+        self.context = context
+
+    @cached_property
+    def content_type(self) -> str:
+        """The lowercased media type of the request body, without parameters"""
+        return self.context.content_type.split(";", 1)[0].strip().lower()
+
+    @cached_property
+    def json(self) -> Optional[Any]:
+        """The body parsed as JSON, or None if it is not a JSON object or array"""
+        return parse_json(self.context.search_body)
+
+    @cached_property
+    def json_index(self) -> Optional[JsonIndex]:
+        """The flattened JSON body, or None if the body is not JSON"""
+        if self.json is None:
+            return None
+        return JsonIndex(self.json)
+
+    @cached_property
+    def form(self) -> Optional[Dict[str, str]]:
+        """The body parsed as a urlencoded form, or None if it is not one"""
+        if self.content_type != FORM_CONTENT_TYPE:
+            return None
+        return dict(parse_qsl(self.context.body, keep_blank_values=True))
+
+    @cached_property
+    def query(self) -> Dict[str, str]:
+        """The parameters of the URL query string"""
+        return dict(parse_qsl(urlsplit(self.context.url).query, keep_blank_values=True))
+
+    @cached_property
+    def fields(self) -> List[Tuple[str, str, Any]]:
+        """
+        (path, key, value) for every value in the JSON body, form body and query.
+
+        Form and query paths are prefixed with "form." and "query." so they
+        don't collide with JSON paths.
+        """
+        fields: List[Tuple[str, str, Any]] = []
+        if self.json_index is not None:
+            fields.extend(self.json_index.fields)
+        if self.form is not None:
+            fields.extend((f"form.{key}", key, value) for key, value in self.form.items())
+        fields.extend((f"query.{key}", key, value) for key, value in self.query.items())
+        return fields
+
+    def json_index_for(self, text: Union[str, bytes]) -> Optional[JsonIndex]:
+        """
+        Flatten one of the context's search strings as JSON.
+
+        The body reuses the cached parse, other strings go through the prefilter.
+        """
+        if text is self.context.search_body:
+            return self.json_index
+        data = parse_json(text)
+        return JsonIndex(data) if data is not None else None
+
+    def parameters_for(self, text: Union[str, bytes]) -> Optional[Dict[str, str]]:
+        """The form parameters of the body or the query parameters of the URL"""
+        if text is self.context.search_body:
+            return self.form
+        if text is self.context.url:
+            return self.query
+        return None
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from mitmproxy import tcp
+
+from MatchEngine import MatchEngine
+from ScreeningContext import TcpScreeningContext
+
+
+class TcpStreams:
+    """
+    TcpStreams screens TCP connections incrementally, one message at a time.
+
+    Only the newest message of a connection is screened, never the stream so
+    far. To catch values split across segment boundaries, the last carry_size
+    characters of each direction are kept and put in front of the next
+    message in that direction. carry_size must be at least as long as the
+    longest value screened for, less one.
+
+    At most carry_size characters are kept per direction, and at most
+    max_streams directions are tracked at once, the least recently active
+    ones being forgotten first. State is freed when a connection closes.
+    """
+
+    carry_size: int
+    """The number of trailing characters carried over to the next message"""
+
+    max_streams: int
+    """The maximum number of connection directions tracked at once"""
+
+    def __init__(self, carry_size: int = 256, max_streams: int = 10000) -> None:
+        self.carry_size = carry_size
+        self.max_streams = max_streams
+        self._carry: "OrderedDict[Tuple[str, bool], str]" = OrderedDict()
+
+    def __len__(self) -> int:
+        """The number of connection directions with a carried over tail"""
+        return len(self._carry)
+
+    def context(
+        self, flow: tcp.TCPFlow, match_engine: Optional[MatchEngine] = None
+    ) -> Optional[TcpScreeningContext]:
+        """
+        Build the screening context of the newest message of a connection.
+
+        Returns None if the connection has no messages.
+        """
+        if not flow.messages:
+            return None
+
+        message = flow.messages[-1]
+        key = (flow.id, message.from_client)
+
+        carry = self._carry.pop(key, "")
+        text = carry + message.content.decode("latin-1")
+
+        if self.carry_size > 0:
+            self._carry[key] = text[-self.carry_size :]
+            while len(self._carry) > self.max_streams:
+                self._carry.popitem(last=False)
+
+        return TcpScreeningContext(flow, message, text, len(carry), match_engine)
+
+    def close(self, flow: tcp.TCPFlow) -> None:
+        """Forget the carried over tails of a connection"""
+        self._carry.pop((flow.id, True), None)
+        self._carry.pop((flow.id, False), None)
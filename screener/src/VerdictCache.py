@@ -0,0 +1,193 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+import hashlib
+import sys
+import threading
+import time
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+from ScreeningContext import ScreeningContext
+from Screeners.IndividualScreener import IndividualScreener
+
+
+Found = List[Any]
+"""What screen_material found in a context, screener for screener"""
+
+CacheKey = Tuple[bytes, Tuple[Hashable, ...]]
+"""The digest of the screened material and the version and state of every screener"""
+
+ENTRY_OVERHEAD = 256
+"""The bytes an entry is counted as besides its results, for the key and bookkeeping"""
+
+
+def material_digest(context: ScreeningContext) -> bytes:
+    """
+    A digest of everything screen_material can see of a context.
+
+    That is the kind of traffic, the overlap and every search string, each
+    marked with whether it is bytes and its length so no two different
+    contexts are fed to the hash as the same input.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{context.kind}:{context.overlap}".encode())
+    for text in context.search_strings:
+        if isinstance(text, bytes):
+            digest.update(b"\0b%d:" % len(text))
+            digest.update(text)
+        else:
+            encoded = text.encode("utf-8", "surrogatepass")
+            digest.update(b"\0s%d:" % len(encoded))
+            digest.update(encoded)
+    return digest.digest()
+
+
+@dataclass
+class VerdictCacheStats:
+    """Counters describing how well the verdict cache works"""
+
+    hits: int = 0
+    """Contexts whose material had been screened before"""
+
+    misses: int = 0
+    """Contexts that had to be screened"""
+
+    evictions: int = 0
+    """Entries dropped to stay within the entry and byte limits"""
+
+    expirations: int = 0
+    """Entries dropped because they were older than the TTL"""
+
+    entries: int = 0
+    """Entries in the cache"""
+
+    bytes: int = 0
+    """Approximate size of the entries in the cache"""
+
+
+class VerdictCache:
+    """
+    VerdictCache remembers what the screeners found in material they have
+    already screened.
+
+    Mobile SDKs send the same heartbeat and telemetry bodies over and over,
+    and screening each copy finds the same things in it. Contexts are keyed
+    by a BLAKE2 digest of their search strings, so a byte-identical repeat
+    skips the scan and the screeners entirely.
+
+    Only the part of screening that depends on the material alone is
+    cached, what each screener's screen_material returns. Every screener's
+    verdict still runs on every context, so stateful screeners such as the
+    TimestampScreener count every repeat in their rate windows, and the
+    LocationScreener compares cached coordinates with the current device
+    location. The key also holds every screener's cache_version and
+    cache_state, so entries stop being used once a screener changes or
+    reloads what it screens for, such as its secrets.
+
+    Entries are evicted least recently used first once there are more than
+    max_entries of them or they take more than max_bytes, and are not used
+    once they are older than ttl seconds. The cache can be shared by the
+    threads of a ScreeningExecutor.
+    """
+
+    max_entries: int
+    """The most entries kept"""
+
+    max_bytes: int
+    """The most bytes the entries are counted as taking up"""
+
+    ttl: Optional[float]
+    """How many seconds an entry is used for, None to use it until it is evicted"""
+
+    stats: VerdictCacheStats
+    """Hit, miss and eviction counters"""
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl: Optional[float] = 300.0,
+    ) -> None:
+        """
+        Args:
+            max_entries: The most entries kept
+            max_bytes: The most bytes the entries are counted as taking up
+            ttl: How many seconds an entry is used for, None for no limit
+        """
+        if max_entries < 1 or max_bytes < 1:
+            raise ValueError("A verdict cache needs room for at least one entry")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = VerdictCacheStats()
+
+        # key -> (found, size, expires at), least recently used first
+        self._entries: "OrderedDict[CacheKey, Tuple[Found, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """The number of entries"""
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of contexts found in the cache, 0 before any lookup"""
+        lookups = self.stats.hits + self.stats.misses
+        return self.stats.hits / lookups if lookups else 0.0
+
+    def factory(self) -> Callable[[], "VerdictCache"]:
+        """Builds empty caches with the same limits, for worker processes"""
+        return partial(VerdictCache, self.max_entries, self.max_bytes, self.ttl)
+
+    def key(self, screeners: List[IndividualScreener], context: ScreeningContext) -> CacheKey:
+        """The key of a context screened by a list of screeners"""
+        return (
+            material_digest(context),
+            tuple(
+                (type(screener).__name__, screener.cache_version, screener.cache_state())
+                for screener in screeners
+            ),
+        )
+
+    def get(self, key: CacheKey) -> Optional[Found]:
+        """What was found in the material of a key, None if it isn't cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                self.stats.expirations += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[0]
+
+    def put(self, key: CacheKey, found: Found) -> None:
+        """Keep what was found in the material of a key, evicting as needed"""
+        size = ENTRY_OVERHEAD + sum(sys.getsizeof(result) for result in found)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (found, size, expires)
+            self.stats.bytes += size
+            while len(self._entries) > self.max_entries or self.stats.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+            self.stats.entries = len(self._entries)
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self.stats.bytes = 0
+            self.stats.entries = 0
+
+    def _remove(self, key: CacheKey) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.stats.bytes -= size
+        self.stats.entries = len(self._entries)
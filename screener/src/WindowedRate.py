@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import math
+import threading
+import time
+from typing import Hashable, List, Optional
+
+
+class _Buckets:
+    """The event counts of one key, in a ring of buckets"""
+
+    __slots__ = ("counts", "head", "total", "touched")
+
+    def __init__(self, buckets: int, head: int) -> None:
+        self.counts: List[int] = [0] * buckets
+        # the number of the newest bucket in the ring
+        self.head = head
+        self.total = 0
+        # when the key was last added to, on the monotonic clock
+        self.touched = 0.0
+
+
+class WindowedRate:
+    """
+    WindowedRate counts events per key over a sliding window of time.
+
+    Screeners that alert on "more than N events in T seconds" share it, with
+    keys such as the host of a request. The window is split into a fixed
+    number of buckets kept in a ring per key, so recording an event and
+    reading the count take constant time, and a key uses the same memory
+    whether it sees one event or a million. Counts are exact to the width of
+    a bucket, window / buckets seconds.
+
+    A key is forgotten once nothing has been added to it for a whole window,
+    and at most max_keys keys are tracked at once, the least recently active
+    ones being forgotten first.
+
+    The times of events are passed in, rather than read from the clock, so
+    that replayed traffic is counted as it happened. Idleness is measured on
+    the monotonic clock instead, so how a key is counted never depends on the
+    times of the events of other keys. The methods are thread safe.
+    """
+
+    window: float
+    """The length of the window in seconds"""
+
+    buckets: int
+    """The number of buckets the window is split into"""
+
+    max_keys: int
+    """The maximum number of keys tracked at once"""
+
+    def __init__(self, window: float, buckets: int = 60, max_keys: int = 10000) -> None:
+        """
+        Args:
+            window: The length of the window in seconds
+            buckets: The number of buckets the window is split into
+            max_keys: The maximum number of keys tracked at once
+        """
+        self.window = window
+        self.buckets = buckets
+        self.max_keys = max_keys
+        self._width = window / buckets
+        self._keys: "OrderedDict[Hashable, _Buckets]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """The number of keys tracked"""
+        return len(self._keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def add(self, key: Hashable, now: Optional[float] = None, count: int = 1) -> int:
+        """
+        Record count events for a key at now.
+
+        Returns the number of events of the key in the window ending at now,
+        or at the latest time seen for the key if that is later. Events older
+        than the window are not recorded.
+        """
+        if now is None:
+            now = time.time()
+        bucket = math.floor(now / self._width)
+
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                entry = _Buckets(self.buckets, bucket)
+                self._keys[key] = entry
+            else:
+                self._keys.move_to_end(key)
+            self._advance(entry, bucket)
+
+            if bucket > entry.head - self.buckets:
+                entry.counts[bucket % self.buckets] += count
+                entry.total += count
+            entry.touched = time.monotonic()
+
+            self._evict(entry.touched)
+            return entry.total
+
+    def count(self, key: Hashable, now: Optional[float] = None) -> int:
+        """The number of events of a key in the window ending at now"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                return 0
+            self._advance(entry, math.floor(now / self._width))
+            return entry.total
+
+    def discard(self, key: Hashable) -> None:
+        """Forget a key"""
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def clear(self) -> None:
+        """Forget every key"""
+        with self._lock:
+            self._keys.clear()
+
+    def _advance(self, entry: _Buckets, bucket: int) -> None:
+        """Move the ring of a key forward to bucket, emptying the buckets it passes"""
+        if bucket <= entry.head:
+            return
+        if bucket - entry.head >= self.buckets:
+            entry.counts = [0] * self.buckets
+            entry.total = 0
+        else:
+            for passed in range(entry.head + 1, bucket + 1):
+                slot = passed % self.buckets
+                entry.total -= entry.counts[slot]
+                entry.counts[slot] = 0
+        entry.head = bucket
+
+    def _evict(self, now: float) -> None:
+        """Forget the keys idle for a whole window, and the oldest ones over max_keys"""
+        while len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+        # the keys are in the order they were added to, so the idle ones are first
+        while self._keys:
+            oldest = next(iter(self._keys.values()))
+            if now - oldest.touched < self.window:
+                break
+            self._keys.popitem(last=False)
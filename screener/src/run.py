@@ -3,7 +3,25 @@ import mitmproxy.http as http
 
 from AllScreenersCombined import AllScreenersCombined
 
-unified_screener = AllScreenersCombined(database_path="../database.db")
+# screen on a thread pool so slow screeners never stall the proxy,
+# holding each flow for at most two seconds while it is screened.
+# Metrics are served at http://127.0.0.1:9464/metrics
+# Every built-in screener is enabled, pass screener_config to choose them.
+# Everything is kept until retention is turned on. To delete alerts after 90
+# days and their traffic after 30, archiving each day to its own file in
+# ../archive first, import RetentionPolicy from Retention and pass
+# retention=RetentionPolicy(archive_dir="../archive")
+unified_screener = AllScreenersCombined(
+    database_path="../database.db",
+    executor="thread",
+    hold=True,
+    deadline=2.0,
+    metrics_port=9464,
+    retention=None,
+)
+
+# what importing and building each screener cost, see scripts/startup.py
+print(unified_screener.screener_registry.report())
 
 print("Initializing Addons")
 addons = [unified_screener]
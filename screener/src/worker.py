@@ -0,0 +1,25 @@
+# this is the entrypoint for each proxy worker of a multi-worker deployment,
+# launched by scripts/runworkers.py rather than by hand
+import os
+
+from AllScreenersCombined import AllScreenersCombined
+from AlertWriterService import RemoteAlertSink, parse_address
+
+# the worker's alerts go to the writer service, which owns the database.
+# Screening works as in run.py, and each worker serves its own metrics
+worker = int(os.environ.get("TRAFFIC_SLICE_WORKER", "0"))
+metrics_port = os.environ.get("TRAFFIC_SLICE_METRICS_PORT")
+unified_screener = AllScreenersCombined(
+    alert_sink=RemoteAlertSink(
+        parse_address(os.environ["TRAFFIC_SLICE_WRITER_ADDRESS"]),
+        authkey=bytes.fromhex(os.environ["TRAFFIC_SLICE_WRITER_AUTHKEY"]),
+    ),
+    executor="thread",
+    hold=True,
+    deadline=2.0,
+    metrics_port=int(metrics_port) if metrics_port else None,
+    screener_config=os.environ.get("TRAFFIC_SLICE_SCREENER_CONFIG") or None,
+)
+
+print(f"Initializing worker {worker}")
+addons = [unified_screener]